@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+from mock_llm import ScriptedLLM, current_stats, turn
+
+# Offline benchmark for run_main_loop: the model is replaced by a scripted,
+# deterministic stand-in with injected latency, so it runs without network
+# access or an API key and the numbers are comparable between commits.
+#
+#   python bench.py                               README example prompts
+#   python bench.py --latency 0.8 --compare       also run SINGLE_CALL_MODE=0
+#   python bench.py --replay flask_app_builder_log.json
+#   python bench.py --replay logs/<job_id>.jsonl --concurrency 4 --json
+
+HELLO_ROUTE = """from flask import Blueprint
+
+hello_bp = Blueprint('hello', __name__)
+
+@hello_bp.route('/hello')
+def hello():
+    return 'hello world'
+"""
+
+
+def _route(name):
+    return f"""from flask import Blueprint
+
+{name}_bp = Blueprint('{name}', __name__)
+
+@{name}_bp.route('/{name}')
+def {name}():
+    return '{name}'
+"""
+
+
+# Prompt -> (script, {url: expected body}); the prompts are the README examples
+SCENARIOS = {
+    "hello": (
+        '创建一个简单的 Flask 应用，输出 "hello world"，只有一个路由 `/hello`。',
+        [
+            turn("规划：只需要 routes/hello.py。",
+                 ("create_directory", {"path": "routes"}),
+                 ("create_file", {"path": "routes/hello.py", "content": HELLO_ROUTE})),
+            turn("", ("fetch_code", {"file_path": "routes/hello.py"})),
+            turn("路由已完成。", ("task_completed", {})),
+        ],
+        {"/hello": "hello world"}
+    ),
+    "helloa_hellob": (
+        '创建一个 Flask 应用，有两个路由 `/helloa` 和 `/hellob`，分别输出 "helloa" 和 "hellob"。',
+        [
+            turn("规划：routes/helloa.py 和 routes/hellob.py。",
+                 ("create_directory", {"path": "routes"}),
+                 ("create_file", {"path": "routes/helloa.py", "content": _route("helloa")}),
+                 ("create_file", {"path": "routes/hellob.py", "content": _route("hellob")})),
+            turn("",
+                 ("fetch_code", {"file_path": "routes/helloa.py"}),
+                 ("fetch_code", {"file_path": "routes/hellob.py"})),
+            turn("两个路由都已完成。", ("task_completed", {})),
+        ],
+        {"/helloa": "helloa", "/hellob": "hellob"}
+    ),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Flask app builder loop")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable; default: all)")
+    parser.add_argument('--replay', metavar='LOG',
+                        help="replay a recorded session (flask_app_builder_log.json or logs/<job>.jsonl) instead")
+    parser.add_argument('--latency', type=float, default=0.5, help="seconds per LLM call (default 0.5)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="extra random seconds per call, seeded")
+    parser.add_argument('--seconds-per-token', type=float, default=0.0,
+                        help="extra seconds per completion token, to model generation speed")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=1, help="builds of each scenario run at once")
+    parser.add_argument('--repeat', type=int, default=1, help="rounds per scenario")
+    parser.add_argument('--no-warmup', action='store_true',
+                        help="also time the first build (tokenizer and import warm-up included)")
+    parser.add_argument('--compare', action='store_true', help="also run with SINGLE_CALL_MODE=0")
+    parser.add_argument('--workdir', help="directory generated files are written to (default: a temp dir)")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    return parser.parse_args(argv)
+
+
+def prepare_workdir(path):
+    # main.py resolves its directories at import time, so this has to run first
+    workdir = os.path.abspath(path or tempfile.mkdtemp(prefix='builder-bench-'))
+    os.makedirs(workdir, exist_ok=True)
+    os.environ['BUILDER_BASE_DIR'] = workdir
+    os.environ['BUILD_LOG_DIR'] = os.path.join(workdir, 'logs')
+    # Cached completions would hide the injected latency
+    os.environ.pop('LLM_CACHE_PATH', None)
+    os.chdir(workdir)
+    return workdir
+
+
+async def run_build(main, prompt):
+    from jobs import new_job_state
+
+    stats = {}
+    current_stats.set(stats)
+    job = new_job_state(user_input=prompt, max_iterations=main.MAX_ITERATIONS)
+    started = time.perf_counter()
+    await main.run_main_loop_async(prompt, job)
+    wall = time.perf_counter() - started
+    llm_seconds = stats.get("llm_seconds", 0.0)
+    return {
+        "status": job["status"],
+        "wall_seconds": wall,
+        "iterations": job["iteration"],
+        "llm_calls": stats.get("llm_calls", 0),
+        "prompt_tokens": job.get("prompt_tokens", 0),
+        "completion_tokens": job.get("completion_tokens", 0),
+        "llm_seconds": llm_seconds,
+        "outside_llm_seconds": max(0.0, wall - llm_seconds),
+        "errors": sum(1 for event in job["events"] if event["type"] == "error")
+    }
+
+
+async def run_round(main, prompt, concurrency):
+    return await asyncio.gather(*(run_build(main, prompt) for _ in range(concurrency)))
+
+
+def check_routes(main, expected):
+    client = main.app.test_client()
+    return all(client.get(url).get_data(as_text=True) == body for url, body in expected.items())
+
+
+def summarize(name, mode, runs, round_seconds, routes_ok):
+    def median(key):
+        return statistics.median(run[key] for run in runs)
+
+    return {
+        "scenario": name,
+        "mode": mode,
+        "builds": len(runs),
+        "completed": sum(1 for run in runs if run["status"] == "completed"),
+        "routes_ok": routes_ok,
+        "wall_seconds": round(median("wall_seconds"), 3),
+        "round_seconds": round(statistics.median(round_seconds), 3),
+        "iterations": median("iterations"),
+        "llm_calls": median("llm_calls"),
+        "prompt_tokens": median("prompt_tokens"),
+        "completion_tokens": median("completion_tokens"),
+        "llm_seconds": round(median("llm_seconds"), 3),
+        "outside_llm_seconds": round(median("outside_llm_seconds"), 3),
+        "errors": sum(run["errors"] for run in runs)
+    }
+
+
+COLUMNS = [
+    ("scenario", "{:<16}"), ("mode", "{:<7}"), ("builds", "{:>6}"), ("completed", "{:>9}"),
+    ("routes_ok", "{!s:>9}"), ("wall_seconds", "{:>12}"), ("round_seconds", "{:>13}"),
+    ("iterations", "{:>10}"), ("llm_calls", "{:>9}"), ("prompt_tokens", "{:>13}"),
+    ("completion_tokens", "{:>17}"), ("llm_seconds", "{:>11}"), ("outside_llm_seconds", "{:>19}"),
+    ("errors", "{:>6}")
+]
+
+
+def print_table(results):
+    print(" ".join(fmt.replace("!s", "").format(name) for name, fmt in COLUMNS))
+    for result in results:
+        print(" ".join(fmt.format(result[name]) for name, fmt in COLUMNS))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    replay = os.path.abspath(args.replay) if args.replay else None
+    workdir = prepare_workdir(args.workdir)
+
+    import llm
+    import event_loop
+    import main as builder
+
+    if replay:
+        backend, prompt = ScriptedLLM.from_log(
+            replay, latency=args.latency, jitter=args.jitter, seconds_per_token=args.seconds_per_token, seed=args.seed
+        )
+        scenarios = {"replay": (prompt, None, {})}
+    else:
+        names = args.scenario or sorted(SCENARIOS)
+        backend = ScriptedLLM(
+            {SCENARIOS[name][0]: SCENARIOS[name][1] for name in names},
+            latency=args.latency, jitter=args.jitter, seconds_per_token=args.seconds_per_token, seed=args.seed
+        )
+        scenarios = {name: SCENARIOS[name] for name in names}
+    llm.set_backend(backend)
+
+    if not args.no_warmup:
+        event_loop.run_sync(run_round(builder, next(iter(scenarios.values()))[0], 1))
+
+    results = []
+    for single_call in ([True, False] if args.compare else [True]):
+        builder.SINGLE_CALL_MODE = single_call
+        mode = "single" if single_call else "double"
+        for name, (prompt, _, expected) in scenarios.items():
+            runs, round_seconds = [], []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                runs.extend(event_loop.run_sync(run_round(builder, prompt, args.concurrency)))
+                round_seconds.append(time.perf_counter() - started)
+            results.append(summarize(name, mode, runs, round_seconds, check_routes(builder, expected)))
+
+    if args.json:
+        json.dump({"workdir": workdir, "latency": args.latency, "jitter": args.jitter,
+                   "concurrency": args.concurrency, "results": results}, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"workdir: {workdir}  latency: {args.latency}s  jitter: {args.jitter}s  concurrency: {args.concurrency}")
+        print_table(results)
+    return 0 if all(r["completed"] == r["builds"] and r["routes_ok"] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
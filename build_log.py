@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import time
+import threading
+
+BUILD_LOG_DIR = os.environ.get('BUILD_LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs'))
+# Records held in memory before they are written out; 1 writes every record immediately
+BUILD_LOG_BUFFER = int(os.environ.get('BUILD_LOG_BUFFER', '64'))
+
+
+class BuildLog:
+    # Append-only JSONL log for one build: one record per action, never rewritten.
+
+    def __init__(self, path, buffer_records=BUILD_LOG_BUFFER):
+        self.path = path
+        self.buffer_records = max(1, buffer_records)
+        self._buffer = []
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    @classmethod
+    def for_job(cls, job_id, log_dir=BUILD_LOG_DIR, **kwargs):
+        return cls(os.path.join(log_dir, f"{job_id}.jsonl"), **kwargs)
+
+    def append(self, record_type, **data):
+        record = {"type": record_type, "time": time.time()}
+        record.update(data)
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) < self.buffer_records:
+                return
+            lines, self._buffer = self._buffer, []
+        self._write(lines)
+
+    def flush(self):
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+        if lines:
+            self._write(lines)
+
+    def _write(self, lines):
+        try:
+            with open(self.path, 'a', encoding='utf-8') as log_file:
+                log_file.write("".join(lines))
+        except Exception:
+            pass
+
+
+def read_records(path):
+    with open(path, encoding='utf-8') as log_file:
+        for line in log_file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A crash can leave a torn last line behind
+                continue
+
+
+def current_records(path):
+    # The records of the build as it finally ran. A resumed build appends to
+    # the same log and continues after its checkpointed iteration, so records
+    # of later iterations written before the "resume" record were superseded
+    # (the interrupted run got further than its last checkpoint) and are dropped.
+    records = list(read_records(path))
+    kept = []
+    limit = None
+    for record in reversed(records):
+        iteration = record.get("iteration")
+        if record.get("type") == "resume":
+            limit = iteration if limit is None else min(limit, iteration)
+        elif limit is not None and isinstance(iteration, int) and iteration > limit:
+            continue
+        kept.append(record)
+    kept.reverse()
+    return kept
+
+
+def load_iterations(path):
+    # Rebuilds the {"iterations": [...]} structure of the old flask_app_builder_log.json
+    history = {"iterations": []}
+    current = None
+    for record in current_records(path):
+        record_type = record.get("type")
+        if record_type == "iteration":
+            current = {
+                "iteration": record["iteration"],
+                "actions": [],
+                "llm_responses": [],
+                "tool_results": [],
+                "errors": []
+            }
+            history["iterations"].append(current)
+        elif record_type == "resume":
+            # Iterations after this one ran in a resumed run of the build
+            history.setdefault("resumed_after", []).append(record["iteration"])
+        elif current is None:
+            continue
+        elif record_type == "llm_response":
+            current["llm_responses"].append(record.get("content", ""))
+        elif record_type == "tool_result":
+            current["tool_results"].append({"tool": record.get("tool"), "result": record.get("result")})
+        elif record_type == "error":
+            error = {"action": record.get("action"), "error": record.get("error")}
+            if "traceback" in record:
+                error["traceback"] = record["traceback"]
+            current["errors"].append(error)
+        elif record_type == "action":
+            current["actions"].append(record.get("action"))
+    return history
+
+
+if __name__ == '__main__':
+    # python build_log.py logs/<job_id>.jsonl > flask_app_builder_log.json
+    json.dump(load_iterations(sys.argv[1]), sys.stdout, ensure_ascii=False, indent=4)
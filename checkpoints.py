@@ -0,0 +1,55 @@
+import os
+import base64
+import tempfile
+
+from llm_cache import MESSAGE_FIELDS, to_jsonable
+
+# Save the conversation and the build's changed files after every iteration so
+# an interrupted build can be resumed instead of started over
+BUILD_CHECKPOINTS = os.environ.get('BUILD_CHECKPOINTS', '1') != '0'
+
+
+def serialize_message(message):
+    # litellm Message objects become plain dicts, which completion() accepts as well
+    data = to_jsonable(message)
+    if not isinstance(data, dict):
+        return data
+    return {k: data[k] for k in MESSAGE_FIELDS if data.get(k) is not None}
+
+
+def changed_files(workspace, read):
+    # {relative path: {"text": ...} or {"base64": ...}} for every file the
+    # build changed in its workspace; `read` may be a caching reader
+    files = {}
+    for relative in workspace.changes():
+        path = os.path.join(workspace.root, relative)
+        try:
+            files[relative] = {"text": read(path)}
+        except UnicodeDecodeError:
+            with open(path, 'rb') as f:
+                files[relative] = {"base64": base64.b64encode(f.read()).decode('ascii')}
+    return files
+
+
+def restore_files(workspace, files):
+    # Writes checkpointed files into a fresh workspace. Its files are
+    # hardlinks to the base files, so each one is replaced, never written through.
+    for relative, content in files.items():
+        target = workspace.resolve(relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if "base64" in content:
+            data = base64.b64decode(content["base64"])
+        else:
+            data = content["text"].encode('utf-8')
+        fd, temporary = tempfile.mkstemp(prefix=f'.{os.path.basename(target)}.', dir=os.path.dirname(target))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, target)
+        except BaseException:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            raise
+    return sorted(files)
@@ -0,0 +1,157 @@
+import os
+import re
+import json
+
+from litellm import token_counter
+
+from llm_cache import to_jsonable
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '60000'))
+# Once over budget, compact down to this fraction of it so the rewritten
+# prefix stays stable (and provider-side prompt caching keeps hitting) for
+# many turns instead of shifting on every call
+CONTEXT_TARGET_RATIO = float(os.environ.get('CONTEXT_TARGET_RATIO', '0.7'))
+CONTEXT_KEEP_RECENT = int(os.environ.get('CONTEXT_KEEP_RECENT', '6'))
+
+WRITE_TOOLS = {"create_file": "path", "update_file": "path"}
+READ_TOOLS = {"fetch_code": "file_path"}
+# Read many files at once; the files a result covers are its "=== path ===" section headers
+MULTI_READ_TOOLS = {"fetch_files": "paths"}
+SECTION_HEADER = re.compile(r'^=== (.+) ===$', re.MULTILINE)
+# Edits in place: never stubbed themselves, but they make earlier copies of the file stale
+PATCH_TOOLS = {"apply_patch": "path"}
+
+STUB_PREFIX = "[compacted]"
+
+
+def _paths(*paths):
+    return frozenset(os.path.normpath(path) for path in paths if isinstance(path, str) and path)
+
+
+def _field(message, name):
+    if isinstance(message, dict):
+        return message.get(name)
+    return getattr(message, name, None)
+
+
+def _as_dict(message):
+    if isinstance(message, dict):
+        return message
+    data = to_jsonable(message)
+    return {k: v for k, v in data.items() if v is not None and k in ("role", "content", "name", "tool_calls", "tool_call_id")}
+
+
+class ContextCompactor:
+    # Keeps the messages sent for each request under a token budget by
+    # replacing stale tool output with short stubs. The leading `prefix`
+    # messages (system prompt, user request) and the most recent
+    # `keep_recent` messages are never touched.
+
+    def __init__(self, model, budget=CONTEXT_TOKEN_BUDGET, target_ratio=CONTEXT_TARGET_RATIO,
+                 keep_recent=CONTEXT_KEEP_RECENT, prefix=2):
+        self.model = model
+        self.budget = budget
+        self.target = int(budget * target_ratio)
+        self.keep_recent = keep_recent
+        self.prefix = prefix
+        self._sizes = {}
+
+    def message_tokens(self, message):
+        cached = self._sizes.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        text = json.dumps(to_jsonable(message), ensure_ascii=False)
+        try:
+            tokens = token_counter(model=self.model, text=text)
+        except Exception:
+            tokens = len(text) // 3
+        # Keep a reference so the id cannot be reused by another object
+        self._sizes[id(message)] = (message, tokens)
+        return tokens
+
+    def count(self, messages):
+        return sum(self.message_tokens(m) for m in messages)
+
+    def compact(self, messages):
+        # Mutates messages in place; returns (tokens_before, tokens_after)
+        before = self.count(messages)
+        if before <= self.budget:
+            return before, before
+        total = before
+        for index, call_id in self._candidates(messages):
+            if total <= self.target:
+                break
+            old_tokens = self.message_tokens(messages[index])
+            stub = self._stub(messages[index], call_id)
+            saved = old_tokens - self.message_tokens(stub)
+            if saved <= 0:
+                continue
+            messages[index] = stub
+            total -= saved
+        live = {id(m) for m in messages}
+        self._sizes = {k: v for k, v in self._sizes.items() if k in live}
+        return before, total
+
+    def _candidates(self, messages):
+        # Returns (message index, tool_call_id or None) pairs to stub, stale output first
+        calls = {}
+        touches = []
+        end = max(self.prefix, len(messages) - self.keep_recent)
+        for index, message in enumerate(messages):
+            role = _field(message, "role")
+            if role == "assistant":
+                for call in _as_dict(message).get("tool_calls") or []:
+                    name = call["function"]["name"]
+                    try:
+                        args = json.loads(call["function"]["arguments"] or "{}")
+                    except ValueError:
+                        args = {}
+                    calls[call["id"]] = (name, args)
+                    if name in WRITE_TOOLS and isinstance(args.get("content"), str):
+                        touches.append((index, call["id"], "write", _paths(args.get(WRITE_TOOLS[name]))))
+                    elif name in PATCH_TOOLS:
+                        touches.append((index, call["id"], "patch", _paths(args.get(PATCH_TOOLS[name]))))
+            elif role == "tool":
+                name, args = calls.get(_field(message, "tool_call_id"), (None, {}))
+                if name in READ_TOOLS:
+                    touches.append((index, None, "read", _paths(args.get(READ_TOOLS[name]))))
+                elif name in MULTI_READ_TOOLS:
+                    files = SECTION_HEADER.findall(str(_field(message, "content") or ""))
+                    touches.append((index, None, "read", _paths(*files)))
+                else:
+                    touches.append((index, None, "result", frozenset()))
+
+        stale, old = [], []
+        for position, (index, call_id, kind, paths) in enumerate(touches):
+            if kind == "patch" or index < self.prefix or index >= end or self._is_stub(messages[index], call_id):
+                continue
+            later = touches[position + 1:]
+            # Stale once any of its files is written again, or a later read covers all of them
+            superseded = any(t[2] in ("write", "patch") and paths & t[3] for t in later) or \
+                (kind == "read" and paths and any(t[2] == "read" and paths <= t[3] for t in later))
+            (stale if superseded else old).append((index, call_id))
+        return stale + old
+
+    def _is_stub(self, message, call_id):
+        if call_id is None:
+            return str(_field(message, "content") or "").startswith(STUB_PREFIX)
+        for call in _as_dict(message).get("tool_calls") or []:
+            if call["id"] == call_id:
+                return STUB_PREFIX in call["function"]["arguments"]
+        return True
+
+    def _stub(self, message, call_id):
+        message = dict(_as_dict(message))
+        if call_id is None:
+            content = str(message.get("content") or "")
+            message["content"] = f"{STUB_PREFIX} {message.get('name') or 'tool'} output omitted ({len(content)} chars); fetch the file again if you need it."
+            return message
+        tool_calls = []
+        for call in message.get("tool_calls") or []:
+            if call["id"] == call_id:
+                args = json.loads(call["function"]["arguments"])
+                args["content"] = f"{STUB_PREFIX} {len(args['content'])} chars written; fetch the file for its current content."
+                call = dict(call, function=dict(call["function"], arguments=json.dumps(args, ensure_ascii=False)))
+            tool_calls.append(call)
+        message["tool_calls"] = tool_calls
+        return message
@@ -0,0 +1,41 @@
+import asyncio
+import threading
+
+# One asyncio loop shared by every build in the process. It runs in a daemon
+# thread so Flask handlers and other sync code can hand coroutines to it.
+_loop = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    global _loop
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            threading.Thread(target=run, name='event-loop', daemon=True).start()
+            ready.wait()
+            _loop = loop
+        return _loop
+
+
+def submit(coro):
+    # Schedule a coroutine on the shared loop; returns a concurrent.futures.Future
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run_sync(coro, timeout=None):
+    loop = get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("run_sync() cannot be called from the shared event loop; await the coroutine instead")
+    return submit(coro).result(timeout)
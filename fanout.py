@@ -0,0 +1,72 @@
+import os
+import json
+import asyncio
+
+from workspace import WORKSPACE_DIRS
+
+# Plan-then-fan-out mode: one planning completion, then every planned file is
+# generated by its own completion, concurrently
+PLAN_FANOUT = os.environ.get('PLAN_FANOUT', '0') != '0'
+# File completions in flight at once; the rate limiter still applies to each
+FANOUT_CONCURRENCY = int(os.environ.get('FANOUT_CONCURRENCY', '8'))
+FANOUT_MAX_FILES = int(os.environ.get('FANOUT_MAX_FILES', '40'))
+
+
+class InvalidPlan(ValueError):
+    pass
+
+
+def parse_plan(arguments, max_files=FANOUT_MAX_FILES):
+    # Validates the arguments of a submit_plan call. Returns
+    # {"files": [{"path", "purpose", "interfaces"}], "routes": [...], "notes": str,
+    # "rejected": [str]}; planned paths outside templates/, static/ and routes/
+    # are rejected one by one, the rest of the plan still counts.
+    try:
+        plan = json.loads(arguments) if isinstance(arguments, str) else arguments
+    except ValueError as e:
+        raise InvalidPlan(f"plan is not valid JSON: {e}")
+    if not isinstance(plan, dict) or not isinstance(plan.get("files"), list):
+        raise InvalidPlan("plan has no list of files")
+    files = {}
+    rejected = []
+    for file in plan["files"]:
+        if not isinstance(file, dict) or not isinstance(file.get("path"), str):
+            rejected.append(f"planned file without a path: {file!r}")
+            continue
+        path = os.path.normpath(file["path"]).replace(os.sep, '/')
+        if os.path.isabs(path) or path.split('/')[0] not in WORKSPACE_DIRS:
+            rejected.append(f"{file['path']} is outside {', '.join(d + '/' for d in WORKSPACE_DIRS)}")
+            continue
+        files[path] = {"path": path, "purpose": str(file.get("purpose") or ""),
+                       "interfaces": str(file.get("interfaces") or "")}
+    if not files:
+        raise InvalidPlan("plan lists no usable files" + (f" ({'; '.join(rejected)})" if rejected else ""))
+    if len(files) > max_files:
+        raise InvalidPlan(f"plan lists {len(files)} files; at most {max_files} are generated in one fan-out")
+    routes = plan.get("routes") if isinstance(plan.get("routes"), list) else []
+    return {"files": list(files.values()), "routes": routes, "notes": str(plan.get("notes") or ""),
+            "rejected": rejected}
+
+
+def strip_code_fence(text):
+    # Models often wrap a whole file in a Markdown fence despite being asked not to
+    stripped = text.strip()
+    if stripped.startswith('```') and stripped.endswith('```') and '\n' in stripped:
+        return stripped[stripped.index('\n') + 1:-3].rstrip() + '\n'
+    return text
+
+
+async def generate_files(files, generate, concurrency=FANOUT_CONCURRENCY):
+    # Runs `await generate(file)` for every planned file, at most `concurrency`
+    # at a time. Returns (file, result, error) tuples in plan order; one
+    # failing file does not stop the others.
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(file):
+        async with semaphore:
+            try:
+                return file, await generate(file), None
+            except Exception as e:
+                return file, None, f"{type(e).__name__}: {e}"
+
+    return await asyncio.gather(*(run(file) for file in files))
@@ -0,0 +1,71 @@
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# Upper bound on the text kept in memory, in characters
+FILE_CACHE_MAX_CHARS = int(os.environ.get('FILE_CACHE_MAX_CHARS', str(32 * 1024 * 1024)))
+
+
+def _signature(stat):
+    # write_file replaces files by rename, so the inode changes on every write
+    # even when mtime granularity is coarse and the size stays the same
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class FileCache:
+    # Text contents of generated files, keyed by absolute path and validated
+    # against the file's (inode, mtime, size) on every read. Writers call put()
+    # so the next read of a file the build just wrote does not touch the disk.
+
+    def __init__(self, max_chars=FILE_CACHE_MAX_CHARS):
+        self.max_chars = max_chars
+        self._entries = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        # Raises OSError / UnicodeDecodeError like open(path).read() would
+        key = os.path.abspath(path)
+        signature = _signature(os.stat(key))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                metrics.file_cache_reads.inc(result="hit")
+                return entry[1]
+        metrics.file_cache_reads.inc(result="miss")
+        with open(key, 'r') as f:
+            content = f.read()
+        # Only cache what was read if the file did not change underneath us
+        if _signature(os.stat(key)) == signature:
+            self._store(key, signature, content)
+        return content
+
+    def put(self, path, content):
+        key = os.path.abspath(path)
+        try:
+            self._store(key, _signature(os.stat(key)), content)
+        except OSError:
+            self.discard(key)
+
+    def discard(self, path):
+        with self._lock:
+            entry = self._entries.pop(os.path.abspath(path), None)
+            if entry is not None:
+                self._chars -= len(entry[1])
+
+    def _store(self, key, signature, content):
+        if len(content) > self.max_chars:
+            self.discard(key)
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._chars -= len(previous[1])
+            self._entries[key] = (signature, content)
+            self._chars += len(content)
+            while self._chars > self.max_chars:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._chars -= len(evicted)
@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Job fields kept in their own columns; everything else a build adds to its
+# job dict (error, log_file, model, ...) goes into the JSON `extra` column
+COLUMNS = ("id", "status", "user_input", "iteration", "max_iterations", "completed", "llm_calls",
+           "prompt_tokens", "completion_tokens", "created_at", "started_at", "finished_at")
+# Job dict keys that are never persisted
+TRANSIENT = ("events",)
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    try:
+        # A killed worker nobody has reaped yet still answers signal 0
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return True
+
+
+class JobStore:
+    # Job state and progress events in SQLite, shared by every worker process
+    # of the server. WAL mode lets any worker read progress while the worker
+    # running the build appends to it. A queued job is picked up by whichever
+    # worker claims it first (claim() is a single IMMEDIATE transaction).
+
+    def __init__(self, path, timeout=10.0):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT NOT NULL, user_input TEXT, iteration INTEGER,"
+            " max_iterations INTEGER, completed INTEGER, llm_calls INTEGER, prompt_tokens INTEGER,"
+            " completion_tokens INTEGER, created_at REAL, started_at REAL, finished_at REAL,"
+            " owner TEXT, cancel_requested INTEGER DEFAULT 0, extra TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " job_id TEXT NOT NULL, seq INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (job_id, seq))"
+        )
+        # Latest checkpoint of each build; replaced after every iteration
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " job_id TEXT PRIMARY KEY, iteration INTEGER NOT NULL, saved_at REAL NOT NULL, data TEXT NOT NULL)"
+        )
+
+    @contextmanager
+    def _transaction(self, immediate=True):
+        # IMMEDIATE takes the write lock up front, so two workers cannot both
+        # read the same queued job before either of them updates it
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _row(self, job, owner=None):
+        extra = {k: v for k, v in job.items() if k not in COLUMNS and k not in TRANSIENT}
+        values = [job.get(column) for column in COLUMNS]
+        values[COLUMNS.index("completed")] = int(bool(job.get("completed")))
+        return values + [owner, json.dumps(extra, ensure_ascii=False, default=str)]
+
+    @staticmethod
+    def _job(row):
+        job = dict(zip(COLUMNS, row[:len(COLUMNS)]))
+        job["completed"] = bool(job["completed"])
+        job.update(json.loads(row[len(COLUMNS)] or "{}"))
+        return job
+
+    def _select(self, where, params=()):
+        return [self._job(row) for row in self._db.execute(
+            f"SELECT {', '.join(COLUMNS)}, extra FROM jobs {where}", params
+        ).fetchall()]
+
+    def insert(self, job, max_queue=None):
+        # Returns False instead of inserting when max_queue jobs are already waiting
+        with self._transaction():
+            if max_queue is not None:
+                queued = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+                if queued >= max_queue:
+                    return False
+            self._db.execute(
+                f"INSERT INTO jobs ({', '.join(COLUMNS)}, owner, extra) VALUES ({', '.join('?' * (len(COLUMNS) + 2))})",
+                self._row(job)
+            )
+        return True
+
+    def save(self, job, event=None):
+        # Writes the job's current fields and, optionally, one new event in the same transaction
+        self.save_many([(job, event)])
+
+    def save_many(self, updates):
+        # (job, event or None) pairs, applied in order in one transaction
+        assignments = ", ".join(f"{column} = ?" for column in COLUMNS[1:])
+        with self._transaction(immediate=False):
+            for job, event in updates:
+                values = self._row(job)
+                self._db.execute(f"UPDATE jobs SET {assignments}, extra = ? WHERE id = ?",
+                                 values[1:len(COLUMNS)] + values[-1:] + [job["id"]])
+                if event is not None:
+                    self._db.execute("INSERT OR REPLACE INTO events (job_id, seq, data) VALUES (?, ?, ?)",
+                                     (job["id"], event["seq"], json.dumps(event, ensure_ascii=False, default=str)))
+
+    def claim(self, owner):
+        # Atomically takes the oldest queued job for this worker; None when there is none
+        now = time.time()
+        with self._transaction():
+            row = self._db.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE jobs SET status = 'running', started_at = ?, owner = ? WHERE id = ?",
+                             (now, owner, row[0]))
+            return self._select("WHERE id = ?", (row[0],))[0]
+
+    def get(self, job_id):
+        with self._lock:
+            jobs = self._select("WHERE id = ?", (job_id,))
+        return jobs[0] if jobs else None
+
+    def list(self, limit=1000):
+        with self._lock:
+            return self._select("ORDER BY created_at DESC LIMIT ?", (limit,))[::-1]
+
+    def events(self, job_id, cursor=0):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT data FROM events WHERE job_id = ? AND seq >= ? ORDER BY seq", (job_id, max(0, cursor))
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+    def request_cancel(self, job_id):
+        # A queued job is cancelled on the spot; a running one is flagged for
+        # its owner to cancel. Returns False for unknown or finished jobs.
+        now = time.time()
+        with self._transaction():
+            cancelled = self._db.execute(
+                "UPDATE jobs SET status = 'cancelled', completed = 1, finished_at = ? "
+                "WHERE id = ? AND status = 'queued'", (now, job_id)
+            ).rowcount
+            if cancelled:
+                self._append_event(job_id, "end", now, status="cancelled")
+                return True
+            return self._db.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,)
+            ).rowcount > 0
+
+    def cancel_requests(self, owner):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE owner = ? AND status = 'running' AND cancel_requested = 1", (owner,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def save_checkpoint(self, job_id, iteration, data):
+        # Returns the size of the stored checkpoint in bytes
+        encoded = json.dumps(data, ensure_ascii=False, default=str)
+        with self._transaction(immediate=False):
+            self._db.execute("INSERT OR REPLACE INTO checkpoints (job_id, iteration, saved_at, data) VALUES (?, ?, ?, ?)",
+                             (job_id, iteration, time.time(), encoded))
+        return len(encoded)
+
+    def checkpoint(self, job_id):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM checkpoints WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete_checkpoint(self, job_id):
+        with self._transaction(immediate=False):
+            self._db.execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+
+    def resume(self, job_id, max_queue=None):
+        # Queues a failed or cancelled build that has a checkpoint again.
+        # Returns True when queued, False when max_queue jobs are already
+        # waiting and None when the job cannot be resumed.
+        with self._transaction():
+            row = self._db.execute(
+                "SELECT checkpoints.iteration FROM checkpoints JOIN jobs ON jobs.id = checkpoints.job_id "
+                "WHERE job_id = ? AND jobs.status IN ('error', 'cancelled')", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            if max_queue is not None:
+                queued = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+                if queued >= max_queue:
+                    return False
+            self._db.execute(
+                "UPDATE jobs SET status = 'queued', completed = 0, finished_at = NULL, owner = NULL, "
+                "cancel_requested = 0, extra = json_set(json_remove(COALESCE(extra, '{}'), '$.error'), "
+                "'$.resumed', COALESCE(json_extract(extra, '$.resumed'), 0) + 1) WHERE id = ?", (job_id,)
+            )
+            self._append_event(job_id, "resume_requested", time.time(), iteration=row[0])
+        return True
+
+    def _append_event(self, job_id, event_type, now, **data):
+        # For jobs no worker is running; a running job's owner appends through save()
+        seq = self._db.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM events WHERE job_id = ?", (job_id,)).fetchone()[0]
+        event = {"seq": seq, "type": event_type, "time": now}
+        event.update(data)
+        self._db.execute("INSERT INTO events (job_id, seq, data) VALUES (?, ?, ?)", (job_id, seq, json.dumps(event)))
+
+    def recover(self, host=None):
+        # Builds whose worker process died (same host) are marked as failed
+        host = host or socket.gethostname()
+        now = time.time()
+        with self._transaction():
+            rows = self._db.execute(
+                "SELECT id, owner FROM jobs WHERE status = 'running' AND owner LIKE ?", (f"{host}:%",)
+            ).fetchall()
+            for job_id, owner in rows:
+                if _pid_alive(int(owner.rsplit(':', 1)[1])):
+                    continue
+                self._db.execute(
+                    "UPDATE jobs SET status = 'error', completed = 1, finished_at = ?, "
+                    "extra = json_set(COALESCE(extra, '{}'), '$.error', 'worker exited') WHERE id = ?",
+                    (now, job_id)
+                )
+                self._append_event(job_id, "end", now, status="error")
+
+    def prune(self, keep):
+        # Forgets the oldest finished jobs (and their events) beyond the newest `keep` jobs
+        with self._transaction():
+            expired = [row[0] for row in self._db.execute(
+                "SELECT id FROM jobs WHERE finished_at IS NOT NULL AND id NOT IN "
+                "(SELECT id FROM jobs ORDER BY created_at DESC LIMIT ?)", (keep,)
+            ).fetchall()]
+            self._db.executemany("DELETE FROM events WHERE job_id = ?", [(job_id,) for job_id in expired])
+            self._db.executemany("DELETE FROM checkpoints WHERE job_id = ?", [(job_id,) for job_id in expired])
+            self._db.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in expired])
@@ -0,0 +1,323 @@
+import os
+import uuid
+import time
+import queue
+import asyncio
+import threading
+import traceback
+
+import event_loop
+import metrics
+from job_store import worker_id
+
+BUILD_CONCURRENCY = int(os.environ.get('BUILD_CONCURRENCY', '4'))
+BUILD_QUEUE_SIZE = int(os.environ.get('BUILD_QUEUE_SIZE', '100'))
+BUILD_HISTORY_SIZE = int(os.environ.get('BUILD_HISTORY_SIZE', '1000'))
+# Seconds between checks of the job store for queued jobs and cancel requests
+# from other workers; jobs submitted to this worker are picked up immediately
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '0.5'))
+# Seconds between sweeps for builds left running by a worker that died
+JOB_RECOVER_INTERVAL = 30
+
+
+# Wakes up event stream readers whenever any build appends an event
+_events_changed = threading.Condition()
+# Job id -> store for the jobs this process is running; their events are
+# written through so every worker can serve them
+_persisted = {}
+# Most job updates written to the store in one transaction
+WRITE_BATCH_SIZE = 200
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _StoreWriter:
+    # Writes job updates and events to their store from one background
+    # thread, in the order they were emitted and batched into a transaction
+    # per store, so the shared event loop never waits on SQLite locks.
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, store, job, event=None):
+        # job is copied now: it keeps changing while the write waits
+        self._start()
+        self._queue.put((store, job_snapshot(job), event))
+
+    def flush(self, timeout=None):
+        # Blocks until everything put before this call has been written
+        self._start()
+        done = threading.Event()
+        self._queue.put((None, done, None))
+        return done.wait(timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='job-store-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch, store = [], None
+            for item_store, job, event in items + [(None, None, None)]:
+                if batch and item_store is not store:
+                    try:
+                        store.save_many(batch)
+                    except Exception:
+                        traceback.print_exc()
+                    batch = []
+                if item_store is None:
+                    if job is not None:
+                        job.set()
+                    continue
+                store = item_store
+                batch.append((job, event))
+
+
+_writer = _StoreWriter()
+
+
+def new_job_state(job_id=None, user_input="", max_iterations=50):
+    return {
+        "id": job_id or uuid.uuid4().hex,
+        "status": "queued",
+        "user_input": user_input,
+        "iteration": 0,
+        "max_iterations": max_iterations,
+        "events": [],
+        "completed": False,
+        "llm_calls": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None
+    }
+
+
+def emit_event(job, event_type, **data):
+    # Progress is an append-only list of small structured events. Readers keep
+    # a cursor (the seq of the next event they want) and only fetch what is new.
+    with _events_changed:
+        event = {"seq": len(job["events"]), "type": event_type, "time": time.time()}
+        event.update(data)
+        job["events"].append(event)
+        _events_changed.notify_all()
+    store = _persisted.get(job["id"])
+    if store is not None:
+        _writer.put(store, job, event)
+    if event_type == "error":
+        metrics.errors.inc(action=data.get("action", "unknown"))
+    return event
+
+
+def job_store(job):
+    # The store a build running in this process is persisted to; None for
+    # builds run outside the engine (run_main_loop, speculative candidates)
+    return _persisted.get(job["id"])
+
+
+def job_snapshot(job):
+    snapshot = dict(job)
+    snapshot.pop("events", None)
+    return snapshot
+
+
+class JobEngine:
+    # Runs builds as coroutines on the shared event loop of every worker
+    # process. Jobs are queued in the shared JobStore; each worker's dispatcher
+    # claims queued jobs while it has fewer than max_workers builds running, so
+    # builds spread over the server's processes. Once max_queue jobs are
+    # waiting, submit() refuses new work.
+
+    def __init__(self, runner, store, max_workers=BUILD_CONCURRENCY, max_queue=BUILD_QUEUE_SIZE,
+                 history_size=BUILD_HISTORY_SIZE, max_iterations=50, poll_interval=JOB_POLL_INTERVAL):
+        self.runner = runner
+        self.store = store
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.history_size = history_size
+        self.max_iterations = max_iterations
+        self.poll_interval = poll_interval
+        self.owner = worker_id()
+        self._jobs = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._dispatcher = None
+
+    def start(self):
+        # Starts this worker's dispatcher. Each worker process imports the app
+        # itself (no preloading), so each one gets its own loop and dispatcher.
+        with self._lock:
+            if self._dispatcher is not None:
+                return
+            self.store.recover()
+            self._dispatcher = event_loop.submit(self._dispatch())
+
+    def submit(self, user_input):
+        self.start()
+        job = new_job_state(user_input=user_input, max_iterations=self.max_iterations)
+        if not self.store.insert(job, max_queue=self.max_queue):
+            raise QueueFull(f"build queue is full ({self.max_queue} pending)")
+        self.store.prune(self.history_size)
+        self._wake()
+        return job_snapshot(job)
+
+    def resume(self, job_id):
+        # Queues a failed or cancelled build again; the runner continues from
+        # its last checkpoint. Returns None when the job cannot be resumed.
+        self.start()
+        resumed = self.store.resume(job_id, max_queue=self.max_queue)
+        if resumed is None:
+            return None
+        if not resumed:
+            raise QueueFull(f"build queue is full ({self.max_queue} pending)")
+        self._wake()
+        return self.get(job_id)
+
+    def _wake(self):
+        if self._wakeup is not None:
+            event_loop.get_loop().call_soon_threadsafe(self._wakeup.set)
+
+    async def _dispatch(self):
+        # Created here so the event belongs to the shared loop
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        recovered = time.monotonic()
+        while True:
+            try:
+                if time.monotonic() - recovered > JOB_RECOVER_INTERVAL:
+                    recovered = time.monotonic()
+                    await loop.run_in_executor(None, self.store.recover)
+                for job_id in await loop.run_in_executor(None, self.store.cancel_requests, self.owner):
+                    future = self._futures.get(job_id)
+                    if future is not None:
+                        future.cancel()
+                while len(self._jobs) < self.max_workers:
+                    job = await loop.run_in_executor(None, self.store.claim, self.owner)
+                    if job is None:
+                        break
+                    # A resumed build continues after the events it already has
+                    job["events"] = await loop.run_in_executor(None, self.store.events, job["id"])
+                    self._start(job)
+            except Exception:
+                traceback.print_exc()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, job):
+        with self._lock:
+            self._jobs[job["id"]] = job
+            _persisted[job["id"]] = self.store
+            task = asyncio.ensure_future(self._run(job))
+            self._futures[job["id"]] = task
+
+    async def _run(self, job):
+        try:
+            emit_event(job, "started", worker=self.owner)
+            await self.runner(job["user_input"], job)
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+        except Exception as e:
+            job["status"] = "error"
+            job["error"] = str(e)
+            emit_event(job, "error", action="job", error=str(e), traceback=traceback.format_exc())
+        finally:
+            job["completed"] = True
+            job["finished_at"] = time.time()
+            emit_event(job, "end", status=job["status"])
+            # Readers fall back to the store once the job leaves _jobs, so its
+            # final state has to be written by then. Shielded: a repeated
+            # cancel request must not skip the bookkeeping below.
+            try:
+                await asyncio.shield(asyncio.get_running_loop().run_in_executor(None, self._finish, job))
+            except asyncio.CancelledError:
+                pass
+            with self._lock:
+                self._jobs.pop(job["id"], None)
+                self._futures.pop(job["id"], None)
+                _persisted.pop(job["id"], None)
+            metrics.builds.inc(status=job["status"])
+            metrics.build_iterations.observe(job["iteration"], status=job["status"])
+            self._wakeup.set()
+
+    def _finish(self, job):
+        _writer.flush()
+        if job["status"] == "completed":
+            # Only failed and cancelled builds can be resumed
+            self.store.delete_checkpoint(job["id"])
+
+    def get(self, job_id):
+        # Builds running in this process answer from memory (fields such as
+        # the iteration change between events); everything else comes from the store
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job_snapshot(job)
+        return self.store.get(job_id)
+
+    def list(self):
+        return self.store.list(self.history_size)
+
+    def get_events(self, job_id, cursor=0):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job["events"][max(0, cursor):]
+        if self.store.get(job_id) is None:
+            return None
+        return self.store.events(job_id, cursor)
+
+    def wait_events(self, job_id, cursor=0, timeout=15):
+        # Blocks until there are events at or after cursor, the job has
+        # finished, or the timeout expires. A finished job's last event is
+        # "end"; a resumed job has earlier "end" events followed by more. Local builds wake the waiter at once; builds running in
+        # other workers are polled.
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.get_events(job_id, cursor)
+            if events is None or events:
+                return events
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["finished_at"] is not None or remaining <= 0:
+                return events
+            with _events_changed:
+                _events_changed.wait(min(remaining, self.poll_interval))
+
+    def stats(self):
+        # Queue depth and running builds across all workers
+        counts = self.store.counts()
+        return {
+            "queued": counts.get("queued", 0),
+            "active": counts.get("running", 0),
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue
+        }
+
+    def cancel(self, job_id):
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None:
+            event_loop.get_loop().call_soon_threadsafe(future.cancel)
+            return True
+        if self.store.request_cancel(job_id):
+            self._wake()
+            return True
+        return False
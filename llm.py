@@ -0,0 +1,84 @@
+import time
+import asyncio
+
+import litellm
+from litellm import ModelResponse
+
+import metrics
+import tracing
+from llm_cache import CompletionCache, CacheMiss, completion_key
+from rate_limiter import RateLimitScheduler
+
+# Opt-in: only enabled when LLM_CACHE_PATH is set
+completion_cache = CompletionCache.from_env()
+rate_limiter = RateLimitScheduler()
+
+# Anything exposing acompletion() and supports_function_calling() the way
+# litellm does; swapped for a scripted stand-in by the offline benchmark
+backend = litellm
+
+
+def set_backend(new_backend):
+    global backend
+    backend = new_backend if new_backend is not None else litellm
+
+
+def supports_function_calling(model):
+    return backend.supports_function_calling(model)
+
+
+async def _request(model, messages, estimated_tokens, kwargs):
+    return await rate_limiter.call(
+        model, estimated_tokens,
+        lambda: backend.acompletion(model=model, messages=messages, **kwargs)
+    )
+
+
+async def complete(model, messages, estimated_tokens=0, **kwargs):
+    # Single entry point for every LLM call made by the builder
+    with tracing.span("llm_completion", model=model, estimated_tokens=estimated_tokens) as span:
+        return await _complete(model, messages, estimated_tokens, span, kwargs)
+
+
+async def _complete(model, messages, estimated_tokens, span, kwargs):
+    started = time.perf_counter()
+    cache = completion_cache
+    if cache is None:
+        response = await _request(model, messages, estimated_tokens, kwargs)
+        return _observe(model, "api", started, response, span)
+
+    loop = asyncio.get_running_loop()
+    key = completion_key(model, messages, **kwargs)
+    cached = await loop.run_in_executor(None, cache.get, key)
+    if cached is not None:
+        response = ModelResponse(**cached)
+        # Same flag litellm's own cache sets; callers leave these tokens out of their usage
+        response._hidden_params["cache_hit"] = True
+        return _observe(model, "cache", started, response, span)
+    if cache.offline:
+        raise CacheMiss(f"no cached completion for {model} (key {key[:12]})")
+
+    response = await _request(model, messages, estimated_tokens, kwargs)
+    if getattr(response, 'choices', None):
+        await loop.run_in_executor(None, cache.put, key, model, response)
+    return _observe(model, "api", started, response, span)
+
+
+def cache_hit(response):
+    # True for a completion answered from completion_cache
+    hidden = getattr(response, '_hidden_params', None) or {}
+    return bool(hidden.get("cache_hit"))
+
+
+def _observe(model, source, started, response, span):
+    metrics.llm_completion_seconds.observe(time.perf_counter() - started, model=model, source=source)
+    usage = getattr(response, 'usage', None)
+    prompt_tokens = (getattr(usage, 'prompt_tokens', 0) or 0) if usage else 0
+    completion_tokens = (getattr(usage, 'completion_tokens', 0) or 0) if usage else 0
+    # A cache hit costs no tokens; its latency is still observed, labelled source="cache"
+    if usage and source != "cache":
+        metrics.llm_tokens.inc(prompt_tokens, model=model, kind="prompt")
+        metrics.llm_tokens.inc(completion_tokens, model=model, kind="completion")
+    if span is not None:
+        span.set(source=source, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    return response
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', '')
+# readwrite: serve hits, store misses; readonly: serve hits, never store;
+# offline: serve hits and raise CacheMiss instead of calling the model
+LLM_CACHE_MODE = os.environ.get('LLM_CACHE_MODE', 'readwrite')
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', '10000'))
+LLM_CACHE_MAX_MB = float(os.environ.get('LLM_CACHE_MAX_MB', '256'))
+
+# Only these message fields affect the completion; provider extras are ignored
+MESSAGE_FIELDS = ("role", "content", "name", "tool_call_id", "tool_calls")
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def to_jsonable(obj):
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    if isinstance(obj, dict):
+        return {str(k): to_jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_jsonable(v) for v in obj]
+    if hasattr(obj, 'model_dump'):
+        return to_jsonable(obj.model_dump())
+    if hasattr(obj, '__dict__'):
+        return to_jsonable({k: v for k, v in vars(obj).items() if not k.startswith('_')})
+    return str(obj)
+
+
+def _message_fields(message):
+    message = to_jsonable(message)
+    if not isinstance(message, dict):
+        return message
+    fields = {k: message[k] for k in MESSAGE_FIELDS if message.get(k) is not None}
+    if fields.get("tool_calls"):
+        fields["tool_calls"] = [
+            {"id": call.get("id"), "type": call.get("type", "function"),
+             "function": {"name": call["function"].get("name"), "arguments": call["function"].get("arguments")}}
+            for call in fields["tool_calls"]
+        ]
+    return fields
+
+
+def completion_key(model, messages, tools=None, **params):
+    payload = {
+        "model": model,
+        "messages": [_message_fields(m) for m in messages],
+        "tools": to_jsonable(tools),
+        "params": to_jsonable(params)
+    }
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    # SQLite-backed completion cache with TTL expiry and LRU eviction by
+    # entry count and total size.
+
+    def __init__(self, path, mode=LLM_CACHE_MODE, ttl=LLM_CACHE_TTL,
+                 max_entries=LLM_CACHE_MAX_ENTRIES, max_bytes=int(LLM_CACHE_MAX_MB * 1024 * 1024)):
+        self.path = path
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            " key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER,"
+            " created_at REAL, last_access REAL, hits INTEGER DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+
+    @classmethod
+    def from_env(cls):
+        if not LLM_CACHE_PATH:
+            return None
+        return cls(LLM_CACHE_PATH)
+
+    @property
+    def offline(self):
+        return self.mode == 'offline'
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, created_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl and now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE completions SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, model, response):
+        if self.mode != 'readwrite':
+            return
+        data = json.dumps(to_jsonable(response), ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (key, model, response, size, created_at, last_access, hits)"
+                " VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (key, model, data, len(data), now, now)
+            )
+            self._evict(now)
+
+    def _evict(self, now):
+        if self.ttl:
+            self.evictions += self._db.execute(
+                "DELETE FROM completions WHERE created_at < ?", (now - self.ttl,)
+            ).rowcount
+        count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        while count > self.max_entries or size > self.max_bytes:
+            # Drop the least recently used tenth (at least one) per pass
+            batch = max(1, count // 10, count - self.max_entries)
+            self.evictions += self._db.execute(
+                "DELETE FROM completions WHERE key IN "
+                "(SELECT key FROM completions ORDER BY last_access LIMIT ?)", (batch,)
+            ).rowcount
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM completions")
+
+    def stats(self):
+        with self._lock:
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        return {
+            "path": self.path,
+            "mode": self.mode,
+            "entries": count,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+if __name__ == '__main__':
+    # python llm_cache.py stats|clear [path]
+    cache = CompletionCache(sys.argv[2] if len(sys.argv) > 2 else LLM_CACHE_PATH or 'llm_cache.sqlite3')
+    if sys.argv[1:2] == ['clear']:
+        cache.clear()
+    print(json.dumps(cache.stats(), indent=2))
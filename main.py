@@ -1,104 +1,259 @@
 import os
-import sys
 import json
-import importlib
+import time
+import asyncio
+import tempfile
 import traceback
-from flask import Flask, Blueprint, request, send_from_directory, render_template_string, jsonify
-from threading import Thread
-from time import sleep
-
-from litellm import completion, supports_function_calling
+import contextvars
+from functools import partial
+from flask import Flask, Response, request, render_template_string, jsonify
 from litellm import set_verbose
 
+import event_loop
+import metrics
+import tracing
+from jobs import JobEngine, QueueFull, new_job_state, emit_event, job_store
+from job_store import JobStore
+from build_log import BuildLog
+from llm import complete, supports_function_calling, cache_hit
+from compaction import ContextCompactor, CONTEXT_TOKEN_BUDGET
+from patching import PatchConflict, apply_unified_diff, apply_search_replace, content_hash
+from route_reloader import RouteReloader, RouteDispatcher
+from route_validation import RouteValidator
+from tool_scheduler import run_tool_calls
+from workspace import Workspace, current_workspace, resolve_path, expand_path
+from file_cache import FileCache
+from static_files import StaticIndex, StaticMiddleware
+from project_manifest import ProjectManifest
+from model_router import ModelRouter, FAST_MODEL
+import speculative
+import fanout
+import checkpoints
+import smoke_tests
+
 MODEL_NAME = os.environ.get('LITELLM_MODEL', 'gpt-4o-mini')
 
+# 单次调用模式：工具结果直接进入下一次带工具的补全，每次迭代只调用一次 LLM。
+# 设置 SINGLE_CALL_MODE=0 可恢复每次工具调用后额外请求一次无工具评论的旧行为。
+SINGLE_CALL_MODE = os.environ.get('SINGLE_CALL_MODE', '1') != '0'
+
 set_verbose = True
 
 app = Flask(__name__)
 
-LOG_FILE = "flask_app_builder_log.json"
-
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 生成文件所在的根目录；离线基准测试（bench.py）会将其指向临时目录
+BASE_DIR = os.environ.get('BUILDER_BASE_DIR') or os.path.dirname(os.path.abspath(__file__))
 TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
 ROUTES_DIR = os.path.join(BASE_DIR, 'routes')
 
-progress = {
-    "status": "idle",
-    "iteration": 0,
-    "max_iterations": 50,
-    "output": "",
-    "completed": False
-}
+MAX_ITERATIONS = 50
+
+# 任务状态、进度事件和结果保存在 SQLite（WAL 模式）中，多进程 WSGI 服务器的任一工作进程都能查询和领取
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH') or os.path.join(BASE_DIR, 'jobs.sqlite3')
+
+# 每轮修改文件后自动运行冒烟测试，并把结果加入 messages；设置 SMOKE_TEST_AUTO=0 可关闭
+SMOKE_TEST_AUTO = os.environ.get('SMOKE_TEST_AUTO', '1') != '0'
+FILE_WRITE_TOOLS = ("create_file", "update_file", "apply_patch")
+
+# 每个构建在自己的工作区（BASE_DIR/.workspaces 下，基础文件以硬链接引入）中写文件，
+# 完成时一次性原子提交并只重新加载一次路由；设置 BUILD_WORKSPACES=0 可恢复直接写入 BASE_DIR
+BUILD_WORKSPACES = os.environ.get('BUILD_WORKSPACES', '1') != '0'
 
 def create_directory(path):
-    if not os.path.exists(path):
-        os.makedirs(path)
-        if path == ROUTES_DIR:
+    # 工具路径经 resolve_path 映射：构建在独立工作区中运行时写入工作区，否则写入 BASE_DIR
+    try:
+        target = resolve_path(path)
+    except Exception as e:
+        return f"创建目录 {path} 时出错: {e}"
+    if not os.path.exists(target):
+        os.makedirs(target)
+        if os.path.abspath(target) == os.path.abspath(resolve_path(ROUTES_DIR)):
             create_file(os.path.join(ROUTES_DIR, '__init__.py'), '')
         return f"创建了目录: {path}"
     return f"目录已存在: {path}"
 
+# 生成文件的内容缓存：按 inode、mtime 和大小校验，写入时同步更新，fetch_code / fetch_files 读取时不必每次读盘
+file_cache = FileCache()
+# fetch_files 单次返回的最大字符数，超出的文件只列出路径。默认约为上下文 token 预算的六分之一
+# （按每个 token 约 3 个字符），最近的工具结果不会被压缩，单个结果不能占满预算
+FETCH_FILES_MAX_CHARS = int(os.environ.get('FETCH_FILES_MAX_CHARS', str(CONTEXT_TOKEN_BUDGET // 6 * 3)))
+
+def write_file(path, content):
+    # 内容哈希相同时跳过写入（文件的 mtime 也保持不变）；返回文件是否发生了变化
+    try:
+        if content_hash(file_cache.read(path)) == content_hash(content):
+            return False
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    # 先写临时文件再 rename 替换：工作区里的文件可能与 BASE_DIR 共用同一个 inode（硬链接），
+    # 原地写入会直接改到正在服务的文件
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=f'.{os.path.basename(path)}.',
+                                             suffix='.tmp')
+    with os.fdopen(descriptor, 'w') as f:
+        f.write(content)
+    os.chmod(temporary, mode)
+    os.replace(temporary, path)
+    file_cache.put(path, content)
+    return True
+
+route_validator = RouteValidator()
+ROUTE_VALIDATION_FAILED = "\n路由文件验证失败，请修复以下问题后再继续："
+
+def route_validation_note(path, target, content):
+    # 写入 routes/ 的 Python 文件立即做静态验证（语法、编译、Blueprint、路由和蓝图名冲突），
+    # 结构化错误附在工具结果中返回给模型
+    if not target.endswith('.py') or os.path.basename(target) == '__init__.py':
+        return ""
+    if os.path.dirname(os.path.abspath(target)) != os.path.abspath(resolve_path(ROUTES_DIR)):
+        return ""
+    try:
+        with tracing.span("route_validation", path=path):
+            errors = route_validator.validate(target, content)
+    except Exception as e:
+        errors = [{"type": "validation_failed", "message": str(e)}]
+    if not errors:
+        return ""
+    report = json.dumps({"file": path, "errors": errors}, ensure_ascii=False)
+    return f"{ROUTE_VALIDATION_FAILED}{report}"
+
 def create_file(path, content):
     try:
-        with open(path, 'x') as f:
-            f.write(content)
-        return f"创建了文件: {path}"
-    except FileExistsError:
-        with open(path, 'w') as f:
-            f.write(content)
-        return f"更新了文件: {path}"
+        target = resolve_path(path)
+        existed = os.path.exists(target)
+        if not write_file(target, content):
+            return f"文件内容未变化，未写入: {path}" + route_validation_note(path, target, content)
+        result = f"更新了文件: {path}" if existed else f"创建了文件: {path}"
+        return result + route_validation_note(path, target, content)
     except Exception as e:
         return f"创建/更新文件 {path} 时出错: {e}"
 
 def update_file(path, content):
     try:
-        with open(path, 'w') as f:
-            f.write(content)
-        return f"更新了文件: {path}"
+        target = resolve_path(path)
+        if not write_file(target, content):
+            return f"文件内容未变化，未写入: {path}" + route_validation_note(path, target, content)
+        return f"更新了文件: {path}" + route_validation_note(path, target, content)
     except Exception as e:
         return f"更新文件 {path} 时出错: {e}"
 
+def apply_patch(path, patch=None, edits=None):
+    try:
+        target = resolve_path(path)
+        original = file_cache.read(target)
+    except Exception as e:
+        return f"读取文件 {path} 时出错: {e}"
+    try:
+        if edits:
+            content = apply_search_replace(original, edits)
+        elif patch:
+            content = apply_unified_diff(original, patch)
+        else:
+            return f"补丁未应用到 {path}：需要提供 patch（统一 diff）或 edits（查找/替换列表）。"
+    except PatchConflict as e:
+        return f"补丁与 {path} 的当前内容冲突，未做任何修改：{e}"
+    try:
+        if not write_file(target, content):
+            return f"补丁应用后内容未变化，未写入: {path}"
+        return f"已将补丁应用到文件: {path}" + route_validation_note(path, target, content)
+    except Exception as e:
+        return f"写入文件 {path} 时出错: {e}"
+
 def fetch_code(file_path):
     try:
-        with open(file_path, 'r') as f:
-            code = f.read()
-        return code
+        return file_cache.read(resolve_path(file_path))
     except Exception as e:
         return f"从 {file_path} 获取代码时出错: {e}"
 
+def fetch_files(paths):
+    # 一次返回多个文件，路径可以是 glob（如 routes/*.py、templates/**/*.html），省去逐个 fetch_code 的往返
+    if isinstance(paths, str):
+        paths = [paths]
+    sections = []
+    seen = set()
+    total = 0
+    for pattern in paths:
+        try:
+            matches = expand_path(str(pattern))
+        except Exception as e:
+            sections.append(f"=== {pattern} ===\n获取文件时出错: {e}")
+            continue
+        if not matches:
+            sections.append(f"=== {pattern} ===\n没有匹配的文件。")
+            continue
+        for path, target in matches:
+            if target in seen:
+                continue
+            seen.add(target)
+            if total >= FETCH_FILES_MAX_CHARS:
+                sections.append(f"=== {path} ===\n已省略：本次返回的内容已达到 {FETCH_FILES_MAX_CHARS} 个字符的上限，请另行获取。")
+                continue
+            try:
+                content = file_cache.read(target)
+            except Exception as e:
+                sections.append(f"=== {path} ===\n获取代码时出错: {e}")
+                continue
+            if total + len(content) > FETCH_FILES_MAX_CHARS:
+                sections.append(f"=== {path} ===\n已省略：加入该文件（{len(content)} 个字符）会超过本次 {FETCH_FILES_MAX_CHARS} 个字符的上限，请单独获取。")
+                continue
+            total += len(content)
+            sections.append(f"=== {path} ===\n{content}")
+    return "\n\n".join(sections)
+
+# static/ 和 templates/index.html 的内存索引：内容、强 ETag 和预压缩的 gzip/brotli 版本，
+# 加载时建立，构建提交时增量刷新；请求不再访问文件系统
+static_index = StaticIndex(BASE_DIR)
+
+# 生成的路由加载到单独的 Flask 应用中：只重新加载内容哈希发生变化的模块，
+# 新应用构建完成后原子替换，构建器自身的路由优先
+route_reloader = RouteReloader(ROUTES_DIR, app_kwargs={
+    "root_path": BASE_DIR,
+    "template_folder": TEMPLATES_DIR,
+    "static_folder": STATIC_DIR
+}, setup=static_index.add_url_defaults)
+app.wsgi_app = StaticMiddleware(static_index, RouteDispatcher(app, app.wsgi_app, route_reloader))
+
 def load_routes():
     try:
-        if BASE_DIR not in sys.path:
-            sys.path.append(BASE_DIR)
-        for filename in os.listdir(ROUTES_DIR):
-            if filename.endswith('.py') and filename != '__init__.py':
-                module_name = filename[:-3]
-                module_path = f'routes.{module_name}'
-                try:
-                    if module_path in sys.modules:
-                        importlib.reload(sys.modules[module_path])
-                    else:
-                        importlib.import_module(module_path)
-                    module = sys.modules.get(module_path)
-                    if module:
-                        # Find all blueprint objects in the module
-                        for attr_name in dir(module):
-                            attr = getattr(module, attr_name)
-                            if isinstance(attr, Blueprint):
-                                app.register_blueprint(attr)
-                except Exception as e:
-                    print(f"导入模块 {module_path} 时出错: {e}")
-                    continue
+        result = route_reloader.reload()
+        for module_name, error in result["errors"].items():
+            print(f"导入模块 routes.{module_name} 时出错: {error}")
         print("路由加载成功。")
         return "路由加载成功。"
     except Exception as e:
         print(f"加载路由时出错: {e}")
         return f"加载路由时出错: {e}"
 
+def format_smoke_report(summary, verbose=True):
+    # 失败项完整列出；verbose 时通过的请求每个一行
+    lines = [f"冒烟测试：{summary['passed']} 个通过，{summary['failed']} 个失败。"]
+    for module, error in sorted(summary["load_errors"].items()):
+        lines.append(f"加载失败 {module}: {error}")
+    for result in summary["results"]:
+        if smoke_tests.failed(result):
+            outcome = result.get("error") or f"HTTP {result['status']}"
+            lines.append(f"失败 {result['method']} {result['url']} -> {outcome}")
+        elif verbose:
+            lines.append(f"通过 {result['method']} {result['url']} -> HTTP {result['status']}")
+    return "\n".join(lines)
+
+def smoke_test_summary():
+    # 用当前（或工作区中的）routes/ 和 templates/ 构建一次性应用，在工作进程中用 Flask 测试客户端请求每个 URL 规则
+    root = os.path.dirname(resolve_path(ROUTES_DIR))
+    with tracing.span("smoke_tests") as span:
+        summary = smoke_tests.run_smoke_tests(root)
+        if span is not None:
+            span.set(passed=summary["passed"], failed=summary["failed"])
+    return summary
+
+def run_smoke_tests():
+    try:
+        return format_smoke_report(smoke_test_summary())
+    except Exception as e:
+        return f"运行冒烟测试时出错: {e}"
+
 def task_completed():
-    progress["status"] = "completed"
-    progress["completed"] = True
     return "任务已标记为完成。"
 
 create_directory(TEMPLATES_DIR)
@@ -106,46 +261,101 @@ create_directory(STATIC_DIR)
 create_directory(ROUTES_DIR) 
 
 load_routes()
+static_index.refresh()
 
-def log_to_file(history_dict):
-    try:
-        with open(LOG_FILE, 'w') as log_file:
-            json.dump(history_dict, log_file, indent=4)
-    except Exception as e:
-        pass 
+# 进度页面：通过 SSE 只接收新事件；浏览器不支持或连接断开时，用同一游标轮询
+PROGRESS_PAGE = '''
+    <h1>进度</h1>
+    <pre id="progress"></pre>
+    <script>
+        var jobId = '{{ job_id }}';
+        var cursor = 0;
+        var finished = false;
+        var progressEl = document.getElementById('progress');
+
+        function esc(text) {
+            var div = document.createElement('div');
+            div.textContent = text == null ? '' : String(text);
+            return div.innerHTML;
+        }
+
+        function render(event) {
+            switch (event.type) {
+                case 'iteration': return '\\n<h2>迭代 ' + event.iteration + '：</h2>\\n';
+                case 'tool_calls': return '<strong>工具调用：</strong>\\n<p>' + esc(event.content) + '</p>\\n';
+                case 'tool_result': return '<strong>工具结果 (' + esc(event.tool) + ')：</strong>\\n<p>' + esc(event.result) + '</p>\\n';
+                case 'llm_response': return '<strong>LLM 响应：</strong>\\n<p>' + esc(event.content) + '</p>\\n';
+                case 'error': return '<strong>错误 (' + esc(event.action) + ')：</strong>\\n<p>' + esc(event.error) + '</p>\\n';
+                case 'resumed': return '\\n<h2>从第 ' + event.iteration + ' 轮之后的检查点继续</h2>\\n';
+                case 'completed': return '\\n<h2>完成</h2>\\n';
+                default: return '';
+            }
+        }
+
+        function handle(event) {
+            if (event.seq < cursor) {
+                return;
+            }
+            cursor = event.seq + 1;
+            progressEl.insertAdjacentHTML('beforeend', render(event));
+            if (event.type === 'end') {
+                finished = true;
+                document.getElementById('refresh-btn').style.display = 'block';
+            } else if (event.type === 'resume_requested' || event.type === 'resumed') {
+                // 继续构建时之前的 end 事件不再是最后一个
+                finished = false;
+                document.getElementById('refresh-btn').style.display = 'none';
+            }
+        }
+
+        function poll() {
+            if (finished) {
+                return;
+            }
+            fetch('/jobs/' + jobId + '?cursor=' + cursor)
+            .then(response => response.json())
+            .then(data => {
+                data.events.forEach(handle);
+                if (data.finished_at == null) {
+                    finished = false;
+                }
+                setTimeout(poll, 2000);
+            })
+            .catch(() => setTimeout(poll, 2000));
+        }
+
+        if (window.EventSource) {
+            var source = new EventSource('/jobs/' + jobId + '/events?cursor=0');
+            // 服务器在构建真正结束后关闭事件流（触发 onerror），不在收到 end 时自行关闭
+            source.onmessage = function(message) {
+                handle(JSON.parse(message.data));
+            };
+            source.onerror = function() {
+                source.close();
+                poll();
+            };
+        } else {
+            poll();
+        }
+    </script>
+    <button id="refresh-btn" style="display:none;" onclick="location.reload();">刷新页面</button>
+'''
 
 # Default route to serve generated index.html or render a form
 @app.route('/', methods=['GET', 'POST'])
 def home():
-    index_file = os.path.join(TEMPLATES_DIR, 'index.html')
-    if os.path.exists(index_file):
-        return send_from_directory(TEMPLATES_DIR, 'index.html')
+    static_index.check()
+    response = static_index.response(request.environ, 'templates/index.html')
+    if response is not None:
+        return response
     else:
         if request.method == 'POST':
             user_input = request.form.get('user_input')
-            progress["status"] = "running"
-            progress["iteration"] = 0
-            progress["output"] = ""
-            progress["completed"] = False
-            thread = Thread(target=run_main_loop, args=(user_input,))
-            thread.start()
-            return render_template_string('''
-                <h1>进度</h1>
-                <pre id="progress">{{ progress_output }}</pre>
-                <script>
-                    setInterval(function() {
-                        fetch('/progress')
-                        .then(response => response.json())
-                        .then(data => {
-                            document.getElementById('progress').innerHTML = data.output;
-                            if (data.completed) {
-                                document.getElementById('refresh-btn').style.display = 'block';
-                            }
-                        });
-                    }, 2000);
-                </script>
-                <button id="refresh-btn" style="display:none;" onclick="location.reload();">刷新页面</button>
-            ''', progress_output=progress["output"])
+            try:
+                job = build_engine.submit(user_input)
+            except QueueFull:
+                return "构建队列已满，请稍后重试。", 503
+            return render_template_string(PROGRESS_PAGE, job_id=job["id"])
         else:
             return render_template_string('''
                 <h1>Flask 应用构建器</h1>
@@ -156,15 +366,109 @@ def home():
                 </form>
             ''')
 
-@app.route('/progress')
-def get_progress():
-    return jsonify(progress)
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.get_json(silent=True) or request.form
+    user_input = data.get('user_input')
+    if not user_input:
+        return jsonify({"error": "缺少 user_input。"}), 400
+    try:
+        job = build_engine.submit(user_input)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"id": job["id"], "status": job["status"]}), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = build_engine.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在。"}), 404
+    # 轮询回退：只返回游标之后的新事件
+    cursor = request.args.get('cursor', 0, type=int)
+    events = build_engine.get_events(job_id, cursor) or []
+    job["events"] = events
+    job["cursor"] = events[-1]["seq"] + 1 if events else max(cursor, 0)
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events')
+def stream_job_events(job_id):
+    if build_engine.get(job_id) is None:
+        return jsonify({"error": "任务不存在。"}), 404
+    # SSE 的 id 是下一个游标，断线重连时浏览器会通过 Last-Event-ID 带回
+    cursor = request.args.get('cursor', type=int)
+    if cursor is None:
+        cursor = int(request.headers.get('Last-Event-ID', 0) or 0)
+
+    def generate(cursor):
+        while True:
+            events = build_engine.wait_events(job_id, cursor)
+            if events is None:
+                return
+            for event in events:
+                cursor = event["seq"] + 1
+                yield f"id: {cursor}\ndata: {json.dumps(event)}\n\n"
+            # 继续构建的任务在之前的 end 事件之后还有事件：只有最后一个 end 且任务已结束时才关闭
+            if events and events[-1]["type"] == "end":
+                job = build_engine.get(job_id)
+                if job is None or job["finished_at"] is not None:
+                    return
+            if not events:
+                job = build_engine.get(job_id)
+                if job is None or job["finished_at"] is not None:
+                    return
+                yield ": keep-alive\n\n"
+
+    return Response(generate(cursor), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    # 排队中的任务立即取消；运行中的任务由运行它的工作进程取消（可能在另一个进程中，最多延迟 JOB_POLL_INTERVAL 秒）
+    if build_engine.get(job_id) is None:
+        return jsonify({"error": "任务不存在。"}), 404
+    if not build_engine.cancel(job_id):
+        return jsonify({"error": "只有排队中或运行中的任务可以取消。"}), 409
+    return jsonify({"id": job_id, "cancel_requested": True}), 202
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    # 失败或被取消（包括工作进程退出）的构建从最后一个检查点继续，而不是从头开始
+    if build_engine.get(job_id) is None:
+        return jsonify({"error": "任务不存在。"}), 404
+    try:
+        job = build_engine.resume(job_id)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    if job is None:
+        return jsonify({"error": "只有失败或已取消、并且保存了检查点的任务可以继续。"}), 409
+    return jsonify({"id": job["id"], "status": job["status"]}), 202
+
+@app.route('/jobs/<job_id>/trace')
+def get_job_trace(job_id):
+    # Chrome trace-event JSON，可在 chrome://tracing 或 https://ui.perfetto.dev 中打开
+    trace = tracing.get_trace(job_id)
+    if trace is None:
+        return jsonify({"error": "任务不存在或追踪已过期。"}), 404
+    response = jsonify(trace.to_chrome())
+    if request.args.get('download'):
+        response.headers['Content-Disposition'] = f'attachment; filename="trace-{job_id}.json"'
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Prometheus 文本格式：LLM 延迟与 token、工具调用延迟、构建迭代次数、队列、错误和路由重载耗时
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 available_functions = {
     "create_directory": create_directory,
     "create_file": create_file,
     "update_file": update_file,
+    "apply_patch": apply_patch,
     "fetch_code": fetch_code,
+    "fetch_files": fetch_files,
+    "run_smoke_tests": run_smoke_tests,
     "task_completed": task_completed
 }
 
@@ -228,6 +532,45 @@ tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "apply_patch",
+            "description": "对现有文件应用小范围修改，无需重新输出整个文件。提供统一 diff（patch）或查找/替换列表（edits）之一；如果与文件当前内容冲突，文件保持不变并返回冲突说明。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "path": {
+                        "type": "string",
+                        "description": "要修改的文件路径。"
+                    },
+                    "patch": {
+                        "type": "string",
+                        "description": "统一 diff 格式的补丁，包含以 '@@ -起始行,行数 +起始行,行数 @@' 开头的块。"
+                    },
+                    "edits": {
+                        "type": "array",
+                        "description": "按顺序应用的查找/替换编辑；每个 search 必须在文件中恰好出现一次。",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "search": {
+                                    "type": "string",
+                                    "description": "要查找的原文（逐字匹配）。"
+                                },
+                                "replace": {
+                                    "type": "string",
+                                    "description": "替换后的文本。"
+                                }
+                            },
+                            "required": ["search", "replace"]
+                        }
+                    }
+                },
+                "required": ["path"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -245,6 +588,36 @@ tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "fetch_files",
+            "description": "一次获取多个文件的内容。路径可以是 glob 模式，例如 routes/*.py 或 templates/**/*.html。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "paths": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "要获取的文件路径或 glob 模式列表。"
+                    }
+                },
+                "required": ["paths"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "run_smoke_tests",
+            "description": "用 Flask 测试客户端请求当前应用的每个 URL 规则，返回状态码、异常和超时；500 错误、异常和超时视为失败。",
+            "parameters": {
+                "type": "object",
+                "properties": {},
+                "required": []
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -259,20 +632,148 @@ tools = [
     }
 ]
 
-def run_main_loop(user_input):
-    # 每次运行时重置 history_dict
-    history_dict = {
-        "iterations": []
+# 先规划后并行生成（PLAN_FANOUT=1）时，第一次补全只能调用这个工具
+plan_tool = {
+    "type": "function",
+    "function": {
+        "name": "submit_plan",
+        "description": "提交应用的实现计划：需要的所有文件及其用途，以及文件之间共享的接口。",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "files": {
+                    "type": "array",
+                    "description": "需要编写的所有文件。",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "path": {"type": "string", "description": "templates/、static/ 或 routes/ 下的文件路径。"},
+                            "purpose": {"type": "string", "description": "文件的用途和内容要点。"},
+                            "interfaces": {
+                                "type": "string",
+                                "description": "该文件定义或依赖的共享接口：蓝图名、URL、模板变量、表单字段、CSS 类名、JS 函数等。"
+                            }
+                        },
+                        "required": ["path", "purpose"]
+                    }
+                },
+                "routes": {
+                    "type": "array",
+                    "description": "应用的所有 URL 规则。",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "methods": {"type": "array", "items": {"type": "string"}},
+                            "url": {"type": "string"},
+                            "blueprint": {"type": "string"},
+                            "endpoint": {"type": "string"},
+                            "module": {"type": "string", "description": "定义该路由的 routes/ 文件。"},
+                            "template": {"type": "string", "description": "渲染的模板（如有）。"}
+                        },
+                        "required": ["url"]
+                    }
+                },
+                "notes": {"type": "string", "description": "所有文件共同遵守的约定。"}
+            },
+            "required": ["files"]
+        }
     }
+}
 
-    if not supports_function_calling(MODEL_NAME):
-        progress["status"] = "error"
-        progress["output"] = "模型不支持函数调用。"
-        progress["completed"] = True
-        return "模型不支持函数调用。"
+async def run_in_thread(func, *args, **kwargs):
+    # 文件读写等阻塞操作放到线程池中执行，避免阻塞共享事件循环
+    # 复制当前上下文，线程中打开的 span 会挂在当前 span 之下
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, partial(context.run, func, *args, **kwargs))
 
-    max_iterations = progress["max_iterations"]  # 防止无限循环
-    iteration = 0
+async def flush_build_log(build_log):
+    with tracing.span("log_flush"):
+        await run_in_thread(build_log.flush)
+
+def parse_tool_call(tool_call):
+    function_name = tool_call.function.name
+    try:
+        return function_name, json.loads(tool_call.function.arguments), None
+    except Exception as e:
+        return function_name, None, e
+
+def execute_tool_call(function_name, function_args, parse_error):
+    # 在工具线程池中运行；返回 (结果, 错误)
+    function_to_call = available_functions.get(function_name)
+
+    if not function_to_call:
+        error_message = f"工具 '{function_name}' 不可用。"
+        return None, {
+            'action': f'tool_call_{function_name}',
+            'error': error_message,
+            'traceback': '没有可用的追溯信息。'
+        }
+
+    started = time.perf_counter()
+    try:
+        if parse_error:
+            raise parse_error
+        return function_to_call(**function_args), None
+    except Exception as tool_error:
+        error_message = f"执行 {function_name} 时出错：{tool_error}"
+        return None, {
+            'action': f'tool_call_{function_name}',
+            'error': error_message,
+            'traceback': traceback.format_exc()
+        }
+    finally:
+        metrics.tool_call_seconds.observe(time.perf_counter() - started, tool=function_name)
+
+def traced_tool_call(function_name, function_args, parse_error):
+    with tracing.span("tool_call", tool=function_name) as span:
+        function_response, error = execute_tool_call(function_name, function_args, parse_error)
+        if span is not None and error:
+            span.set(error=error['error'])
+        return function_response, error
+
+def record_usage(job, response):
+    # 记录每个任务的 LLM 调用次数和 token 用量；缓存命中的补全不消耗 token，不计入用量
+    job["llm_calls"] = job.get("llm_calls", 0) + 1
+    usage = getattr(response, 'usage', None)
+    if usage and not cache_hit(response):
+        job["prompt_tokens"] = job.get("prompt_tokens", 0) + (getattr(usage, 'prompt_tokens', 0) or 0)
+        job["completion_tokens"] = job.get("completion_tokens", 0) + (getattr(usage, 'completion_tokens', 0) or 0)
+
+async def run_main_loop_async(user_input, job=None):
+    # 每个构建使用自己的任务状态，互不覆盖
+    if job is None:
+        job = new_job_state(user_input=user_input, max_iterations=MAX_ITERATIONS)
+
+    # 每个构建记录自己的 span 追踪（构建 → 迭代 → 补全 / 工具调用 / 日志写入 / 等待），
+    # 可通过 /jobs/<id>/trace 下载
+    with tracing.start_trace(job["id"], "build", model=MODEL_NAME) as root:
+        # 推测式构建的候选已在编排器创建的工作区中运行，不再另建
+        workspace = token = None
+        if BUILD_WORKSPACES and current_workspace.get() is None:
+            workspace = await run_in_thread(Workspace.create, BASE_DIR, job["id"])
+            token = current_workspace.set(workspace)
+        try:
+            return await _run_build(user_input, job, workspace)
+        finally:
+            root.set(status=job["status"], iterations=job["iteration"], llm_calls=job["llm_calls"])
+            if workspace is not None:
+                current_workspace.reset(token)
+                await run_in_thread(workspace.remove)
+
+async def _run_build(user_input, job, workspace=None):
+    # 每个构建写入自己的追加式 JSONL 日志，每个动作一条记录
+    build_log = BuildLog.for_job(job["id"])
+    job["log_file"] = build_log.path
+    build_log.append("build", user_input=user_input, model=MODEL_NAME, fast_model=FAST_MODEL)
+
+    if not all(supports_function_calling(model) for model in ModelRouter(MODEL_NAME).models):
+        job["status"] = "error"
+        emit_event(job, "error", action="llm_completion", error="模型不支持函数调用。")
+        build_log.append("error", action="llm_completion", error="模型不支持函数调用。")
+        await flush_build_log(build_log)
+        job["completed"] = True
+        return job["events"]
 
     # 使用增强提示更新消息数组
     messages = [
@@ -285,7 +786,7 @@ def run_main_loop(user_input):
                 "1. **理解需求**：分析用户的输入，充分理解应用程序的功能和特性。\n"
                 "2. **规划应用程序结构**：列出需要创建的所有路由、模板和静态文件，并考虑它们之间如何交互。\n"
                 "3. **逐步实现**：对于每个组件，使用提供的工具来创建目录、文件并编写代码。在进入下一步之前确保每一步都彻底完成。\n"
-                "4. **审查和优化**：使用 `fetch_code` 查看你编写的代码。如果有必要，可以使用 `update_file` 更新文件。\n"
+                "4. **审查和优化**：使用 `fetch_files`（一次获取多个文件）或 `fetch_code` 查看你编写的代码。如果有必要，可以使用 `update_file` 更新文件。\n"
                 "5. **确保完整性**：不要留任何占位符或不完整的代码。所有功能、路由和模板必须完全实现，并可用于生产环境。\n"
                 "6. **不要修改 `main.py`**：仅关注 `templates/`、`static/` 和 `routes/` 目录中的文件。\n"
                 "7. **最终确定**：一旦所有内容都完成并经过彻底测试，调用 `task_completed()` 完成任务。\n\n"
@@ -301,140 +802,427 @@ def run_main_loop(user_input):
                 "- `create_directory(path)`：创建一个新目录。\n"
                 "- `create_file(path, content)`：使用内容创建或覆盖一个文件。\n"
                 "- `update_file(path, content)`：使用新内容更新现有文件。\n"
+                "- `apply_patch(path, patch 或 edits)`：对现有文件做小范围修改（统一 diff 或查找/替换），小改动优先使用它而不是重写整个文件。\n"
                 "- `fetch_code(file_path)`：从文件中获取代码进行查看。\n"
+                "- `fetch_files(paths)`：一次获取多个文件（支持 glob，如 `routes/*.py`），需要查看多个文件时优先使用它。\n"
+                "- `run_smoke_tests()`：请求应用的每个路由并报告状态码和异常，用它来测试应用。\n"
                 "- `task_completed()`：当应用程序完全构建并准备好时调用此工具完成任务。\n\n"
                 "请在每一步中仔细思考，确保应用程序完整、功能正常，并满足用户需求。"
             )
         },
-        {"role": "user", "content": user_input},
-        {"role": "system", "content": f"历史记录：\n{json.dumps(history_dict, indent=2)}"}
+        {"role": "user", "content": user_input}
     ]
 
-    output = ""
+    # 继续中断的构建时，对话和工作区中改动的文件从检查点恢复，已完成的迭代不再重复
+    store = job_store(job)
+    checkpoint = await run_in_thread(store.checkpoint, job["id"]) if store is not None else None
 
-    while iteration < max_iterations:
-        progress["iteration"] = iteration + 1
-        current_iteration = {
-            "iteration": iteration + 1,  # 从1开始
-            "actions": [],
-            "llm_responses": [],
-            "tool_results": [],
-            "errors": []
-        }
-        history_dict['iterations'].append(current_iteration)
+    try:
+        if checkpoint is not None:
+            messages = await resume_from_checkpoint(job, checkpoint, workspace, build_log)
+        elif fanout.PLAN_FANOUT:
+            await plan_and_generate(job, messages, build_log)
+            await checkpoint_build(job, messages, build_log)
+        # 返回 True 表示模型调用了 task_completed；用完迭代次数的构建同样提交并标记为完成。
+        # 状态和 completed 事件只在工作区提交成功之后设置，提交失败时构建为 error
+        task_completed = await _run_iterations(job, messages, build_log, checkpoint)
+        if workspace is not None and not await commit_workspace(job, workspace, build_log):
+            return job["events"]
+        job["status"] = "completed"
+        job["completed"] = True
+        if task_completed:
+            emit_event(job, "completed")
+        return job["events"]
+    finally:
+        await flush_build_log(build_log)
+
+async def checkpoint_build(job, messages, build_log, iteration=0, router=None, outcome=None, manifest_note=None):
+    # 每轮结束后保存检查点：对话、模型级联状态、上一轮结果和工作区中改动的文件。
+    # 只保存由任务引擎运行的构建（其状态在 SQLite 中）；失败不影响构建本身
+    store = job_store(job)
+    if store is None or not checkpoints.BUILD_CHECKPOINTS:
+        return
+    workspace = current_workspace.get()
+    data = {
+        "iteration": iteration,
+        "messages": [checkpoints.serialize_message(message) for message in messages],
+        "router": router.state() if router is not None else None,
+        "outcome": outcome,
+        "manifest": manifest_note["content"] if manifest_note is not None else None
+    }
+
+    def save():
+        data["files"] = checkpoints.changed_files(workspace, file_cache.read) if workspace is not None else {}
+        return store.save_checkpoint(job["id"], iteration, data)
+
+    with tracing.span("checkpoint", iteration=iteration) as span:
+        try:
+            size = await run_in_thread(save)
+        except Exception as e:
+            build_log.append("error", iteration=iteration, action="checkpoint", error=str(e))
+            return
+        if span is not None:
+            span.set(bytes=size, files=len(data["files"]))
+    build_log.append("checkpoint", iteration=iteration, bytes=size, files=len(data["files"]))
+
+async def resume_from_checkpoint(job, checkpoint, workspace, build_log):
+    # 不使用工作区时文件直接写在基础目录中，无需恢复
+    files = []
+    if workspace is not None and checkpoint.get("files"):
+        files = await run_in_thread(checkpoints.restore_files, workspace, checkpoint["files"])
+    build_log.append("resume", iteration=checkpoint["iteration"], files=files, messages=len(checkpoint["messages"]))
+    emit_event(job, "resumed", iteration=checkpoint["iteration"], files=files)
+    return checkpoint["messages"]
+
+async def commit_workspace(job, workspace, build_log):
+    # 变更的文件先在目标目录中暂存，再整批 rename 替换，读者不会看到写了一半的文件；
+    # 之后只重新加载一次路由，而不是每轮工具调用后都重新加载。提交失败（包括冲突）时返回 False
+    with tracing.span("workspace_commit") as span:
+        try:
+            files = await run_in_thread(workspace.commit)
+        except Exception as e:
+            job["status"] = "error"
+            emit_event(job, "error", action="workspace_commit", error=str(e))
+            build_log.append("error", action="workspace_commit", error=str(e))
+            return False
+        if span is not None:
+            span.set(files=len(files))
+    build_log.append("workspace_commit", iteration=job["iteration"], files=files)
+    emit_event(job, "committed", files=files)
+    if files:
+        await reload_generated_routes(build_log, job["iteration"])
+    return True
 
+async def reload_generated_routes(build_log, iteration):
+    # 路由索引只重新加载内容发生变化的模块；没有变化时只需几次 stat
+    started = time.perf_counter()
+    with tracing.span("route_reload") as span:
+        result = await run_in_thread(route_reloader.reload)
+        if span is not None:
+            span.set(swapped=result["swapped"], reloaded=len(result["reloaded"]))
+    metrics.route_reload_seconds.observe(time.perf_counter() - started, swapped=str(result["swapped"]).lower())
+    if result["swapped"]:
+        build_log.append("route_reload", iteration=iteration, reloaded=result["reloaded"],
+                         removed=result["removed"], errors=result["errors"])
+    # 静态文件索引同时刷新，变化的文件在这里压缩，而不是在请求时
+    with tracing.span("static_index") as span:
+        changed = await run_in_thread(static_index.refresh)
+        if span is not None:
+            span.set(changed=len(changed))
+    if changed:
+        build_log.append("static_index", iteration=iteration, files=changed)
+    return result
+
+def route_load_note(function_name, function_args, reload_result):
+    # 写入的路由模块导入或注册失败时，把错误附在对应的工具结果中，而不是只打印到控制台
+    if function_name not in ("create_file", "update_file", "apply_patch") or not isinstance(function_args, dict):
+        return ""
+    path = os.path.normpath(str(function_args.get("path", "")))
+    filename = os.path.basename(path)
+    if not filename.endswith('.py') or os.path.basename(os.path.dirname(path)) != 'routes':
+        return ""
+    error = reload_result["errors"].get(filename[:-3])
+    return f"\n路由模块 routes/{filename} 加载失败：{error}" if error else ""
+
+async def auto_smoke_test(job, messages, build_log, iteration):
+    # 本轮修改了文件时自动运行冒烟测试，结果（失败项完整列出）加入 messages，下一次补全即可看到
+    try:
+        summary = await run_in_thread(smoke_test_summary)
+    except Exception as e:
+        build_log.append("error", iteration=iteration, action="smoke_tests", error=str(e))
+        return
+    build_log.append("smoke_tests", iteration=iteration, passed=summary["passed"], failed=summary["failed"],
+                     load_errors=summary["load_errors"])
+    emit_event(job, "smoke_tests", passed=summary["passed"], failed=summary["failed"])
+    messages.append({"role": "system", "content": f"自动冒烟测试（本轮修改文件之后）：\n{format_smoke_report(summary, verbose=False)}"})
+    return summary
+
+def compact_context(compactor, messages, build_log, iteration):
+    # 超出 token 预算时，用简短占位替换过期的工具结果；前缀消息保持不变
+    with tracing.span("compaction") as span:
+        before, after = compactor.compact(messages)
+        if span is not None:
+            span.set(tokens_before=before, tokens_after=after)
+    if after < before:
+        build_log.append("compaction", iteration=iteration, tokens_before=before, tokens_after=after)
+    return after
+
+async def project_manifest_message(manifest, previous):
+    # 项目清单（文件树、大小、内容哈希、蓝图和 URL 规则、模板引用）每次补全前增量刷新，
+    # 只重新分析发生变化的文件；内容没变时沿用上一次的消息对象
+    with tracing.span("project_manifest"):
+        text = await run_in_thread(manifest.render)
+    content = f"当前项目文件清单（每轮自动更新；路径  大小  内容哈希  蓝图/路由/模板引用）：\n{text}"
+    if previous is not None and previous["content"] == content:
+        return previous
+    return {"role": "system", "content": content}
+
+def write_planned_file(path, content):
+    target = resolve_path(path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    return create_file(path, content)
+
+async def plan_and_generate(job, messages, build_log):
+    # 第一次补全返回结构化计划，之后每个文件由独立的补全并发生成（相同的前缀：系统提示、需求和计划），
+    # 结果写入 messages，随后的迭代循环负责集成和审查。计划无效时返回 False，按普通模式继续
+    with tracing.span("plan") as span:
         try:
-            response = completion(
+            response = await complete(
                 model=MODEL_NAME,
-                messages=messages,
-                tools=tools,
-                tool_choice="auto"
+                messages=messages + [{"role": "system", "content": "先不要编写任何文件：调用 submit_plan 提交完整的实现计划，列出所有文件及其用途，以及它们之间共享的接口（蓝图名、URL、模板、静态文件、表单字段等）。"}],
+                tools=[plan_tool],
+                tool_choice={"type": "function", "function": {"name": "submit_plan"}}
             )
+            record_usage(job, response)
+            tool_calls = response.choices[0].message.tool_calls or []
+            plan = fanout.parse_plan(tool_calls[0].function.arguments if tool_calls else None)
+        except Exception as e:
+            build_log.append("error", action="plan", error=str(e))
+            emit_event(job, "error", action="plan", error=str(e))
+            return False
+        if span is not None:
+            span.set(files=len(plan["files"]))
+    build_log.append("plan", files=plan["files"], routes=plan["routes"], notes=plan["notes"], rejected=plan["rejected"])
+    emit_event(job, "plan", files=[file["path"] for file in plan["files"]])
+    plan_text = json.dumps(plan, ensure_ascii=False, indent=2)
+    prefix = [
+        {"role": "system", "content": "你是一名专家级Flask开发人员，正在按照给定的计划实现一个Flask应用中的单个文件。"
+                                      "严格遵守计划中的文件路径、蓝图名、URL、模板名和其他共享接口，这样各个文件才能组合在一起。"
+                                      "路由文件必须定义模块级的 Blueprint。不要留任何占位符。"},
+        {"role": "user", "content": messages[1]["content"]},
+        {"role": "system", "content": f"实现计划：\n{plan_text}"}
+    ]
 
-            if not response.choices[0].message:
-                error = response.get('error', '未知错误')
-                current_iteration['errors'].append({'action': 'llm_completion', 'error': error})
-                log_to_file(history_dict)
-                sleep(5)
-                iteration += 1
-                continue
+    async def generate(file):
+        with tracing.span("generate_file", path=file["path"]):
+            response = await complete(
+                model=FAST_MODEL or MODEL_NAME,
+                messages=prefix + [{"role": "user", "content": f"请编写 {file['path']}（{file['purpose']}）。只输出该文件的完整内容，不要解释，也不要使用 Markdown 代码块。"}]
+            )
+            record_usage(job, response)
+            content = fanout.strip_code_fence(response.choices[0].message.content or "")
+            return await run_in_thread(write_planned_file, file["path"], content)
+
+    with tracing.span("fanout", files=len(plan["files"])):
+        results = await fanout.generate_files(plan["files"], generate)
+    lines = []
+    for file, result, error in results:
+        build_log.append("fanout_file", path=file["path"], result=result, error=error)
+        emit_event(job, "fanout_file", path=file["path"], result=result, error=error)
+        lines.append(f"- {file['path']}: {result if error is None else f'生成失败：{error}'}")
+    lines.extend(f"- 未生成（路径无效）：{rejected}" for rejected in plan["rejected"])
+    if current_workspace.get() is None:
+        await reload_generated_routes(build_log, 0)
+    messages.append({"role": "system", "content": f"已按以下计划并行生成文件：\n{plan_text}\n\n生成结果：\n" + "\n".join(lines) +
+                     "\n\n这些文件是分别生成的。请检查它们之间的集成（蓝图名、URL、模板和静态文件引用是否一致），"
+                     "补全缺失或生成失败的文件，修复问题并测试，完成后调用 task_completed()。"})
+    if SMOKE_TEST_AUTO:
+        await auto_smoke_test(job, messages, build_log, 0)
+    return True
 
-            response_message = response.choices[0].message
-            content = response_message.content or ""
-            current_iteration['llm_responses'].append(content)
+async def _run_iterations(job, messages, build_log, checkpoint=None):
+    max_iterations = job["max_iterations"]  # 防止无限循环
+    iteration = 0
+    compactor = ContextCompactor(MODEL_NAME)
+    # 清单只附加在每次请求的末尾而不存入 messages：模型总是看到最新状态，前面的消息前缀保持不变
+    manifest = ProjectManifest(os.path.dirname(resolve_path(ROUTES_DIR)), read=file_cache.read)
+    manifest_note = None
+    # 模型级联：常规步骤用快速模型，验证失败、连续出错或没有进展时升级到强模型；每次选择都写入构建日志
+    router = ModelRouter(MODEL_NAME)
+    outcome = iteration_note = None
+    if checkpoint is not None:
+        # 从检查点继续：迭代计数、模型级联状态和上一轮的结果接着使用
+        iteration = checkpoint["iteration"]
+        router.restore(checkpoint.get("router") or {})
+        outcome = checkpoint.get("outcome")
+        if checkpoint.get("manifest") is not None:
+            manifest_note = iteration_note = {"role": "system", "content": checkpoint["manifest"]}
 
-            output += f"\n<h2>迭代 {iteration + 1}：</h2>\n"
+    while iteration < max_iterations:
+        with tracing.span("iteration", iteration=iteration + 1):
+            job["iteration"] = iteration + 1
+            build_log.append("iteration", iteration=iteration + 1)  # 从1开始
 
-            tool_calls = response_message.tool_calls
+            try:
+                manifest_note = await project_manifest_message(manifest, manifest_note)
+                if outcome is not None:
+                    # 上一轮的结果：清单发生变化说明文件有改动
+                    router.observe(progress=manifest_note is not iteration_note, **outcome)
+                iteration_note = manifest_note
+                outcome = {"errors": 0, "validation_failures": 0}
+                model, tier, reason = router.choose()
+                build_log.append("model_route", iteration=iteration + 1, model=model, tier=tier, reason=reason)
+                if job.get("model") != model:
+                    job["model"] = model
+                    emit_event(job, "model_route", model=model, tier=tier, reason=reason)
+                prompt_tokens = compact_context(compactor, messages, build_log, iteration + 1)
+                response = await complete(
+                    model=model,
+                    estimated_tokens=prompt_tokens + compactor.message_tokens(manifest_note),
+                    messages=messages + [manifest_note],
+                    tools=tools,
+                    tool_choice="auto"
+                )
+                record_usage(job, response)
 
-            if tool_calls:
-                output += "<strong>工具调用：</strong>\n<p>" + content + "</p>\n"
-                messages.append(response_message)
+                if not response.choices[0].message:
+                    error = response.get('error', '未知错误')
+                    build_log.append("error", iteration=iteration + 1, action="llm_completion", error=error)
+                    emit_event(job, "error", action="llm_completion", error=str(error))
+                    outcome["errors"] += 1
+                    # 与正常结束的一轮相同：先保存检查点，继续时不会重复这一轮
+                    iteration += 1
+                    await checkpoint_build(job, messages, build_log, iteration, router, outcome, iteration_note)
+                    await flush_build_log(build_log)
+                    continue
 
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    function_to_call = available_functions.get(function_name)
+                response_message = response.choices[0].message
+                content = response_message.content or ""
+                build_log.append("llm_response", iteration=iteration + 1, content=content)
 
-                    if not function_to_call:
-                        error_message = f"工具 '{function_name}' 不可用。"
-                        current_iteration['errors'].append({
-                            'action': f'tool_call_{function_name}',
-                            'error': error_message,
-                            'traceback': '没有可用的追溯信息。'
-                        })
-                        continue
+                emit_event(job, "iteration", iteration=iteration + 1)
+
+                tool_calls = response_message.tool_calls
+
+                if tool_calls:
+                    emit_event(job, "tool_calls", content=content)
+                    messages.append(response_message)
+
+                    # task_completed 之后的调用不会执行
+                    for index, tool_call in enumerate(tool_calls):
+                        if tool_call.function.name == "task_completed":
+                            tool_calls = tool_calls[:index + 1]
+                            break
+
+                    # 不同路径上的工具调用在线程池中并发执行，同一路径上的调用保持顺序；
+                    # 结果按原始 tool_call 顺序写回 messages
+                    parsed_calls = [parse_tool_call(tool_call) for tool_call in tool_calls]
+                    for tool_call, (function_name, function_args, _) in zip(tool_calls, parsed_calls):
+                        build_log.append("tool_call", iteration=iteration + 1, id=tool_call.id,
+                                         tool=function_name, arguments=function_args)
+                    with tracing.span("tool_calls", count=len(parsed_calls)):
+                        results = await run_tool_calls(
+                            [(function_name, function_args) for function_name, function_args, _ in parsed_calls],
+                            lambda index: traced_tool_call(*parsed_calls[index])
+                        )
+                    reload_result = None
+                    if current_workspace.get() is None:
+                        # 工作区中的构建不影响正在服务的路由，提交时统一重新加载
+                        reload_result = await reload_generated_routes(build_log, iteration + 1)
 
-                    try:
-                        function_args = json.loads(tool_call.function.arguments)
+                    for tool_call, (function_name, function_args, _), (function_response, error) in zip(tool_calls, parsed_calls, results):
+                        if error:
+                            build_log.append("error", iteration=iteration + 1, **error)
+                            emit_event(job, "error", action=error['action'], error=error['error'])
+                            outcome["errors"] += 1
+                            # 每个 tool_call 都必须有对应的 tool 消息，否则之后的补全请求都会被拒绝
+                            messages.append(
+                                {"tool_call_id": tool_call.id, "role": "tool", "name": function_name, "content": error['error']}
+                            )
+                            continue
 
-                        function_response = function_to_call(**function_args)
+                        load_note = route_load_note(function_name, function_args, reload_result) if reload_result else ""
+                        function_response += load_note
+                        if load_note or ROUTE_VALIDATION_FAILED in function_response:
+                            outcome["validation_failures"] += 1
 
-                        current_iteration['tool_results'].append({
-                            'tool': function_name,
-                            'result': function_response
-                        })
+                        build_log.append("tool_result", iteration=iteration + 1, tool=function_name, result=function_response)
 
-                        output += f"<strong>工具结果 ({function_name})：</strong>\n<p>{function_response}</p>\n"
+                        emit_event(job, "tool_result", tool=function_name, result=function_response)
 
                         messages.append(
                             {"tool_call_id": tool_call.id, "role": "tool", "name": function_name, "content": function_response}
                         )
 
                         if function_name == "task_completed":
-                            progress["status"] = "completed"
-                            progress["completed"] = True
-                            output += "\n<h2>完成</h2>\n"
-                            progress["output"] = output
-                            log_to_file(history_dict)
-                            return output
-
-                    except Exception as tool_error:
-                        error_message = f"执行 {function_name} 时出错：{tool_error}"
-                        current_iteration['errors'].append({
-                            'action': f'tool_call_{function_name}',
-                            'error': error_message,
-                            'traceback': traceback.format_exc()
-                        })
-
-                second_response = completion(
-                    model=MODEL_NAME,
-                    messages=messages
-                )
-                if second_response.choices and second_response.choices[0].message:
-                    second_response_message = second_response.choices[0].message
-                    content = second_response_message.content or ""
-                    current_iteration['llm_responses'].append(content)
-                    output += "<strong>LLM 响应：</strong>\n<p>" + content + "</p>\n"
-                    messages.append(second_response_message)
+                            return True
+
+                    if SMOKE_TEST_AUTO and any(
+                        function_name in FILE_WRITE_TOOLS and not error
+                        for (function_name, _, _), (_, error) in zip(parsed_calls, results)
+                    ) and not any(function_name == "run_smoke_tests" for function_name, _, _ in parsed_calls):
+                        summary = await auto_smoke_test(job, messages, build_log, iteration + 1)
+                        if summary is not None and (summary["failed"] or summary["load_errors"]):
+                            outcome["validation_failures"] += 1
+
+                    if not SINGLE_CALL_MODE:
+                        manifest_note = await project_manifest_message(manifest, manifest_note)
+                        prompt_tokens = compact_context(compactor, messages, build_log, iteration + 1)
+                        second_response = await complete(
+                            model=model,
+                            estimated_tokens=prompt_tokens + compactor.message_tokens(manifest_note),
+                            messages=messages + [manifest_note]
+                        )
+                        record_usage(job, second_response)
+                        if second_response.choices and second_response.choices[0].message:
+                            second_response_message = second_response.choices[0].message
+                            content = second_response_message.content or ""
+                            build_log.append("llm_response", iteration=iteration + 1, content=content)
+                            emit_event(job, "llm_response", content=content)
+                            messages.append(second_response_message)
+                        else:
+                            error = second_response.get('error', '第二次 LLM 响应中未知错误。')
+                            build_log.append("error", iteration=iteration + 1, action="second_llm_completion", error=error)
+                            emit_event(job, "error", action="second_llm_completion", error=str(error))
+                            outcome["errors"] += 1
+
                 else:
-                    error = second_response.get('error', '第二次 LLM 响应中未知错误。')
-                    current_iteration['errors'].append({'action': 'second_llm_completion', 'error': error})
+                    emit_event(job, "llm_response", content=content)
+                    messages.append(response_message)
 
-            else:
-                output += "<strong>LLM 响应：</strong>\n<p>" + content + "</p>\n"
-                messages.append(response_message)
+            except Exception as e:
+                error = str(e)
+                build_log.append("error", iteration=iteration + 1, action="main_loop", error=error,
+                                 traceback=traceback.format_exc())
+                emit_event(job, "error", action="main_loop", error=error)
+                if outcome is not None:
+                    outcome["errors"] += 1
 
-            progress["output"] = output
+            iteration += 1
+            await checkpoint_build(job, messages, build_log, iteration, router, outcome, iteration_note)
+            # 不再固定休眠：限流和退避由共享的 rate_limiter 统一处理
+            await flush_build_log(build_log)
 
-        except Exception as e:
-            error = str(e)
-            current_iteration['errors'].append({
-                'action': 'main_loop',
-                'error': error,
-                'traceback': traceback.format_exc()
-            })
+    return False
 
-        iteration += 1
-        log_to_file(history_dict)
-        sleep(2)
+async def run_speculative_build(user_input, job):
+    # 推测式构建：并行运行 SPECULATIVE_CANDIDATES 个候选，每个在独立工作区中；
+    # 第一个完成并通过验证的候选提升到 templates/、static/ 和 routes/，其余立即取消
+    build_log = BuildLog.for_job(job["id"])
+    job["log_file"] = build_log.path
+    build_log.append("build", user_input=user_input, model=MODEL_NAME, candidates=speculative.SPECULATIVE_CANDIDATES)
+    with tracing.start_trace(job["id"], "speculative_build", candidates=speculative.SPECULATIVE_CANDIDATES):
+        try:
+            committed = await speculative.run_candidates(user_input, job, run_main_loop_async, BASE_DIR,
+                                                         build_log=build_log)
+            if committed is None:
+                job["status"] = "error"
+                emit_event(job, "error", action="speculative_build", error="没有候选构建通过验证。")
+                build_log.append("error", action="speculative_build", error="没有候选构建通过验证。")
+            else:
+                await reload_generated_routes(build_log, job["iteration"])
+                job["status"] = "completed"
+                emit_event(job, "completed")
+            return job["events"]
+        finally:
+            await flush_build_log(build_log)
 
-    if iteration >= max_iterations:
-        progress["status"] = "completed"
+async def run_build(user_input, job):
+    if speculative.SPECULATIVE_CANDIDATES > 1:
+        return await run_speculative_build(user_input, job)
+    return await run_main_loop_async(user_input, job)
 
-    progress["completed"] = True
-    progress["status"] = "completed"
+def run_main_loop(user_input, job=None):
+    # 同步入口：在共享事件循环上运行异步主循环并等待结果
+    return event_loop.run_sync(run_main_loop_async(user_input, job))
 
-    return output
+build_engine = JobEngine(run_build, JobStore(JOB_STORE_PATH), max_iterations=MAX_ITERATIONS)
+# 每个工作进程导入应用时启动自己的调度器，从共享队列中领取构建。
+# 以 python main.py 运行时，冒烟测试和路由校验进程池的子进程会把本脚本作为 __mp_main__ 导入，它们不领取构建
+if __name__ != '__mp_main__':
+    build_engine.start()
+metrics.builds_queued.set_function(lambda: build_engine.stats()["queued"])
+metrics.builds_active.set_function(lambda: build_engine.stats()["active"])
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
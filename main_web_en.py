@@ -1,104 +1,259 @@
 import os
-import sys
 import json
-import importlib
+import time
+import asyncio
+import tempfile
 import traceback
-from flask import Flask, Blueprint, request, send_from_directory, render_template_string, jsonify
-from threading import Thread
-from time import sleep
-
-from litellm import completion, supports_function_calling
+import contextvars
+from functools import partial
+from flask import Flask, Response, request, render_template_string, jsonify
 from litellm import set_verbose
 
+import event_loop
+import metrics
+import tracing
+from jobs import JobEngine, QueueFull, new_job_state, emit_event, job_store
+from job_store import JobStore
+from build_log import BuildLog
+from llm import complete, supports_function_calling, cache_hit
+from compaction import ContextCompactor, CONTEXT_TOKEN_BUDGET
+from patching import PatchConflict, apply_unified_diff, apply_search_replace, content_hash
+from route_reloader import RouteReloader, RouteDispatcher
+from route_validation import RouteValidator
+from tool_scheduler import run_tool_calls
+from workspace import Workspace, current_workspace, resolve_path, expand_path
+from file_cache import FileCache
+from static_files import StaticIndex, StaticMiddleware
+from project_manifest import ProjectManifest
+from model_router import ModelRouter, FAST_MODEL
+import speculative
+import fanout
+import checkpoints
+import smoke_tests
+
 MODEL_NAME = os.environ.get('LITELLM_MODEL', 'gpt-4o-mini')
 
+# Single-call mode: tool results feed straight into the next tool-enabled completion, so each iteration costs one LLM call.
+# Set SINGLE_CALL_MODE=0 to restore the old extra tool-less commentary call after every tool round.
+SINGLE_CALL_MODE = os.environ.get('SINGLE_CALL_MODE', '1') != '0'
+
 set_verbose = True
 
 app = Flask(__name__)
 
-LOG_FILE = "flask_app_builder_log.json"
-
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Root directory for generated files; the offline benchmark (bench.py) points it at a temp dir
+BASE_DIR = os.environ.get('BUILDER_BASE_DIR') or os.path.dirname(os.path.abspath(__file__))
 TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
 ROUTES_DIR = os.path.join(BASE_DIR, 'routes')
 
-progress = {
-    "status": "idle",
-    "iteration": 0,
-    "max_iterations": 50,
-    "output": "",
-    "completed": False
-}
+MAX_ITERATIONS = 50
+
+# Job state, progress events and results live in SQLite (WAL mode), so any worker of a multi-process WSGI server can query and claim them
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH') or os.path.join(BASE_DIR, 'jobs.sqlite3')
+
+# Run the smoke tests automatically after each iteration that changed files and add the result to messages; SMOKE_TEST_AUTO=0 turns it off
+SMOKE_TEST_AUTO = os.environ.get('SMOKE_TEST_AUTO', '1') != '0'
+FILE_WRITE_TOOLS = ("create_file", "update_file", "apply_patch")
+
+# Each build writes into its own workspace (under BASE_DIR/.workspaces, base files hardlinked in),
+# committed atomically on completion with a single route reload; set BUILD_WORKSPACES=0 to write into BASE_DIR directly
+BUILD_WORKSPACES = os.environ.get('BUILD_WORKSPACES', '1') != '0'
 
 def create_directory(path):
-    if not os.path.exists(path):
-        os.makedirs(path)
-        if path == ROUTES_DIR:
+    # Tool paths go through resolve_path: into the workspace when the build runs in one, otherwise into BASE_DIR
+    try:
+        target = resolve_path(path)
+    except Exception as e:
+        return f"Error creating directory {path}: {e}"
+    if not os.path.exists(target):
+        os.makedirs(target)
+        if os.path.abspath(target) == os.path.abspath(resolve_path(ROUTES_DIR)):
             create_file(os.path.join(ROUTES_DIR, '__init__.py'), '')
         return f"Created directory: {path}"
     return f"Directory already exists: {path}"
 
+# Content cache for generated files: validated by inode, mtime and size and updated on write, so fetch_code / fetch_files do not hit the disk every time
+file_cache = FileCache()
+# Maximum characters returned by one fetch_files call; files beyond it are only listed. The default is about a sixth of the context token budget
+# (at roughly 3 characters per token): recent tool results are never compacted, so a single result must not fill the budget
+FETCH_FILES_MAX_CHARS = int(os.environ.get('FETCH_FILES_MAX_CHARS', str(CONTEXT_TOKEN_BUDGET // 6 * 3)))
+
+def write_file(path, content):
+    # Skip the write when the content hash is unchanged (so the file mtime stays put too); returns whether the file changed
+    try:
+        if content_hash(file_cache.read(path)) == content_hash(content):
+            return False
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    # Write a temporary file and rename it over the target: a workspace file may share its inode with BASE_DIR (hardlink),
+    # so writing in place would modify the file being served
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=f'.{os.path.basename(path)}.',
+                                             suffix='.tmp')
+    with os.fdopen(descriptor, 'w') as f:
+        f.write(content)
+    os.chmod(temporary, mode)
+    os.replace(temporary, path)
+    file_cache.put(path, content)
+    return True
+
+route_validator = RouteValidator()
+ROUTE_VALIDATION_FAILED = "\nRoute file validation failed; fix these problems before continuing: "
+
+def route_validation_note(path, target, content):
+    # Python files written into routes/ are validated statically right away (syntax, compile, Blueprint, route and blueprint-name collisions);
+    # structured errors go back to the model in the tool result
+    if not target.endswith('.py') or os.path.basename(target) == '__init__.py':
+        return ""
+    if os.path.dirname(os.path.abspath(target)) != os.path.abspath(resolve_path(ROUTES_DIR)):
+        return ""
+    try:
+        with tracing.span("route_validation", path=path):
+            errors = route_validator.validate(target, content)
+    except Exception as e:
+        errors = [{"type": "validation_failed", "message": str(e)}]
+    if not errors:
+        return ""
+    report = json.dumps({"file": path, "errors": errors}, ensure_ascii=False)
+    return f"{ROUTE_VALIDATION_FAILED}{report}"
+
 def create_file(path, content):
     try:
-        with open(path, 'x') as f:
-            f.write(content)
-        return f"Created file: {path}"
-    except FileExistsError:
-        with open(path, 'w') as f:
-            f.write(content)
-        return f"Updated file: {path}"
+        target = resolve_path(path)
+        existed = os.path.exists(target)
+        if not write_file(target, content):
+            return f"File content unchanged, not written: {path}" + route_validation_note(path, target, content)
+        result = f"Updated file: {path}" if existed else f"Created file: {path}"
+        return result + route_validation_note(path, target, content)
     except Exception as e:
         return f"Error creating/updating file {path}: {e}"
 
 def update_file(path, content):
     try:
-        with open(path, 'w') as f:
-            f.write(content)
-        return f"Updated file: {path}"
+        target = resolve_path(path)
+        if not write_file(target, content):
+            return f"File content unchanged, not written: {path}" + route_validation_note(path, target, content)
+        return f"Updated file: {path}" + route_validation_note(path, target, content)
     except Exception as e:
         return f"Error updating file {path}: {e}"
 
+def apply_patch(path, patch=None, edits=None):
+    try:
+        target = resolve_path(path)
+        original = file_cache.read(target)
+    except Exception as e:
+        return f"Error reading file {path}: {e}"
+    try:
+        if edits:
+            content = apply_search_replace(original, edits)
+        elif patch:
+            content = apply_unified_diff(original, patch)
+        else:
+            return f"Patch not applied to {path}: provide either patch (a unified diff) or edits (a search/replace list)."
+    except PatchConflict as e:
+        return f"Patch conflicts with the current content of {path}; nothing was changed: {e}"
+    try:
+        if not write_file(target, content):
+            return f"Content unchanged after applying the patch, not written: {path}"
+        return f"Applied patch to file: {path}" + route_validation_note(path, target, content)
+    except Exception as e:
+        return f"Error writing file {path}: {e}"
+
 def fetch_code(file_path):
     try:
-        with open(file_path, 'r') as f:
-            code = f.read()
-        return code
+        return file_cache.read(resolve_path(file_path))
     except Exception as e:
         return f"Error fetching code from {file_path}: {e}"
 
+def fetch_files(paths):
+    # Returns several files at once; paths may be globs (routes/*.py, templates/**/*.html), saving a fetch_code round-trip per file
+    if isinstance(paths, str):
+        paths = [paths]
+    sections = []
+    seen = set()
+    total = 0
+    for pattern in paths:
+        try:
+            matches = expand_path(str(pattern))
+        except Exception as e:
+            sections.append(f"=== {pattern} ===\nError fetching files: {e}")
+            continue
+        if not matches:
+            sections.append(f"=== {pattern} ===\nNo matching files.")
+            continue
+        for path, target in matches:
+            if target in seen:
+                continue
+            seen.add(target)
+            if total >= FETCH_FILES_MAX_CHARS:
+                sections.append(f"=== {path} ===\nOmitted: this result already reached the {FETCH_FILES_MAX_CHARS}-character limit; fetch it separately.")
+                continue
+            try:
+                content = file_cache.read(target)
+            except Exception as e:
+                sections.append(f"=== {path} ===\nError fetching code: {e}")
+                continue
+            if total + len(content) > FETCH_FILES_MAX_CHARS:
+                sections.append(f"=== {path} ===\nOmitted: adding this file ({len(content)} characters) would exceed this call's limit of {FETCH_FILES_MAX_CHARS} characters; fetch it separately.")
+                continue
+            total += len(content)
+            sections.append(f"=== {path} ===\n{content}")
+    return "\n\n".join(sections)
+
+# In-memory index of static/ and templates/index.html: contents, strong ETags and pre-compressed gzip/brotli variants,
+# built at load time and refreshed incrementally when a build commits; requests no longer touch the filesystem
+static_index = StaticIndex(BASE_DIR)
+
+# Generated routes load into a separate Flask app: only modules whose content hash changed are reloaded,
+# and the new app is swapped in atomically once built; the builder's own routes take precedence
+route_reloader = RouteReloader(ROUTES_DIR, app_kwargs={
+    "root_path": BASE_DIR,
+    "template_folder": TEMPLATES_DIR,
+    "static_folder": STATIC_DIR
+}, setup=static_index.add_url_defaults)
+app.wsgi_app = StaticMiddleware(static_index, RouteDispatcher(app, app.wsgi_app, route_reloader))
+
 def load_routes():
     try:
-        if BASE_DIR not in sys.path:
-            sys.path.append(BASE_DIR)
-        for filename in os.listdir(ROUTES_DIR):
-            if filename.endswith('.py') and filename != '__init__.py':
-                module_name = filename[:-3]
-                module_path = f'routes.{module_name}'
-                try:
-                    if module_path in sys.modules:
-                        importlib.reload(sys.modules[module_path])
-                    else:
-                        importlib.import_module(module_path)
-                    module = sys.modules.get(module_path)
-                    if module:
-                        # Find all blueprint objects in the module
-                        for attr_name in dir(module):
-                            attr = getattr(module, attr_name)
-                            if isinstance(attr, Blueprint):
-                                app.register_blueprint(attr)
-                except Exception as e:
-                    print(f"Error importing module {module_path}: {e}")
-                    continue
+        result = route_reloader.reload()
+        for module_name, error in result["errors"].items():
+            print(f"Error importing module routes.{module_name}: {error}")
         print("Routes loaded successfully.")
         return "Routes loaded successfully."
     except Exception as e:
         print(f"Error in load_routes: {e}")
         return f"Error loading routes: {e}"
 
+def format_smoke_report(summary, verbose=True):
+    # Failures are listed in full; with verbose, one line per passing request
+    lines = [f"Smoke tests: {summary['passed']} passed, {summary['failed']} failed."]
+    for module, error in sorted(summary["load_errors"].items()):
+        lines.append(f"Failed to load {module}: {error}")
+    for result in summary["results"]:
+        if smoke_tests.failed(result):
+            outcome = result.get("error") or f"HTTP {result['status']}"
+            lines.append(f"FAIL {result['method']} {result['url']} -> {outcome}")
+        elif verbose:
+            lines.append(f"ok {result['method']} {result['url']} -> HTTP {result['status']}")
+    return "\n".join(lines)
+
+def smoke_test_summary():
+    # Build a throwaway app from the current (or workspace) routes/ and templates/ and request every URL rule with the Flask test client in worker processes
+    root = os.path.dirname(resolve_path(ROUTES_DIR))
+    with tracing.span("smoke_tests") as span:
+        summary = smoke_tests.run_smoke_tests(root)
+        if span is not None:
+            span.set(passed=summary["passed"], failed=summary["failed"])
+    return summary
+
+def run_smoke_tests():
+    try:
+        return format_smoke_report(smoke_test_summary())
+    except Exception as e:
+        return f"Error running smoke tests: {e}"
+
 def task_completed():
-    progress["status"] = "completed"
-    progress["completed"] = True
     return "Task marked as completed."
 
 create_directory(TEMPLATES_DIR)
@@ -106,46 +261,101 @@ create_directory(STATIC_DIR)
 create_directory(ROUTES_DIR) 
 
 load_routes()
+static_index.refresh()
 
-def log_to_file(history_dict):
-    try:
-        with open(LOG_FILE, 'w') as log_file:
-            json.dump(history_dict, log_file, indent=4)
-    except Exception as e:
-        pass 
+# Progress page: receives only new events over SSE; falls back to polling with the same cursor when SSE is unavailable or drops
+PROGRESS_PAGE = '''
+    <h1>Progress</h1>
+    <pre id="progress"></pre>
+    <script>
+        var jobId = '{{ job_id }}';
+        var cursor = 0;
+        var finished = false;
+        var progressEl = document.getElementById('progress');
+
+        function esc(text) {
+            var div = document.createElement('div');
+            div.textContent = text == null ? '' : String(text);
+            return div.innerHTML;
+        }
+
+        function render(event) {
+            switch (event.type) {
+                case 'iteration': return '\\n<h2>Iteration ' + event.iteration + ':</h2>\\n';
+                case 'tool_calls': return '<strong>Tool Call:</strong>\\n<p>' + esc(event.content) + '</p>\\n';
+                case 'tool_result': return '<strong>Tool Result (' + esc(event.tool) + '):</strong>\\n<p>' + esc(event.result) + '</p>\\n';
+                case 'llm_response': return '<strong>LLM Response:</strong>\\n<p>' + esc(event.content) + '</p>\\n';
+                case 'error': return '<strong>Error (' + esc(event.action) + '):</strong>\\n<p>' + esc(event.error) + '</p>\\n';
+                case 'resumed': return '\\n<h2>Resumed from the checkpoint after iteration ' + event.iteration + '</h2>\\n';
+                case 'completed': return '\\n<h2>COMPLETE</h2>\\n';
+                default: return '';
+            }
+        }
+
+        function handle(event) {
+            if (event.seq < cursor) {
+                return;
+            }
+            cursor = event.seq + 1;
+            progressEl.insertAdjacentHTML('beforeend', render(event));
+            if (event.type === 'end') {
+                finished = true;
+                document.getElementById('refresh-btn').style.display = 'block';
+            } else if (event.type === 'resume_requested' || event.type === 'resumed') {
+                // When a build is resumed, its earlier end event is no longer the last one
+                finished = false;
+                document.getElementById('refresh-btn').style.display = 'none';
+            }
+        }
+
+        function poll() {
+            if (finished) {
+                return;
+            }
+            fetch('/jobs/' + jobId + '?cursor=' + cursor)
+            .then(response => response.json())
+            .then(data => {
+                data.events.forEach(handle);
+                if (data.finished_at == null) {
+                    finished = false;
+                }
+                setTimeout(poll, 2000);
+            })
+            .catch(() => setTimeout(poll, 2000));
+        }
+
+        if (window.EventSource) {
+            var source = new EventSource('/jobs/' + jobId + '/events?cursor=0');
+            // The server closes the stream (firing onerror) once the build has really finished; the page does not close it on end
+            source.onmessage = function(message) {
+                handle(JSON.parse(message.data));
+            };
+            source.onerror = function() {
+                source.close();
+                poll();
+            };
+        } else {
+            poll();
+        }
+    </script>
+    <button id="refresh-btn" style="display:none;" onclick="location.reload();">Refresh Page</button>
+'''
 
 # Default route to serve generated index.html or render a form
 @app.route('/', methods=['GET', 'POST'])
 def home():
-    index_file = os.path.join(TEMPLATES_DIR, 'index.html')
-    if os.path.exists(index_file):
-        return send_from_directory(TEMPLATES_DIR, 'index.html')
+    static_index.check()
+    response = static_index.response(request.environ, 'templates/index.html')
+    if response is not None:
+        return response
     else:
         if request.method == 'POST':
             user_input = request.form.get('user_input')
-            progress["status"] = "running"
-            progress["iteration"] = 0
-            progress["output"] = ""
-            progress["completed"] = False
-            thread = Thread(target=run_main_loop, args=(user_input,))
-            thread.start()
-            return render_template_string('''
-                <h1>Progress</h1>
-                <pre id="progress">{{ progress_output }}</pre>
-                <script>
-                    setInterval(function() {
-                        fetch('/progress')
-                        .then(response => response.json())
-                        .then(data => {
-                            document.getElementById('progress').innerHTML = data.output;
-                            if (data.completed) {
-                                document.getElementById('refresh-btn').style.display = 'block';
-                            }
-                        });
-                    }, 2000);
-                </script>
-                <button id="refresh-btn" style="display:none;" onclick="location.reload();">Refresh Page</button>
-            ''', progress_output=progress["output"])
+            try:
+                job = build_engine.submit(user_input)
+            except QueueFull:
+                return "The build queue is full, please try again later.", 503
+            return render_template_string(PROGRESS_PAGE, job_id=job["id"])
         else:
             return render_template_string('''
                 <h1>Flask App Builder</h1>
@@ -156,15 +366,109 @@ def home():
                 </form>
             ''')
 
-@app.route('/progress')
-def get_progress():
-    return jsonify(progress)
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.get_json(silent=True) or request.form
+    user_input = data.get('user_input')
+    if not user_input:
+        return jsonify({"error": "Missing user_input."}), 400
+    try:
+        job = build_engine.submit(user_input)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"id": job["id"], "status": job["status"]}), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = build_engine.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+    # Polling fallback: only return events after the cursor
+    cursor = request.args.get('cursor', 0, type=int)
+    events = build_engine.get_events(job_id, cursor) or []
+    job["events"] = events
+    job["cursor"] = events[-1]["seq"] + 1 if events else max(cursor, 0)
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events')
+def stream_job_events(job_id):
+    if build_engine.get(job_id) is None:
+        return jsonify({"error": "Job not found."}), 404
+    # The SSE id is the next cursor; browsers send it back as Last-Event-ID when reconnecting
+    cursor = request.args.get('cursor', type=int)
+    if cursor is None:
+        cursor = int(request.headers.get('Last-Event-ID', 0) or 0)
+
+    def generate(cursor):
+        while True:
+            events = build_engine.wait_events(job_id, cursor)
+            if events is None:
+                return
+            for event in events:
+                cursor = event["seq"] + 1
+                yield f"id: {cursor}\ndata: {json.dumps(event)}\n\n"
+            # A resumed job has events after its earlier end event: close only on a last end event of a finished job
+            if events and events[-1]["type"] == "end":
+                job = build_engine.get(job_id)
+                if job is None or job["finished_at"] is not None:
+                    return
+            if not events:
+                job = build_engine.get(job_id)
+                if job is None or job["finished_at"] is not None:
+                    return
+                yield ": keep-alive\n\n"
+
+    return Response(generate(cursor), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    # A queued job is cancelled immediately; a running one is cancelled by the worker running it (possibly another process, up to JOB_POLL_INTERVAL seconds later)
+    if build_engine.get(job_id) is None:
+        return jsonify({"error": "Job not found."}), 404
+    if not build_engine.cancel(job_id):
+        return jsonify({"error": "Only queued or running jobs can be cancelled."}), 409
+    return jsonify({"id": job_id, "cancel_requested": True}), 202
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    # Failed or cancelled builds (including those whose worker exited) continue from their last checkpoint instead of starting over
+    if build_engine.get(job_id) is None:
+        return jsonify({"error": "Job not found."}), 404
+    try:
+        job = build_engine.resume(job_id)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    if job is None:
+        return jsonify({"error": "Only failed or cancelled jobs with a saved checkpoint can be resumed."}), 409
+    return jsonify({"id": job["id"], "status": job["status"]}), 202
+
+@app.route('/jobs/<job_id>/trace')
+def get_job_trace(job_id):
+    # Chrome trace-event JSON; open it in chrome://tracing or https://ui.perfetto.dev
+    trace = tracing.get_trace(job_id)
+    if trace is None:
+        return jsonify({"error": "Job not found or its trace has expired."}), 404
+    response = jsonify(trace.to_chrome())
+    if request.args.get('download'):
+        response.headers['Content-Disposition'] = f'attachment; filename="trace-{job_id}.json"'
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Prometheus text format: LLM latency and tokens, tool-call latency, iterations per build, queue, errors and route reload time
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 available_functions = {
     "create_directory": create_directory,
     "create_file": create_file,
     "update_file": update_file,
+    "apply_patch": apply_patch,
     "fetch_code": fetch_code,
+    "fetch_files": fetch_files,
+    "run_smoke_tests": run_smoke_tests,
     "task_completed": task_completed
 }
 
@@ -228,6 +532,45 @@ tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "apply_patch",
+            "description": "Applies a small change to an existing file without re-sending the whole file. Provide either a unified diff (patch) or a search/replace list (edits); if it conflicts with the current file content, the file is left unchanged and the conflict is explained.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "path": {
+                        "type": "string",
+                        "description": "The file path to modify."
+                    },
+                    "patch": {
+                        "type": "string",
+                        "description": "A patch in unified diff format, with hunks starting with '@@ -start,count +start,count @@'."
+                    },
+                    "edits": {
+                        "type": "array",
+                        "description": "Search/replace edits applied in order; each search must occur exactly once in the file.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "search": {
+                                    "type": "string",
+                                    "description": "The exact original text to find."
+                                },
+                                "replace": {
+                                    "type": "string",
+                                    "description": "The replacement text."
+                                }
+                            },
+                            "required": ["search", "replace"]
+                        }
+                    }
+                },
+                "required": ["path"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -245,6 +588,36 @@ tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "fetch_files",
+            "description": "Fetch the contents of several files at once. Paths may be glob patterns such as routes/*.py or templates/**/*.html.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "paths": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "List of file paths or glob patterns to fetch."
+                    }
+                },
+                "required": ["paths"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "run_smoke_tests",
+            "description": "Requests every URL rule of the current app with the Flask test client and returns status codes, exceptions and timeouts; 5xx responses, exceptions and timeouts count as failures.",
+            "parameters": {
+                "type": "object",
+                "properties": {},
+                "required": []
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -259,20 +632,148 @@ tools = [
     }
 ]
 
-def run_main_loop(user_input):
-    # Reset the history_dict for each run
-    history_dict = {
-        "iterations": []
+# In plan-then-fan-out mode (PLAN_FANOUT=1) the first completion may only call this tool
+plan_tool = {
+    "type": "function",
+    "function": {
+        "name": "submit_plan",
+        "description": "Submit the implementation plan for the app: every file needed and its purpose, plus the interfaces shared between files.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "files": {
+                    "type": "array",
+                    "description": "All files to write.",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "path": {"type": "string", "description": "File path under templates/, static/ or routes/."},
+                            "purpose": {"type": "string", "description": "What the file is for and what it contains."},
+                            "interfaces": {
+                                "type": "string",
+                                "description": "Shared interfaces the file defines or relies on: blueprint names, URLs, template variables, form fields, CSS classes, JS functions, etc."
+                            }
+                        },
+                        "required": ["path", "purpose"]
+                    }
+                },
+                "routes": {
+                    "type": "array",
+                    "description": "Every URL rule of the app.",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "methods": {"type": "array", "items": {"type": "string"}},
+                            "url": {"type": "string"},
+                            "blueprint": {"type": "string"},
+                            "endpoint": {"type": "string"},
+                            "module": {"type": "string", "description": "The routes/ file that defines the route."},
+                            "template": {"type": "string", "description": "The template it renders, if any."}
+                        },
+                        "required": ["url"]
+                    }
+                },
+                "notes": {"type": "string", "description": "Conventions every file follows."}
+            },
+            "required": ["files"]
+        }
     }
+}
 
-    if not supports_function_calling(MODEL_NAME):
-        progress["status"] = "error"
-        progress["output"] = "Model does not support function calling."
-        progress["completed"] = True
-        return "Model does not support function calling."
+async def run_in_thread(func, *args, **kwargs):
+    # Run blocking work such as file I/O on the thread pool so the shared event loop is never blocked
+    # Copy the current context so spans opened in the thread nest under the current span
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, partial(context.run, func, *args, **kwargs))
 
-    max_iterations = progress["max_iterations"]  # Prevent infinite loops
-    iteration = 0
+async def flush_build_log(build_log):
+    with tracing.span("log_flush"):
+        await run_in_thread(build_log.flush)
+
+def parse_tool_call(tool_call):
+    function_name = tool_call.function.name
+    try:
+        return function_name, json.loads(tool_call.function.arguments), None
+    except Exception as e:
+        return function_name, None, e
+
+def execute_tool_call(function_name, function_args, parse_error):
+    # Runs on the tool thread pool; returns (result, error)
+    function_to_call = available_functions.get(function_name)
+
+    if not function_to_call:
+        error_message = f"Tool '{function_name}' is not available."
+        return None, {
+            'action': f'tool_call_{function_name}',
+            'error': error_message,
+            'traceback': 'No traceback available.'
+        }
+
+    started = time.perf_counter()
+    try:
+        if parse_error:
+            raise parse_error
+        return function_to_call(**function_args), None
+    except Exception as tool_error:
+        error_message = f"Error executing {function_name}: {tool_error}"
+        return None, {
+            'action': f'tool_call_{function_name}',
+            'error': error_message,
+            'traceback': traceback.format_exc()
+        }
+    finally:
+        metrics.tool_call_seconds.observe(time.perf_counter() - started, tool=function_name)
+
+def traced_tool_call(function_name, function_args, parse_error):
+    with tracing.span("tool_call", tool=function_name) as span:
+        function_response, error = execute_tool_call(function_name, function_args, parse_error)
+        if span is not None and error:
+            span.set(error=error['error'])
+        return function_response, error
+
+def record_usage(job, response):
+    # Record each job's LLM call count and token usage; completions served from the cache cost no tokens and are not counted
+    job["llm_calls"] = job.get("llm_calls", 0) + 1
+    usage = getattr(response, 'usage', None)
+    if usage and not cache_hit(response):
+        job["prompt_tokens"] = job.get("prompt_tokens", 0) + (getattr(usage, 'prompt_tokens', 0) or 0)
+        job["completion_tokens"] = job.get("completion_tokens", 0) + (getattr(usage, 'completion_tokens', 0) or 0)
+
+async def run_main_loop_async(user_input, job=None):
+    # Each build gets its own job state so builds do not clobber each other
+    if job is None:
+        job = new_job_state(user_input=user_input, max_iterations=MAX_ITERATIONS)
+
+    # Each build records its own span trace (build -> iteration -> completion / tool call / log flush / waits),
+    # downloadable from /jobs/<id>/trace
+    with tracing.start_trace(job["id"], "build", model=MODEL_NAME) as root:
+        # Speculative candidates already run in a workspace created by the orchestrator
+        workspace = token = None
+        if BUILD_WORKSPACES and current_workspace.get() is None:
+            workspace = await run_in_thread(Workspace.create, BASE_DIR, job["id"])
+            token = current_workspace.set(workspace)
+        try:
+            return await _run_build(user_input, job, workspace)
+        finally:
+            root.set(status=job["status"], iterations=job["iteration"], llm_calls=job["llm_calls"])
+            if workspace is not None:
+                current_workspace.reset(token)
+                await run_in_thread(workspace.remove)
+
+async def _run_build(user_input, job, workspace=None):
+    # Each build writes its own append-only JSONL log, one record per action
+    build_log = BuildLog.for_job(job["id"])
+    job["log_file"] = build_log.path
+    build_log.append("build", user_input=user_input, model=MODEL_NAME, fast_model=FAST_MODEL)
+
+    if not all(supports_function_calling(model) for model in ModelRouter(MODEL_NAME).models):
+        job["status"] = "error"
+        emit_event(job, "error", action="llm_completion", error="Model does not support function calling.")
+        build_log.append("error", action="llm_completion", error="Model does not support function calling.")
+        await flush_build_log(build_log)
+        job["completed"] = True
+        return job["events"]
 
     # Updated messages array with enhanced prompt
     messages = [
@@ -285,7 +786,7 @@ def run_main_loop(user_input):
                 "1. **Understand the Requirements**: Analyze the user's input to fully understand the application's functionality and features.\n"
                 "2. **Plan the Application Structure**: List all the routes, templates, and static files that need to be created. Consider how they interact.\n"
                 "3. **Implement Step by Step**: For each component, use the provided tools to create directories, files, and write code. Ensure each step is thoroughly completed before moving on.\n"
-                "4. **Review and Refine**: Use `fetch_code` to review the code you've written. Update files if necessary using `update_file`.\n"
+                "4. **Review and Refine**: Use `fetch_files` (several files at once) or `fetch_code` to review the code you've written. Update files if necessary using `update_file`.\n"
                 "5. **Ensure Completeness**: Do not leave any placeholders or incomplete code. All functions, routes, and templates must be fully implemented and ready for production.\n"
                 "6. **Do Not Modify `main.py`**: Focus only on the `templates/`, `static/`, and `routes/` directories.\n"
                 "7. **Finalize**: Once everything is complete and thoroughly tested, call `task_completed()` to finish.\n\n"
@@ -301,140 +802,427 @@ def run_main_loop(user_input):
                 "- `create_directory(path)`: Create a new directory.\n"
                 "- `create_file(path, content)`: Create or overwrite a file with content.\n"
                 "- `update_file(path, content)`: Update an existing file with new content.\n"
+                "- `apply_patch(path, patch or edits)`: Make a small change to an existing file (unified diff or search/replace); prefer it over rewriting the whole file for small fixes.\n"
                 "- `fetch_code(file_path)`: Retrieve the code from a file for review.\n"
+                "- `fetch_files(paths)`: Fetch several files at once (globs such as `routes/*.py` allowed); prefer it when reviewing more than one file.\n"
+                "- `run_smoke_tests()`: Request every route of the app and report status codes and exceptions; use it to test the app.\n"
                 "- `task_completed()`: Call this when the application is fully built and ready.\n\n"
                 "Remember to think carefully at each step, ensuring the application is complete, functional, and meets the user's requirements."
             )
         },
-        {"role": "user", "content": user_input},
-        {"role": "system", "content": f"History:\n{json.dumps(history_dict, indent=2)}"}
+        {"role": "user", "content": user_input}
     ]
 
-    output = ""
+    # When an interrupted build is resumed, the conversation and the changed workspace files come from its checkpoint and finished iterations are not repeated
+    store = job_store(job)
+    checkpoint = await run_in_thread(store.checkpoint, job["id"]) if store is not None else None
 
-    while iteration < max_iterations:
-        progress["iteration"] = iteration + 1
-        current_iteration = {
-            "iteration": iteration + 1,  # Start from 1
-            "actions": [],
-            "llm_responses": [],
-            "tool_results": [],
-            "errors": []
-        }
-        history_dict['iterations'].append(current_iteration)
+    try:
+        if checkpoint is not None:
+            messages = await resume_from_checkpoint(job, checkpoint, workspace, build_log)
+        elif fanout.PLAN_FANOUT:
+            await plan_and_generate(job, messages, build_log)
+            await checkpoint_build(job, messages, build_log)
+        # True means the model called task_completed; a build that runs out of iterations is committed and marked completed as well.
+        # The status and the completed event are only set once the workspace commit succeeds; a failed commit leaves the build in error
+        task_completed = await _run_iterations(job, messages, build_log, checkpoint)
+        if workspace is not None and not await commit_workspace(job, workspace, build_log):
+            return job["events"]
+        job["status"] = "completed"
+        job["completed"] = True
+        if task_completed:
+            emit_event(job, "completed")
+        return job["events"]
+    finally:
+        await flush_build_log(build_log)
+
+async def checkpoint_build(job, messages, build_log, iteration=0, router=None, outcome=None, manifest_note=None):
+    # Saves a checkpoint after every iteration: the conversation, the model router state, the last outcome and the changed workspace files.
+    # Only builds run by the job engine (whose state is in SQLite) are checkpointed; a failure does not affect the build itself
+    store = job_store(job)
+    if store is None or not checkpoints.BUILD_CHECKPOINTS:
+        return
+    workspace = current_workspace.get()
+    data = {
+        "iteration": iteration,
+        "messages": [checkpoints.serialize_message(message) for message in messages],
+        "router": router.state() if router is not None else None,
+        "outcome": outcome,
+        "manifest": manifest_note["content"] if manifest_note is not None else None
+    }
+
+    def save():
+        data["files"] = checkpoints.changed_files(workspace, file_cache.read) if workspace is not None else {}
+        return store.save_checkpoint(job["id"], iteration, data)
+
+    with tracing.span("checkpoint", iteration=iteration) as span:
+        try:
+            size = await run_in_thread(save)
+        except Exception as e:
+            build_log.append("error", iteration=iteration, action="checkpoint", error=str(e))
+            return
+        if span is not None:
+            span.set(bytes=size, files=len(data["files"]))
+    build_log.append("checkpoint", iteration=iteration, bytes=size, files=len(data["files"]))
+
+async def resume_from_checkpoint(job, checkpoint, workspace, build_log):
+    # Without a workspace the files were written to the base directory and need no restoring
+    files = []
+    if workspace is not None and checkpoint.get("files"):
+        files = await run_in_thread(checkpoints.restore_files, workspace, checkpoint["files"])
+    build_log.append("resume", iteration=checkpoint["iteration"], files=files, messages=len(checkpoint["messages"]))
+    emit_event(job, "resumed", iteration=checkpoint["iteration"], files=files)
+    return checkpoint["messages"]
+
+async def commit_workspace(job, workspace, build_log):
+    # Changed files are staged in their target directories, then renamed into place as one batch, so readers never see a half-written file;
+    # then routes are reloaded once, instead of after every round of tool calls. Returns False when the commit fails (including conflicts)
+    with tracing.span("workspace_commit") as span:
+        try:
+            files = await run_in_thread(workspace.commit)
+        except Exception as e:
+            job["status"] = "error"
+            emit_event(job, "error", action="workspace_commit", error=str(e))
+            build_log.append("error", action="workspace_commit", error=str(e))
+            return False
+        if span is not None:
+            span.set(files=len(files))
+    build_log.append("workspace_commit", iteration=job["iteration"], files=files)
+    emit_event(job, "committed", files=files)
+    if files:
+        await reload_generated_routes(build_log, job["iteration"])
+    return True
 
+async def reload_generated_routes(build_log, iteration):
+    # The route index only reloads modules whose content changed; with no changes it is just a few stats
+    started = time.perf_counter()
+    with tracing.span("route_reload") as span:
+        result = await run_in_thread(route_reloader.reload)
+        if span is not None:
+            span.set(swapped=result["swapped"], reloaded=len(result["reloaded"]))
+    metrics.route_reload_seconds.observe(time.perf_counter() - started, swapped=str(result["swapped"]).lower())
+    if result["swapped"]:
+        build_log.append("route_reload", iteration=iteration, reloaded=result["reloaded"],
+                         removed=result["removed"], errors=result["errors"])
+    # The static file index is refreshed at the same time; changed files are compressed here, not per request
+    with tracing.span("static_index") as span:
+        changed = await run_in_thread(static_index.refresh)
+        if span is not None:
+            span.set(changed=len(changed))
+    if changed:
+        build_log.append("static_index", iteration=iteration, files=changed)
+    return result
+
+def route_load_note(function_name, function_args, reload_result):
+    # When a written route module fails to import or register, attach the error to its tool result instead of only printing it
+    if function_name not in ("create_file", "update_file", "apply_patch") or not isinstance(function_args, dict):
+        return ""
+    path = os.path.normpath(str(function_args.get("path", "")))
+    filename = os.path.basename(path)
+    if not filename.endswith('.py') or os.path.basename(os.path.dirname(path)) != 'routes':
+        return ""
+    error = reload_result["errors"].get(filename[:-3])
+    return f"\nRoute module routes/{filename} failed to load: {error}" if error else ""
+
+async def auto_smoke_test(job, messages, build_log, iteration):
+    # When this iteration changed files, run the smoke tests and add the result (failures in full) to messages for the next completion
+    try:
+        summary = await run_in_thread(smoke_test_summary)
+    except Exception as e:
+        build_log.append("error", iteration=iteration, action="smoke_tests", error=str(e))
+        return
+    build_log.append("smoke_tests", iteration=iteration, passed=summary["passed"], failed=summary["failed"],
+                     load_errors=summary["load_errors"])
+    emit_event(job, "smoke_tests", passed=summary["passed"], failed=summary["failed"])
+    messages.append({"role": "system", "content": f"Automatic smoke tests (after this iteration's file changes):\n{format_smoke_report(summary, verbose=False)}"})
+    return summary
+
+def compact_context(compactor, messages, build_log, iteration):
+    # Over the token budget, replace stale tool results with short stubs; the prefix messages stay byte-stable
+    with tracing.span("compaction") as span:
+        before, after = compactor.compact(messages)
+        if span is not None:
+            span.set(tokens_before=before, tokens_after=after)
+    if after < before:
+        build_log.append("compaction", iteration=iteration, tokens_before=before, tokens_after=after)
+    return after
+
+async def project_manifest_message(manifest, previous):
+    # The project manifest (file tree, sizes, content hashes, blueprints and URL rules, template references) is refreshed
+    # incrementally before every completion, re-analysing only changed files; an unchanged manifest reuses the previous message object
+    with tracing.span("project_manifest"):
+        text = await run_in_thread(manifest.render)
+    content = f"Current project manifest (updated every turn; path  size  content hash  blueprints/routes/template references):\n{text}"
+    if previous is not None and previous["content"] == content:
+        return previous
+    return {"role": "system", "content": content}
+
+def write_planned_file(path, content):
+    target = resolve_path(path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    return create_file(path, content)
+
+async def plan_and_generate(job, messages, build_log):
+    # The first completion returns a structured plan, then each file is generated by its own concurrent completion (sharing one prefix: system prompt, request and plan);
+    # the results go into messages and the iteration loop that follows does integration and review. Returns False for an unusable plan, and the build continues normally
+    with tracing.span("plan") as span:
         try:
-            response = completion(
+            response = await complete(
                 model=MODEL_NAME,
-                messages=messages,
-                tools=tools,
-                tool_choice="auto"
+                messages=messages + [{"role": "system", "content": "Do not write any files yet: call submit_plan with the complete implementation plan, listing every file and its purpose and the interfaces they share (blueprint names, URLs, templates, static files, form fields, etc.)."}],
+                tools=[plan_tool],
+                tool_choice={"type": "function", "function": {"name": "submit_plan"}}
             )
+            record_usage(job, response)
+            tool_calls = response.choices[0].message.tool_calls or []
+            plan = fanout.parse_plan(tool_calls[0].function.arguments if tool_calls else None)
+        except Exception as e:
+            build_log.append("error", action="plan", error=str(e))
+            emit_event(job, "error", action="plan", error=str(e))
+            return False
+        if span is not None:
+            span.set(files=len(plan["files"]))
+    build_log.append("plan", files=plan["files"], routes=plan["routes"], notes=plan["notes"], rejected=plan["rejected"])
+    emit_event(job, "plan", files=[file["path"] for file in plan["files"]])
+    plan_text = json.dumps(plan, ensure_ascii=False, indent=2)
+    prefix = [
+        {"role": "system", "content": "You are an expert Flask developer implementing a single file of a Flask application according to the given plan. "
+                                      "Follow the file paths, blueprint names, URLs, template names and other shared interfaces in the plan exactly, so the files fit together. "
+                                      "Route files must define a module-level Blueprint. Do not leave any placeholders."},
+        {"role": "user", "content": messages[1]["content"]},
+        {"role": "system", "content": f"Implementation plan:\n{plan_text}"}
+    ]
 
-            if not response.choices[0].message:
-                error = response.get('error', 'Unknown error')
-                current_iteration['errors'].append({'action': 'llm_completion', 'error': error})
-                log_to_file(history_dict)
-                sleep(5)
-                iteration += 1
-                continue
+    async def generate(file):
+        with tracing.span("generate_file", path=file["path"]):
+            response = await complete(
+                model=FAST_MODEL or MODEL_NAME,
+                messages=prefix + [{"role": "user", "content": f"Write {file['path']} ({file['purpose']}). Output only the complete file content, with no explanation and no Markdown code fence."}]
+            )
+            record_usage(job, response)
+            content = fanout.strip_code_fence(response.choices[0].message.content or "")
+            return await run_in_thread(write_planned_file, file["path"], content)
+
+    with tracing.span("fanout", files=len(plan["files"])):
+        results = await fanout.generate_files(plan["files"], generate)
+    lines = []
+    for file, result, error in results:
+        build_log.append("fanout_file", path=file["path"], result=result, error=error)
+        emit_event(job, "fanout_file", path=file["path"], result=result, error=error)
+        lines.append(f"- {file['path']}: {result if error is None else f'generation failed: {error}'}")
+    lines.extend(f"- not generated (invalid path): {rejected}" for rejected in plan["rejected"])
+    if current_workspace.get() is None:
+        await reload_generated_routes(build_log, 0)
+    messages.append({"role": "system", "content": f"Files were generated in parallel from this plan:\n{plan_text}\n\nResults:\n" + "\n".join(lines) +
+                     "\n\nThese files were generated separately. Check how they integrate (consistent blueprint names, URLs, template and static file references), "
+                     "add any missing or failed files, fix problems and test, then call task_completed()."})
+    if SMOKE_TEST_AUTO:
+        await auto_smoke_test(job, messages, build_log, 0)
+    return True
 
-            response_message = response.choices[0].message
-            content = response_message.content or ""
-            current_iteration['llm_responses'].append(content)
+async def _run_iterations(job, messages, build_log, checkpoint=None):
+    max_iterations = job["max_iterations"]  # Prevent infinite loops
+    iteration = 0
+    compactor = ContextCompactor(MODEL_NAME)
+    # The manifest is appended to each request but not stored in messages: the model always sees the current state and the message prefix stays stable
+    manifest = ProjectManifest(os.path.dirname(resolve_path(ROUTES_DIR)), read=file_cache.read)
+    manifest_note = None
+    # Model cascade: routine steps use the fast model, escalating to the strong one on validation failures, repeated errors or no progress; every decision goes to the build log
+    router = ModelRouter(MODEL_NAME)
+    outcome = iteration_note = None
+    if checkpoint is not None:
+        # Resuming from a checkpoint: the iteration count, model router state and last outcome carry over
+        iteration = checkpoint["iteration"]
+        router.restore(checkpoint.get("router") or {})
+        outcome = checkpoint.get("outcome")
+        if checkpoint.get("manifest") is not None:
+            manifest_note = iteration_note = {"role": "system", "content": checkpoint["manifest"]}
 
-            output += f"\n<h2>Iteration {iteration + 1}:</h2>\n"
+    while iteration < max_iterations:
+        with tracing.span("iteration", iteration=iteration + 1):
+            job["iteration"] = iteration + 1
+            build_log.append("iteration", iteration=iteration + 1)  # Start from 1
 
-            tool_calls = response_message.tool_calls
+            try:
+                manifest_note = await project_manifest_message(manifest, manifest_note)
+                if outcome is not None:
+                    # Outcome of the previous iteration: a changed manifest means files were modified
+                    router.observe(progress=manifest_note is not iteration_note, **outcome)
+                iteration_note = manifest_note
+                outcome = {"errors": 0, "validation_failures": 0}
+                model, tier, reason = router.choose()
+                build_log.append("model_route", iteration=iteration + 1, model=model, tier=tier, reason=reason)
+                if job.get("model") != model:
+                    job["model"] = model
+                    emit_event(job, "model_route", model=model, tier=tier, reason=reason)
+                prompt_tokens = compact_context(compactor, messages, build_log, iteration + 1)
+                response = await complete(
+                    model=model,
+                    estimated_tokens=prompt_tokens + compactor.message_tokens(manifest_note),
+                    messages=messages + [manifest_note],
+                    tools=tools,
+                    tool_choice="auto"
+                )
+                record_usage(job, response)
 
-            if tool_calls:
-                output += "<strong>Tool Call:</strong>\n<p>" + content + "</p>\n"
-                messages.append(response_message)
+                if not response.choices[0].message:
+                    error = response.get('error', 'Unknown error')
+                    build_log.append("error", iteration=iteration + 1, action="llm_completion", error=error)
+                    emit_event(job, "error", action="llm_completion", error=str(error))
+                    outcome["errors"] += 1
+                    # Same as an iteration that ends normally: checkpoint first, so a resumed build does not repeat it
+                    iteration += 1
+                    await checkpoint_build(job, messages, build_log, iteration, router, outcome, iteration_note)
+                    await flush_build_log(build_log)
+                    continue
 
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    function_to_call = available_functions.get(function_name)
+                response_message = response.choices[0].message
+                content = response_message.content or ""
+                build_log.append("llm_response", iteration=iteration + 1, content=content)
 
-                    if not function_to_call:
-                        error_message = f"Tool '{function_name}' is not available."
-                        current_iteration['errors'].append({
-                            'action': f'tool_call_{function_name}',
-                            'error': error_message,
-                            'traceback': 'No traceback available.'
-                        })
-                        continue
+                emit_event(job, "iteration", iteration=iteration + 1)
+
+                tool_calls = response_message.tool_calls
+
+                if tool_calls:
+                    emit_event(job, "tool_calls", content=content)
+                    messages.append(response_message)
+
+                    # Calls after task_completed are never run
+                    for index, tool_call in enumerate(tool_calls):
+                        if tool_call.function.name == "task_completed":
+                            tool_calls = tool_calls[:index + 1]
+                            break
+
+                    # Tool calls on different paths run concurrently on the thread pool, calls on the same path keep their order;
+                    # results are written back to messages in the original tool_call order
+                    parsed_calls = [parse_tool_call(tool_call) for tool_call in tool_calls]
+                    for tool_call, (function_name, function_args, _) in zip(tool_calls, parsed_calls):
+                        build_log.append("tool_call", iteration=iteration + 1, id=tool_call.id,
+                                         tool=function_name, arguments=function_args)
+                    with tracing.span("tool_calls", count=len(parsed_calls)):
+                        results = await run_tool_calls(
+                            [(function_name, function_args) for function_name, function_args, _ in parsed_calls],
+                            lambda index: traced_tool_call(*parsed_calls[index])
+                        )
+                    reload_result = None
+                    if current_workspace.get() is None:
+                        # Builds in a workspace do not touch the served routes; they are reloaded once on commit
+                        reload_result = await reload_generated_routes(build_log, iteration + 1)
 
-                    try:
-                        function_args = json.loads(tool_call.function.arguments)
+                    for tool_call, (function_name, function_args, _), (function_response, error) in zip(tool_calls, parsed_calls, results):
+                        if error:
+                            build_log.append("error", iteration=iteration + 1, **error)
+                            emit_event(job, "error", action=error['action'], error=error['error'])
+                            outcome["errors"] += 1
+                            # Every tool_call needs a matching tool message, otherwise every later completion request is rejected
+                            messages.append(
+                                {"tool_call_id": tool_call.id, "role": "tool", "name": function_name, "content": error['error']}
+                            )
+                            continue
 
-                        function_response = function_to_call(**function_args)
+                        load_note = route_load_note(function_name, function_args, reload_result) if reload_result else ""
+                        function_response += load_note
+                        if load_note or ROUTE_VALIDATION_FAILED in function_response:
+                            outcome["validation_failures"] += 1
 
-                        current_iteration['tool_results'].append({
-                            'tool': function_name,
-                            'result': function_response
-                        })
+                        build_log.append("tool_result", iteration=iteration + 1, tool=function_name, result=function_response)
 
-                        output += f"<strong>Tool Result ({function_name}):</strong>\n<p>{function_response}</p>\n"
+                        emit_event(job, "tool_result", tool=function_name, result=function_response)
 
                         messages.append(
                             {"tool_call_id": tool_call.id, "role": "tool", "name": function_name, "content": function_response}
                         )
 
                         if function_name == "task_completed":
-                            progress["status"] = "completed"
-                            progress["completed"] = True
-                            output += "\n<h2>COMPLETE</h2>\n"
-                            progress["output"] = output
-                            log_to_file(history_dict)
-                            return output
-
-                    except Exception as tool_error:
-                        error_message = f"Error executing {function_name}: {tool_error}"
-                        current_iteration['errors'].append({
-                            'action': f'tool_call_{function_name}',
-                            'error': error_message,
-                            'traceback': traceback.format_exc()
-                        })
-
-                second_response = completion(
-                    model=MODEL_NAME,
-                    messages=messages
-                )
-                if second_response.choices and second_response.choices[0].message:
-                    second_response_message = second_response.choices[0].message
-                    content = second_response_message.content or ""
-                    current_iteration['llm_responses'].append(content)
-                    output += "<strong>LLM Response:</strong>\n<p>" + content + "</p>\n"
-                    messages.append(second_response_message)
+                            return True
+
+                    if SMOKE_TEST_AUTO and any(
+                        function_name in FILE_WRITE_TOOLS and not error
+                        for (function_name, _, _), (_, error) in zip(parsed_calls, results)
+                    ) and not any(function_name == "run_smoke_tests" for function_name, _, _ in parsed_calls):
+                        summary = await auto_smoke_test(job, messages, build_log, iteration + 1)
+                        if summary is not None and (summary["failed"] or summary["load_errors"]):
+                            outcome["validation_failures"] += 1
+
+                    if not SINGLE_CALL_MODE:
+                        manifest_note = await project_manifest_message(manifest, manifest_note)
+                        prompt_tokens = compact_context(compactor, messages, build_log, iteration + 1)
+                        second_response = await complete(
+                            model=model,
+                            estimated_tokens=prompt_tokens + compactor.message_tokens(manifest_note),
+                            messages=messages + [manifest_note]
+                        )
+                        record_usage(job, second_response)
+                        if second_response.choices and second_response.choices[0].message:
+                            second_response_message = second_response.choices[0].message
+                            content = second_response_message.content or ""
+                            build_log.append("llm_response", iteration=iteration + 1, content=content)
+                            emit_event(job, "llm_response", content=content)
+                            messages.append(second_response_message)
+                        else:
+                            error = second_response.get('error', 'Unknown error in second LLM response.')
+                            build_log.append("error", iteration=iteration + 1, action="second_llm_completion", error=error)
+                            emit_event(job, "error", action="second_llm_completion", error=str(error))
+                            outcome["errors"] += 1
+
                 else:
-                    error = second_response.get('error', 'Unknown error in second LLM response.')
-                    current_iteration['errors'].append({'action': 'second_llm_completion', 'error': error})
+                    emit_event(job, "llm_response", content=content)
+                    messages.append(response_message)
 
-            else:
-                output += "<strong>LLM Response:</strong>\n<p>" + content + "</p>\n"
-                messages.append(response_message)
+            except Exception as e:
+                error = str(e)
+                build_log.append("error", iteration=iteration + 1, action="main_loop", error=error,
+                                 traceback=traceback.format_exc())
+                emit_event(job, "error", action="main_loop", error=error)
+                if outcome is not None:
+                    outcome["errors"] += 1
 
-            progress["output"] = output
+            iteration += 1
+            await checkpoint_build(job, messages, build_log, iteration, router, outcome, iteration_note)
+            # No fixed sleeps: throttling and backoff are handled by the shared rate_limiter
+            await flush_build_log(build_log)
 
-        except Exception as e:
-            error = str(e)
-            current_iteration['errors'].append({
-                'action': 'main_loop',
-                'error': error,
-                'traceback': traceback.format_exc()
-            })
+    return False
 
-        iteration += 1
-        log_to_file(history_dict)
-        sleep(2)
+async def run_speculative_build(user_input, job):
+    # Speculative build: run SPECULATIVE_CANDIDATES candidates in parallel, each in its own workspace;
+    # the first one to finish and pass validation is promoted into templates/, static/ and routes/, the rest are cancelled
+    build_log = BuildLog.for_job(job["id"])
+    job["log_file"] = build_log.path
+    build_log.append("build", user_input=user_input, model=MODEL_NAME, candidates=speculative.SPECULATIVE_CANDIDATES)
+    with tracing.start_trace(job["id"], "speculative_build", candidates=speculative.SPECULATIVE_CANDIDATES):
+        try:
+            committed = await speculative.run_candidates(user_input, job, run_main_loop_async, BASE_DIR,
+                                                         build_log=build_log)
+            if committed is None:
+                job["status"] = "error"
+                emit_event(job, "error", action="speculative_build", error="No candidate build passed validation.")
+                build_log.append("error", action="speculative_build", error="No candidate build passed validation.")
+            else:
+                await reload_generated_routes(build_log, job["iteration"])
+                job["status"] = "completed"
+                emit_event(job, "completed")
+            return job["events"]
+        finally:
+            await flush_build_log(build_log)
 
-    if iteration >= max_iterations:
-        progress["status"] = "completed"
+async def run_build(user_input, job):
+    if speculative.SPECULATIVE_CANDIDATES > 1:
+        return await run_speculative_build(user_input, job)
+    return await run_main_loop_async(user_input, job)
 
-    progress["completed"] = True
-    progress["status"] = "completed"
+def run_main_loop(user_input, job=None):
+    # Sync entry point: run the async main loop on the shared event loop and wait for the result
+    return event_loop.run_sync(run_main_loop_async(user_input, job))
 
-    return output
+build_engine = JobEngine(run_build, JobStore(JOB_STORE_PATH), max_iterations=MAX_ITERATIONS)
+# Each worker process starts its own dispatcher when it imports the app, claiming builds from the shared queue.
+# When run as python main.py, the smoke test and route validation pool workers import this script as __mp_main__; they do not claim builds
+if __name__ != '__mp_main__':
+    build_engine.start()
+metrics.builds_queued.set_function(lambda: build_engine.stats()["queued"])
+metrics.builds_active.set_function(lambda: build_engine.stats()["active"])
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,166 @@
+import math
+import bisect
+import threading
+
+# Minimal Prometheus instrumentation (text exposition format 0.0.4), enough for
+# the builder's own counters and histograms without another dependency. An
+# update is a dict lookup and a few additions under a per-metric lock.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Label values come partly from the model (tool names); past this many series a
+# metric folds new label combinations into a single "other" series
+MAX_SERIES = 200
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        if key not in self._series and len(self._series) >= MAX_SERIES:
+            key = ('other',) * len(self.labelnames)
+        return key
+
+    def render(self):
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value):
+        return [f'{self.name}{_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    # Either set() explicitly, or read from a callback at scrape time
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            try:
+                self.set(self._function())
+            except Exception:
+                pass
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket (not cumulative) counts, then sum and count
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def _render_series(self, key, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), series):
+            cumulative += count
+            extra = (('le', _format_value(bound)),)
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, extra)} {cumulative}')
+        labels = _labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(series[-2])}')
+        lines.append(f'{self.name}_count{labels} {series[-1]}')
+        return lines
+
+
+registry = []
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+llm_completion_seconds = Histogram(
+    'builder_llm_completion_seconds', 'Latency of LLM completions, including rate-limit waits and retries',
+    ('model', 'source')
+)
+llm_tokens = Counter('builder_llm_tokens_total', 'Tokens used by LLM completions', ('model', 'kind'))
+tool_call_seconds = Histogram(
+    'builder_tool_call_seconds', 'Latency of tool calls', ('tool',),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+build_iterations = Histogram(
+    'builder_build_iterations', 'Iterations per finished build', ('status',),
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 50)
+)
+builds = Counter('builder_builds_total', 'Finished builds', ('status',))
+builds_queued = Gauge('builder_builds_queued', 'Builds waiting for a free slot')
+builds_active = Gauge('builder_builds_active', 'Builds currently running')
+errors = Counter('builder_errors_total', 'Errors reported by builds', ('action',))
+file_cache_reads = Counter('builder_file_cache_reads_total', 'Reads of generated files through the content cache',
+                           ('result',))
+static_responses = Counter('builder_static_responses_total', 'Responses served from the static file index',
+                           ('status', 'encoding'))
+route_reload_seconds = Histogram(
+    'builder_route_reload_seconds', 'Time to rescan routes/ and swap in the generated app', ('swapped',),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
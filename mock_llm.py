@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import contextvars
+
+from litellm import ModelResponse
+
+# Content of the tool-less follow-up call made when SINGLE_CALL_MODE=0;
+# these turns are not part of the script and do not advance it
+COMMENTARY = "[mock] 已收到工具结果。"
+
+# Per-build counters, set by whoever drives the build (see bench.py)
+current_stats = contextvars.ContextVar('mock_llm_stats', default=None)
+
+
+def _role(message):
+    return message.get("role") if isinstance(message, dict) else getattr(message, "role", None)
+
+
+def _content(message):
+    return message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
+
+
+def _estimate_tokens(value):
+    return max(1, len(json.dumps(value, ensure_ascii=False, default=str)) // 4)
+
+
+def turn(content="", *tool_calls):
+    # turn("text", ("create_file", {"path": ..., "content": ...}), ...)
+    return {"content": content, "tool_calls": [{"name": name, "arguments": args} for name, args in tool_calls]}
+
+
+class ScriptedLLM:
+    # Deterministic stand-in for litellm.completion/acompletion. Each
+    # conversation (keyed by its user prompt) follows a script of turns; the
+    # turn is picked from the conversation itself, so concurrent builds and
+    # replays always see the same answers. Latency is injected with a seeded
+    # jitter so runs are reproducible.
+
+    def __init__(self, scripts, latency=0.0, jitter=0.0, seconds_per_token=0.0, seed=0, default=None):
+        self.scripts = scripts
+        self.default = default
+        self.latency = latency
+        self.jitter = jitter
+        self.seconds_per_token = seconds_per_token
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.llm_seconds = 0.0
+
+    def supports_function_calling(self, model):
+        return True
+
+    def _script(self, messages):
+        prompt = next((_content(m) for m in messages if _role(m) == "user"), None)
+        script = self.scripts.get(prompt, self.default)
+        if script is None:
+            raise KeyError(f"no mock script for prompt {prompt!r}")
+        return script
+
+    def _respond(self, model, messages, tools):
+        if tools is None:
+            return {"content": COMMENTARY, "tool_calls": []}
+        script = self._script(messages)
+        position = sum(1 for m in messages if _role(m) == "assistant" and _content(m) != COMMENTARY)
+        if position < len(script):
+            return script[position]
+        return turn("", ("task_completed", {}))
+
+    def _build_response(self, model, messages, scripted, position):
+        tool_calls = [
+            {"id": f"call_{position}_{index}", "type": "function",
+             "function": {"name": call["name"], "arguments": json.dumps(call["arguments"], ensure_ascii=False)}}
+            for index, call in enumerate(scripted["tool_calls"])
+        ]
+        message = {"role": "assistant", "content": scripted["content"] or None}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        prompt_tokens = _estimate_tokens([m for m in messages])
+        completion_tokens = _estimate_tokens(message)
+        return ModelResponse(
+            id=f"mock-{position}",
+            model=model,
+            choices=[{"index": 0, "finish_reason": "tool_calls" if tool_calls else "stop", "message": message}],
+            usage={"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                   "total_tokens": prompt_tokens + completion_tokens}
+        )
+
+    def _prepare(self, model, messages, tools):
+        scripted = self._respond(model, messages, tools)
+        position = sum(1 for m in messages if _role(m) == "assistant")
+        response = self._build_response(model, messages, scripted, position)
+        delay = self.latency + self.seconds_per_token * response.usage.completion_tokens
+        if self.jitter:
+            delay += self._random.uniform(0, self.jitter)
+        return response, delay
+
+    def _record(self, response, delay):
+        self.calls += 1
+        self.prompt_tokens += response.usage.prompt_tokens
+        self.completion_tokens += response.usage.completion_tokens
+        self.llm_seconds += delay
+        stats = current_stats.get()
+        if stats is not None:
+            stats["llm_calls"] = stats.get("llm_calls", 0) + 1
+            stats["llm_seconds"] = stats.get("llm_seconds", 0.0) + delay
+
+    def completion(self, model, messages, tools=None, **kwargs):
+        response, delay = self._prepare(model, messages, tools)
+        time.sleep(delay)
+        self._record(response, delay)
+        return response
+
+    async def acompletion(self, model, messages, tools=None, **kwargs):
+        response, delay = self._prepare(model, messages, tools)
+        await asyncio.sleep(delay)
+        self._record(response, delay)
+        return response
+
+    @classmethod
+    def from_log(cls, path, **kwargs):
+        # Replays a recorded session: a JSONL build log (which records tool
+        # arguments) or an old flask_app_builder_log.json (which only has tool
+        # names and results, so arguments are reconstructed from the results)
+        prompt, script = load_script(path)
+        return cls({prompt: script}, default=script, **kwargs), prompt
+
+
+RESULT_PATH = re.compile(r'[:：]\s*(\S+)\s*$')
+
+
+def _arguments_from_result(tool, result):
+    match = RESULT_PATH.search(result or "")
+    path = match.group(1) if match else f"replay_{tool}.txt"
+    if tool == "fetch_code":
+        return {"file_path": path}
+    if tool == "create_directory":
+        return {"path": path}
+    if tool in ("create_file", "update_file"):
+        return {"path": path, "content": f"# replayed {tool} for {path}\n"}
+    return {}
+
+
+def load_script(path):
+    if path.endswith('.jsonl'):
+        # Imported here: build_log reads BUILD_LOG_DIR at import time
+        from build_log import current_records
+
+        prompt, script, answered = None, [], True
+        for record in current_records(path):
+            if record["type"] == "build":
+                prompt = record.get("user_input")
+            elif record["type"] == "iteration":
+                script.append(turn(""))
+                answered = False
+            elif record["type"] == "llm_response" and script and not answered:
+                # Only the first response of an iteration; later ones are commentary
+                script[-1]["content"] = record.get("content", "")
+                answered = True
+            elif record["type"] == "tool_call" and script:
+                script[-1]["tool_calls"].append({"name": record["tool"], "arguments": record.get("arguments") or {}})
+        return prompt, script
+
+    with open(path, encoding='utf-8') as f:
+        history = json.load(f)
+    script = []
+    for iteration in history.get("iterations", []):
+        responses = iteration.get("llm_responses") or [""]
+        calls = [
+            {"name": result["tool"], "arguments": _arguments_from_result(result["tool"], result.get("result"))}
+            for result in iteration.get("tool_results", [])
+        ]
+        script.append({"content": responses[0], "tool_calls": calls})
+    return os.path.basename(path), script
@@ -0,0 +1,88 @@
+import os
+
+# Model for routine tool-driven steps. Unset disables the cascade: every call
+# goes to the strong model (LITELLM_MODEL).
+FAST_MODEL = os.environ.get('LITELLM_FAST_MODEL') or None
+# Use the strong model for the first turn, where the app gets planned
+ROUTER_PLAN_WITH_STRONG = os.environ.get('ROUTER_PLAN_WITH_STRONG', '1') != '0'
+# Escalate after this many validation failures in one iteration (static route
+# validation, route load errors, failing smoke tests); 0 disables the rule
+ROUTER_ESCALATE_ON_VALIDATION = int(os.environ.get('ROUTER_ESCALATE_ON_VALIDATION', '1'))
+# ... after this many consecutive iterations with errors; 0 disables the rule
+ROUTER_ESCALATE_AFTER_ERRORS = int(os.environ.get('ROUTER_ESCALATE_AFTER_ERRORS', '2'))
+# ... after this many consecutive iterations that changed no files; 0 disables the rule
+ROUTER_ESCALATE_AFTER_IDLE = int(os.environ.get('ROUTER_ESCALATE_AFTER_IDLE', '3'))
+# Clean iterations on the strong model before handing back to the fast one;
+# 0 keeps the strong model for the rest of the build once escalated
+ROUTER_STRONG_TURNS = int(os.environ.get('ROUTER_STRONG_TURNS', '2'))
+
+# Attributes that change while a build runs; saved in build checkpoints
+ROUTER_STATE = ("error_streak", "idle_streak", "escalated", "reason", "clean_turns")
+
+
+class ModelRouter:
+    # Picks the model for each iteration of one build. Starts on the fast
+    # model (after an optional single strong planning turn), escalates to the
+    # strong model when the build runs into trouble and drops back once it has
+    # made ROUTER_STRONG_TURNS clean iterations there.
+
+    def __init__(self, strong, fast=FAST_MODEL, plan_with_strong=ROUTER_PLAN_WITH_STRONG,
+                 escalate_on_validation=ROUTER_ESCALATE_ON_VALIDATION,
+                 escalate_after_errors=ROUTER_ESCALATE_AFTER_ERRORS,
+                 escalate_after_idle=ROUTER_ESCALATE_AFTER_IDLE, strong_turns=ROUTER_STRONG_TURNS):
+        self.strong = strong
+        self.fast = fast if fast and fast != strong else None
+        self.escalate_on_validation = escalate_on_validation
+        self.escalate_after_errors = escalate_after_errors
+        self.escalate_after_idle = escalate_after_idle
+        self.strong_turns = strong_turns
+        self.error_streak = 0
+        self.idle_streak = 0
+        self.escalated = plan_with_strong
+        self.reason = "plan" if plan_with_strong else "default"
+        self.clean_turns = 0
+
+    @property
+    def models(self):
+        return [model for model in (self.fast, self.strong) if model]
+
+    def state(self):
+        return {key: getattr(self, key) for key in ROUTER_STATE}
+
+    def restore(self, state):
+        for key in ROUTER_STATE:
+            if key in state:
+                setattr(self, key, state[key])
+
+    def choose(self):
+        # Returns (model, tier, reason) for the next completion
+        if self.fast is None:
+            return self.strong, "strong", "single_model"
+        if self.escalated:
+            return self.strong, "strong", self.reason
+        return self.fast, "fast", self.reason
+
+    def observe(self, errors=0, validation_failures=0, progress=False):
+        # Outcome of the iteration that just finished
+        self.error_streak = self.error_streak + 1 if errors else 0
+        self.idle_streak = 0 if progress else self.idle_streak + 1
+        trigger = None
+        if self.escalate_on_validation and validation_failures >= self.escalate_on_validation:
+            trigger = "validation_failed"
+        elif self.escalate_after_errors and self.error_streak >= self.escalate_after_errors:
+            trigger = "repeated_errors"
+        elif self.escalate_after_idle and self.idle_streak >= self.escalate_after_idle:
+            trigger = "no_progress"
+
+        if trigger is not None:
+            # Each escalation gets a fresh window; the streaks start over on the strong model
+            self.escalated, self.reason, self.clean_turns = True, trigger, 0
+            self.error_streak = self.idle_streak = 0
+        elif self.escalated:
+            self.clean_turns += 1
+            if self.reason == "plan":
+                self.escalated, self.reason = False, "routine"
+            elif self.strong_turns and self.clean_turns >= self.strong_turns:
+                self.escalated, self.reason = False, "recovered"
+        else:
+            self.reason = "routine"
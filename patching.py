@@ -0,0 +1,105 @@
+import re
+import hashlib
+
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+
+
+class PatchConflict(Exception):
+    pass
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def parse_unified_diff(diff):
+    hunks = []
+    current = None
+    # Old and new lines the current hunk header still promises. While either
+    # is left, '--- ' and '+++ ' lines are removals and additions, not file
+    # headers. Lines past a miscounted hunk still count as part of it.
+    old_left = new_left = 0
+    lines = diff.splitlines()
+    for index, line in enumerate(lines):
+        if line.startswith('@@'):
+            match = HUNK_HEADER.match(line)
+            if not match:
+                raise PatchConflict(f"invalid hunk header: {line!r}")
+            old_left = int(match.group(2)) if match.group(2) is not None else 1
+            new_left = int(match.group(3)) if match.group(3) is not None else 1
+            current = {"start": int(match.group(1)), "old_count": old_left, "old": [], "new": []}
+            hunks.append(current)
+        elif current is None or line.startswith('\\'):
+            # File headers before the first hunk, "\ No newline at end of file"
+            continue
+        elif old_left <= 0 and new_left <= 0 and line.startswith('--- ') and \
+                index + 1 < len(lines) and lines[index + 1].startswith('+++ '):
+            current = None
+        elif line.startswith('-'):
+            current["old"].append(line[1:])
+            old_left -= 1
+        elif line.startswith('+'):
+            current["new"].append(line[1:])
+            new_left -= 1
+        else:
+            # Context line; some tools strip the leading space from blank lines
+            current["old"].append(line[1:])
+            current["new"].append(line[1:])
+            old_left -= 1
+            new_left -= 1
+    return hunks
+
+
+def _find_block(lines, block, expected, start):
+    # Exact match nearest to the expected line first, then ignoring trailing whitespace
+    candidates = sorted(range(start, len(lines) - len(block) + 1), key=lambda i: abs(i - expected))
+    for normalize in (lambda s: s, lambda s: s.rstrip()):
+        wanted = [normalize(s) for s in block]
+        for i in candidates:
+            if [normalize(s) for s in lines[i:i + len(block)]] == wanted:
+                return i
+    return None
+
+
+def apply_unified_diff(text, diff):
+    hunks = parse_unified_diff(diff)
+    if not hunks:
+        raise PatchConflict("the patch contains no hunks (expected lines starting with '@@ -l,s +l,s @@')")
+    lines = text.splitlines()
+    offset = 0
+    position = 0
+    for number, hunk in enumerate(hunks, 1):
+        # A hunk without old lines (@@ -l,0 ...) inserts after line l, not at it
+        expected = max(0, hunk["start"] - (0 if hunk["old_count"] == 0 else 1) + offset)
+        if hunk["old"]:
+            index = _find_block(lines, hunk["old"], expected, position)
+            if index is None:
+                preview = "\n".join(hunk["old"][:10])
+                raise PatchConflict(
+                    f"hunk {number} (@@ -{hunk['start']}) does not apply: these lines were not found "
+                    f"in the current file:\n{preview}"
+                )
+        else:
+            index = min(max(expected, position), len(lines))
+        lines[index:index + len(hunk["old"])] = hunk["new"]
+        offset += len(hunk["new"]) - len(hunk["old"])
+        position = index + len(hunk["new"])
+    result = "\n".join(lines)
+    if text.endswith("\n") or not text:
+        result += "\n"
+    return result
+
+
+def apply_search_replace(text, edits):
+    for number, edit in enumerate(edits, 1):
+        search = edit.get("search")
+        replace = edit.get("replace", "")
+        if not search:
+            raise PatchConflict(f"edit {number} has an empty 'search' block")
+        count = text.count(search)
+        if count == 0:
+            raise PatchConflict(f"edit {number}: the 'search' block was not found in the current file:\n{search[:500]}")
+        if count > 1:
+            raise PatchConflict(f"edit {number}: the 'search' block matches {count} places; include more surrounding lines")
+        text = text.replace(search, replace, 1)
+    return text
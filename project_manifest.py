@@ -0,0 +1,136 @@
+import os
+import re
+import hashlib
+
+from route_validation import analyze_route_source
+from workspace import WORKSPACE_DIRS
+
+# Rendered manifests longer than this list the remaining files by name only
+MANIFEST_MAX_CHARS = int(os.environ.get('MANIFEST_MAX_CHARS', '12000'))
+
+TEMPLATE_TAG = re.compile(r"""\{%-?\s*(?:extends|include|import|from)\s+['"]([^'"]+)['"]""")
+RENDER_TEMPLATE = re.compile(r"""render_template\(\s*['"]([^'"]+)['"]""")
+URL_FOR = re.compile(r"""url_for\(\s*['"]([^'"]+)['"](?:\s*,\s*filename\s*=\s*['"]([^'"]+)['"])?""")
+STATIC_URL = re.compile(r"""(?:src|href)\s*=\s*['"]/static/([^'"?#]+)""")
+
+
+def _read_text(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def _signature(stat):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _unique(values):
+    return list(dict.fromkeys(values))
+
+
+def template_references(content):
+    # {"templates": [...], "static": [...], "endpoints": [...]} referenced by a Jinja template
+    static, endpoints = list(STATIC_URL.findall(content)), []
+    for endpoint, filename in URL_FOR.findall(content):
+        if endpoint == 'static':
+            if filename:
+                static.append(filename)
+        else:
+            endpoints.append(endpoint)
+    return {"templates": _unique(TEMPLATE_TAG.findall(content)), "static": _unique(static),
+            "endpoints": _unique(endpoints)}
+
+
+def describe_file(relative, content):
+    # Size, short content hash and, for route modules and templates, what
+    # they define and reference. content is bytes for non-text files.
+    data = content.encode('utf-8') if isinstance(content, str) else content
+    entry = {"path": relative, "size": len(data), "hash": hashlib.sha256(data).hexdigest()[:12]}
+    if not isinstance(content, str):
+        return entry
+    top = relative.split(os.sep)[0]
+    if top == 'routes' and relative.endswith('.py') and os.path.basename(relative) != '__init__.py':
+        summary = analyze_route_source(content, relative)
+        entry["errors"] = [error.get("message") or error["type"] for error in summary["errors"]]
+        entry["blueprints"] = [blueprint["name"] for blueprint in summary["blueprints"] if blueprint["name"]]
+        entry["routes"] = [f"{'/'.join(route['methods'])} {route['rule']}" for route in summary["routes"]]
+        entry["templates"] = _unique(RENDER_TEMPLATE.findall(content))
+    elif top == 'templates':
+        entry.update(template_references(content))
+    return entry
+
+
+class ProjectManifest:
+    # Incrementally maintained index of templates/, static/ and routes/ under
+    # root. refresh() walks the tree and re-describes only files whose
+    # (inode, mtime, size) changed, so rebuilding it every turn costs one stat
+    # per file. `read` may be a caching reader such as FileCache.read.
+
+    def __init__(self, root, read=_read_text, dirs=WORKSPACE_DIRS):
+        self.root = root
+        self.read = read
+        self.dirs = dirs
+        self._entries = {}
+
+    def _load(self, path):
+        try:
+            return self.read(path)
+        except UnicodeDecodeError:
+            with open(path, 'rb') as f:
+                return f.read()
+
+    def refresh(self):
+        # Returns the entries sorted by path
+        seen = set()
+        for directory in self.dirs:
+            for current, subdirs, files in os.walk(os.path.join(self.root, directory)):
+                subdirs[:] = sorted(d for d in subdirs if d != '__pycache__' and not d.startswith('.'))
+                for filename in files:
+                    if filename.startswith('.'):
+                        continue
+                    path = os.path.join(current, filename)
+                    relative = os.path.relpath(path, self.root)
+                    try:
+                        signature = _signature(os.stat(path))
+                        cached = self._entries.get(relative)
+                        if cached is None or cached[0] != signature:
+                            self._entries[relative] = (signature, describe_file(relative, self._load(path)))
+                    except OSError:
+                        continue
+                    seen.add(relative)
+        for relative in set(self._entries) - seen:
+            del self._entries[relative]
+        return [self._entries[relative][1] for relative in sorted(self._entries)]
+
+    def render(self, max_chars=MANIFEST_MAX_CHARS):
+        # Compact text form, one line per file, grouped by top-level directory
+        entries = self.refresh()
+        existing = {entry["path"].replace(os.sep, '/') for entry in entries}
+
+        def referenced(directory, names):
+            # References to files that do not exist are marked, so the model does not have to look
+            return ", ".join(name if f"{directory}/{name}" in existing else f"{name} (missing)" for name in names)
+
+        lines = []
+        used = 0
+        for index, entry in enumerate(entries):
+            parts = [entry["path"], f"{entry['size']}B", entry["hash"]]
+            if entry.get("errors"):
+                parts.append("errors: " + "; ".join(entry["errors"]))
+            if entry.get("blueprints"):
+                parts.append("blueprints: " + ", ".join(entry["blueprints"]))
+            if entry.get("routes"):
+                parts.append("routes: " + ", ".join(entry["routes"]))
+            if entry.get("templates"):
+                parts.append("templates: " + referenced('templates', entry["templates"]))
+            if entry.get("static"):
+                parts.append("static: " + referenced('static', entry["static"]))
+            if entry.get("endpoints"):
+                parts.append("url_for: " + ", ".join(entry["endpoints"]))
+            line = "  ".join(parts)
+            if used + len(line) > max_chars:
+                rest = entries[index:]
+                lines.append(f"... {len(rest)} more: " + ", ".join(e["path"] for e in rest))
+                break
+            lines.append(line)
+            used += len(line) + 1
+        return "\n".join(lines) if lines else "(no files yet)"
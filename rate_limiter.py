@@ -0,0 +1,197 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import tracing
+from litellm import RateLimitError, ServiceUnavailableError, APIConnectionError, Timeout, InternalServerError
+
+# Requests and tokens per minute for every model, unless overridden per model
+# in LLM_RATE_LIMITS, e.g. '{"gpt-4o-mini": {"rpm": 500, "tpm": 200000}}'. 0 means unlimited.
+LLM_RPM_LIMIT = int(os.environ.get('LLM_RPM_LIMIT', '0'))
+LLM_TPM_LIMIT = int(os.environ.get('LLM_TPM_LIMIT', '0'))
+LLM_RATE_LIMITS = json.loads(os.environ.get('LLM_RATE_LIMITS', '{}') or '{}')
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '6'))
+LLM_BACKOFF_BASE = float(os.environ.get('LLM_BACKOFF_BASE', '1.0'))
+LLM_BACKOFF_MAX = float(os.environ.get('LLM_BACKOFF_MAX', '60'))
+
+RETRYABLE_ERRORS = (RateLimitError, ServiceUnavailableError, APIConnectionError, Timeout, InternalServerError)
+
+WINDOW = 60.0
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+
+
+def parse_duration(value):
+    # Accepts seconds ("2", "1.5"), Go-style durations ("6m0s", "20ms") and HTTP dates
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if parts and "".join(n + u for n, u in parts) == value:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(n) * scale[u] for n, u in parts)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _headers(source):
+    headers = {}
+    for candidate in (
+        getattr(getattr(source, 'response', None), 'headers', None),
+        getattr(source, 'litellm_response_headers', None),
+        getattr(source, 'headers', None),
+        (getattr(source, '_hidden_params', None) or {}).get('additional_headers')
+    ):
+        if candidate:
+            try:
+                headers.update({str(k).lower(): v for k, v in dict(candidate).items()})
+            except (TypeError, ValueError):
+                continue
+    # litellm prefixes passed-through provider headers with "llm_provider-"
+    return {k[len('llm_provider-'):] if k.startswith('llm_provider-') else k: v for k, v in headers.items()}
+
+
+def retry_after(error):
+    headers = _headers(error)
+    if 'retry-after-ms' in headers:
+        delay = parse_duration(headers['retry-after-ms'])
+        return delay / 1000 if delay is not None else None
+    return parse_duration(headers.get('retry-after'))
+
+
+class _ModelState:
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = deque()  # [timestamp, tokens] per request in the last minute
+        self.blocked_until = 0.0
+
+    def prune(self, now):
+        while self.window and now - self.window[0][0] >= WINDOW:
+            self.window.popleft()
+
+
+class RateLimitScheduler:
+    # Shared by every build in the process: tracks requests and tokens per
+    # minute for each model, waits only when a limit or a provider
+    # retry-after signal says so, and retries throttled or transient failures
+    # with jittered exponential backoff.
+
+    def __init__(self, rpm=LLM_RPM_LIMIT, tpm=LLM_TPM_LIMIT, limits=LLM_RATE_LIMITS,
+                 max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.limits = limits
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.throttled = 0
+        self.retries = 0
+        self.waited = 0.0
+        self._models = {}
+
+    def _state(self, model):
+        state = self._models.get(model)
+        if state is None:
+            limits = self.limits.get(model, {})
+            state = self._models[model] = _ModelState(limits.get('rpm', self.rpm), limits.get('tpm', self.tpm))
+        return state
+
+    def _delay(self, state, tokens, now):
+        state.prune(now)
+        delay = state.blocked_until - now
+        if state.rpm and len(state.window) >= state.rpm:
+            delay = max(delay, state.window[len(state.window) - state.rpm][0] + WINDOW - now)
+        if state.tpm and state.window:
+            used = sum(entry[1] for entry in state.window)
+            excess = used + tokens - state.tpm
+            for timestamp, entry_tokens in state.window:
+                if excess <= 0:
+                    break
+                delay = max(delay, timestamp + WINDOW - now)
+                excess -= entry_tokens
+        return delay
+
+    async def acquire(self, model, tokens=0):
+        state = self._state(model)
+        while True:
+            now = time.monotonic()
+            delay = self._delay(state, tokens, now)
+            if delay <= 0:
+                entry = [now, tokens]
+                state.window.append(entry)
+                return entry
+            self.waited += delay
+            with tracing.span("rate_limit_wait", model=model, seconds=round(delay, 3)):
+                await asyncio.sleep(delay)
+
+    def block(self, model, seconds):
+        state = self._state(model)
+        state.blocked_until = max(state.blocked_until, time.monotonic() + seconds)
+
+    def observe(self, model, entry, response):
+        # Replace the token estimate with real usage, and honour provider
+        # "remaining: 0" headers before the next request hits the wall
+        usage = getattr(response, 'usage', None)
+        total = getattr(usage, 'total_tokens', None) if usage else None
+        if total:
+            entry[1] = total
+        headers = _headers(response)
+        for kind in ('requests', 'tokens'):
+            if str(headers.get(f'x-ratelimit-remaining-{kind}', '')).strip() == '0':
+                reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                if reset:
+                    self.block(model, reset)
+
+    def backoff(self, attempt, error):
+        delay = retry_after(error)
+        if delay is None:
+            # Full jitter: uniform between 0 and the exponential cap
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return min(delay, self.backoff_max)
+
+    async def call(self, model, tokens, request):
+        # request: zero-argument coroutine function performing one completion
+        attempt = 0
+        while True:
+            entry = await self.acquire(model, tokens)
+            try:
+                response = await request()
+            except RETRYABLE_ERRORS as error:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt, error)
+                if isinstance(error, RateLimitError):
+                    self.throttled += 1
+                    # Every build using this model waits in acquire(), not just this one
+                    self.block(model, delay)
+                else:
+                    with tracing.span("retry_backoff", model=model, seconds=round(delay, 3), error=type(error).__name__):
+                        await asyncio.sleep(delay)
+                self.retries += 1
+                attempt += 1
+                continue
+            self.observe(model, entry, response)
+            return response
+
+    def stats(self):
+        return {
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "waited_seconds": round(self.waited, 3),
+            "models": {
+                model: {"requests_last_minute": len(state.window),
+                        "tokens_last_minute": sum(entry[1] for entry in state.window)}
+                for model, state in self._models.items()
+            }
+        }
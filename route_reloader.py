@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import types
+import hashlib
+import importlib
+import threading
+
+from flask import Flask, Blueprint
+from werkzeug.exceptions import NotFound, MethodNotAllowed
+from werkzeug.routing import RequestRedirect
+
+# Seconds between checks for route files changed by builds in other worker
+# processes; 0 disables the check
+ROUTE_CHECK_INTERVAL = float(os.environ.get('ROUTE_CHECK_INTERVAL', '2'))
+
+
+class RouteIndex:
+    # module name -> (mtime_ns, size, sha256) of every route file seen so far
+
+    def __init__(self):
+        self.entries = {}
+
+    def scan(self, routes_dir):
+        # Returns (changed, removed): changed maps module name -> (path, source)
+        changed = {}
+        seen = set()
+        for filename in sorted(os.listdir(routes_dir)):
+            if not filename.endswith('.py') or filename == '__init__.py':
+                continue
+            name = filename[:-3]
+            path = os.path.join(routes_dir, filename)
+            seen.add(name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entry = self.entries.get(name)
+            if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                continue
+            with open(path, 'rb') as f:
+                source = f.read()
+            digest = hashlib.sha256(source).hexdigest()
+            if entry and entry[2] == digest:
+                # Touched but identical: remember the new mtime, nothing to reload
+                self.entries[name] = (stat.st_mtime_ns, stat.st_size, digest)
+                continue
+            changed[name] = (path, source, (stat.st_mtime_ns, stat.st_size, digest))
+        removed = [name for name in self.entries if name not in seen]
+        return changed, removed
+
+
+class RouteReloader:
+    # Loads the blueprints in routes/ into a separate Flask app for the
+    # generated routes. Only modules whose content hash changed are
+    # re-executed; the new app is built off to the side and swapped in with a
+    # single assignment, so in-flight requests finish on the app they started on.
+    # `setup`, if given, is called with every new app before it is swapped in.
+
+    def __init__(self, routes_dir, package='routes', app_kwargs=None, setup=None):
+        self.routes_dir = routes_dir
+        self.package = package
+        self.app_kwargs = app_kwargs or {}
+        self.setup = setup
+        self.index = RouteIndex()
+        self.blueprints = {}
+        self.load_errors = {}
+        self.register_errors = {}
+        self.app = self._build_app()
+        self._lock = threading.Lock()
+
+    @property
+    def errors(self):
+        return {**self.register_errors, **self.load_errors}
+
+    def _build_app(self):
+        app = Flask('generated_routes', **self.app_kwargs)
+        if self.setup is not None:
+            self.setup(app)
+        self.register_errors = {}
+        for name in sorted(self.blueprints):
+            for blueprint in self.blueprints[name]:
+                try:
+                    app.register_blueprint(blueprint)
+                except Exception as e:
+                    self.register_errors[name] = f"{type(e).__name__}: {e}"
+        return app
+
+    def _load_module(self, name, path, source):
+        # Execute the new source into a fresh module object and only publish it
+        # once it imports cleanly; a broken edit leaves the previous version live.
+        # Compiling the source directly also sidesteps stale .pyc files when an
+        # edit keeps the same mtime and size.
+        module_name = f'{self.package}.{name}'
+        module = types.ModuleType(module_name)
+        module.__file__ = path
+        module.__package__ = self.package
+        code = compile(source, path, 'exec')
+        previous = sys.modules.get(module_name)
+        sys.modules[module_name] = module
+        try:
+            exec(code, module.__dict__)
+        except BaseException:
+            if previous is not None:
+                sys.modules[module_name] = previous
+            else:
+                sys.modules.pop(module_name, None)
+            raise
+        return [attr for attr in vars(module).values() if isinstance(attr, Blueprint)]
+
+    def reload(self):
+        # Returns a summary dict: reloaded/removed module names and errors
+        with self._lock:
+            base_dir = os.path.dirname(self.routes_dir)
+            if base_dir not in sys.path:
+                sys.path.append(base_dir)
+            importlib.invalidate_caches()
+            if self.package not in sys.modules:
+                importlib.import_module(self.package)
+            changed, removed = self.index.scan(self.routes_dir)
+            if not changed and not removed:
+                return {"reloaded": [], "removed": [], "errors": self.errors, "swapped": False}
+
+            for name in removed:
+                self.index.entries.pop(name, None)
+                self.blueprints.pop(name, None)
+                self.load_errors.pop(name, None)
+                sys.modules.pop(f'{self.package}.{name}', None)
+
+            reloaded = []
+            for name, (path, source, entry) in changed.items():
+                self.index.entries[name] = entry
+                try:
+                    self.blueprints[name] = self._load_module(name, path, source)
+                    self.load_errors.pop(name, None)
+                    reloaded.append(name)
+                except Exception as e:
+                    self.load_errors[name] = f"{type(e).__name__}: {e}"
+
+            self.app = self._build_app()
+            return {"reloaded": reloaded, "removed": removed, "errors": self.errors, "swapped": True}
+
+
+class RouteDispatcher:
+    # WSGI middleware: requests the builder app itself routes go to it,
+    # everything else goes to whatever generated app is current.
+
+    def __init__(self, builder_app, builder_wsgi_app, reloader, check_interval=ROUTE_CHECK_INTERVAL):
+        self.builder_app = builder_app
+        self.builder_wsgi_app = builder_wsgi_app
+        self.reloader = reloader
+        self.check_interval = check_interval
+        self._checked = time.monotonic()
+
+    def __call__(self, environ, start_response):
+        adapter = self.builder_app.url_map.bind_to_environ(environ)
+        try:
+            adapter.match()
+        except NotFound:
+            self._check_for_changes()
+            return self.reloader.app.wsgi_app(environ, start_response)
+        except (MethodNotAllowed, RequestRedirect):
+            pass
+        return self.builder_wsgi_app(environ, start_response)
+
+    def _check_for_changes(self):
+        # Builds finishing in another worker process commit route files this
+        # process has not loaded; an unchanged routes/ costs a few stats
+        now = time.monotonic()
+        if not self.check_interval or now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            self.reloader.reload()
+        except Exception:
+            pass
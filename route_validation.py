@@ -0,0 +1,217 @@
+import os
+import re
+import ast
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from worker_processes import process_context
+
+# Worker processes for parsing/compiling route files; 0 checks inline
+ROUTE_VALIDATION_WORKERS = int(os.environ.get('ROUTE_VALIDATION_WORKERS', str(min(4, os.cpu_count() or 1))))
+ROUTE_VALIDATION_TIMEOUT = float(os.environ.get('ROUTE_VALIDATION_TIMEOUT', '10'))
+# Registered at import, before any pool starts the fork server
+WORKER_CONTEXT = process_context(__name__)
+
+ROUTE_SHORTCUTS = {'get': 'GET', 'post': 'POST', 'put': 'PUT', 'delete': 'DELETE', 'patch': 'PATCH'}
+IMPLICIT_METHODS = {'HEAD', 'OPTIONS'}
+CONVERTER = re.compile(r'<[^>]*>')
+
+
+def _literal(node, default=None):
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return default
+
+
+def _keyword(call, name):
+    return next((kw.value for kw in call.keywords if kw.arg == name), None)
+
+
+def _is_blueprint_call(node):
+    if not isinstance(node, ast.Call):
+        return False
+    func = node.func
+    return (isinstance(func, ast.Name) and func.id == 'Blueprint') or \
+        (isinstance(func, ast.Attribute) and func.attr == 'Blueprint')
+
+
+def _route_from_call(call, blueprints, line):
+    # x.route('/r', methods=[...]) / x.get('/r') / x.add_url_rule('/r', ...) on a known blueprint
+    func = call.func
+    if not isinstance(func, ast.Attribute) or not isinstance(func.value, ast.Name):
+        return None
+    blueprint = blueprints.get(func.value.id)
+    if blueprint is None or not call.args:
+        return None
+    rule = _literal(call.args[0])
+    if not isinstance(rule, str):
+        return None
+    if func.attr in ROUTE_SHORTCUTS:
+        methods = [ROUTE_SHORTCUTS[func.attr]]
+    elif func.attr in ('route', 'add_url_rule'):
+        methods = _literal(_keyword(call, 'methods'))
+        methods = [str(m).upper() for m in methods] if isinstance(methods, (list, tuple, set)) else ['GET']
+    else:
+        return None
+    return {
+        "rule": (blueprint["url_prefix"] or '').rstrip('/') + rule,
+        "methods": sorted(set(methods) - IMPLICIT_METHODS),
+        "blueprint": blueprint["name"],
+        "line": line
+    }
+
+
+def analyze_route_source(source, filename='<route>'):
+    # Parses and compiles one route module without executing it. Returns
+    # {"errors": [...], "blueprints": [...], "routes": [...]}; runs in a worker process.
+    summary = {"errors": [], "blueprints": [], "routes": []}
+    try:
+        tree = ast.parse(source, filename)
+        compile(tree, filename, 'exec')
+    except SyntaxError as e:
+        summary["errors"].append({
+            "type": "syntax_error",
+            "line": e.lineno,
+            "column": e.offset,
+            "message": e.msg,
+            "text": (e.text or '').rstrip('\n')
+        })
+        return summary
+    except (ValueError, TypeError) as e:
+        summary["errors"].append({"type": "compile_error", "message": str(e)})
+        return summary
+
+    blueprints = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and _is_blueprint_call(node.value):
+            call = node.value
+            name = _literal(call.args[0]) if call.args else _literal(_keyword(call, 'name'))
+            prefix = _literal(_keyword(call, 'url_prefix'))
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    blueprints[target.id] = {"name": name if isinstance(name, str) else None,
+                                             "url_prefix": prefix if isinstance(prefix, str) else None,
+                                             "line": node.lineno}
+    summary["blueprints"] = [
+        {"variable": variable, **blueprint} for variable, blueprint in sorted(blueprints.items())
+    ]
+    if not blueprints:
+        summary["errors"].append({
+            "type": "missing_blueprint",
+            "message": "the module defines no module-level Blueprint(...); routes/ modules are loaded by "
+                       "registering their Blueprint objects"
+        })
+        return summary
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for decorator in node.decorator_list:
+                if isinstance(decorator, ast.Call):
+                    route = _route_from_call(decorator, blueprints, decorator.lineno)
+                    if route:
+                        summary["routes"].append(route)
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) and \
+                isinstance(node.value.func, ast.Attribute) and node.value.func.attr == 'add_url_rule':
+            route = _route_from_call(node.value, blueprints, node.lineno)
+            if route:
+                summary["routes"].append(route)
+    return summary
+
+
+def _rule_key(rule):
+    # /items/<int:id> and /items/<name> match the same URLs for collision purposes
+    return CONVERTER.sub('<>', rule.rstrip('/') or '/')
+
+
+def find_collisions(summary, others):
+    # others: {display name: summary} of the other modules in routes/
+    errors = []
+    seen = {}
+    for route in summary["routes"]:
+        key = _rule_key(route["rule"])
+        for method in route["methods"]:
+            if (key, method) in seen:
+                errors.append({"type": "route_collision", "rule": route["rule"], "method": method,
+                               "line": route["line"], "conflicts_with": f"line {seen[(key, method)]} of this file"})
+            seen[(key, method)] = route["line"]
+    names = {blueprint["name"]: blueprint for blueprint in summary["blueprints"] if blueprint["name"]}
+    for other_name, other in sorted(others.items()):
+        for blueprint in other["blueprints"]:
+            if blueprint["name"] in names:
+                errors.append({"type": "duplicate_blueprint_name", "name": blueprint["name"],
+                               "line": names[blueprint["name"]]["line"], "conflicts_with": other_name})
+        other_rules = {(_rule_key(r["rule"]), m) for r in other["routes"] for m in r["methods"]}
+        for route in summary["routes"]:
+            for method in route["methods"]:
+                if (_rule_key(route["rule"]), method) in other_rules:
+                    errors.append({"type": "route_collision", "rule": route["rule"], "method": method,
+                                   "line": route["line"], "conflicts_with": other_name})
+    return errors
+
+
+class RouteValidator:
+    # Checks route files as they are written: parse and compile in a process
+    # pool (off the GIL), then compare blueprint names and URL rules against
+    # the other modules in the same routes/ directory. Summaries of the other
+    # modules are cached by (mtime, size).
+
+    def __init__(self, workers=ROUTE_VALIDATION_WORKERS, timeout=ROUTE_VALIDATION_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._pool = None
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None and self.workers > 0:
+                # Forked from the fork server with this module preloaded, not from the threaded server process
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=WORKER_CONTEXT)
+            return self._pool
+
+    def analyze(self, source, filename):
+        pool = self._executor()
+        if pool is None:
+            return analyze_route_source(source, filename)
+        try:
+            return pool.submit(analyze_route_source, source, filename).result(self.timeout)
+        except BrokenProcessPool:
+            with self._lock:
+                self._pool = None
+            return analyze_route_source(source, filename)
+
+    def _summary(self, path):
+        try:
+            stat = os.stat(path)
+            key = (stat.st_mtime_ns, stat.st_size)
+            cached = self._summaries.get(path)
+            if cached and cached[0] == key:
+                return cached[1]
+            with open(path, encoding='utf-8') as f:
+                summary = analyze_route_source(f.read(), path)
+        except (OSError, UnicodeDecodeError):
+            return None
+        if len(self._summaries) > 1000:
+            # Workspaces come and go; forget summaries of files that may be long gone
+            self._summaries.clear()
+        self._summaries[path] = (key, summary)
+        return summary
+
+    def validate(self, path, source):
+        # Returns a list of structured error dicts; empty when the file looks loadable
+        summary = self.analyze(source, path)
+        if summary["errors"]:
+            return summary["errors"]
+        routes_dir = os.path.dirname(os.path.abspath(path))
+        others = {}
+        for filename in sorted(os.listdir(routes_dir)):
+            other_path = os.path.join(routes_dir, filename)
+            if not filename.endswith('.py') or filename == '__init__.py' or \
+                    os.path.abspath(other_path) == os.path.abspath(path):
+                continue
+            other = self._summary(other_path)
+            if other is not None and not other["errors"]:
+                others[f"routes/{filename}"] = other
+        return find_collisions(summary, others)
@@ -0,0 +1,224 @@
+import os
+import sys
+import time
+import types
+import signal
+import itertools
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import Flask, Blueprint, send_from_directory
+
+from worker_processes import process_context
+
+SMOKE_TEST_WORKERS = int(os.environ.get('SMOKE_TEST_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Seconds each request may take before it is reported as hung
+SMOKE_TEST_TIMEOUT = float(os.environ.get('SMOKE_TEST_TIMEOUT', '5'))
+# Registered at import, before any pool starts the fork server
+WORKER_CONTEXT = process_context(__name__)
+
+# Sample values for URL variables, by converter
+SAMPLE_VALUES = {
+    'int': 1,
+    'float': 1.0,
+    'uuid': '00000000-0000-0000-0000-000000000001',
+    'path': 'test',
+    'default': 'test'
+}
+METHOD_PREFERENCE = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+
+def build_app(root, name=None):
+    # Throwaway app with every Blueprint from <root>/routes and the templates
+    # and static files under root, plus the builder's "/" -> index.html rule.
+    # Returns (app, errors); route modules that fail to load are left out.
+    routes_dir = os.path.join(root, 'routes')
+    package = name or f'_smoke_{os.getpid()}_{abs(hash(root))}'
+    app = Flask(package, root_path=root, template_folder=os.path.join(root, 'templates'),
+                static_folder=os.path.join(root, 'static'))
+    app.testing = True
+    errors = {}
+    package_module = types.ModuleType(package)
+    package_module.__path__ = [routes_dir]
+    sys.modules[package] = package_module
+    try:
+        filenames = sorted(os.listdir(routes_dir)) if os.path.isdir(routes_dir) else []
+        for filename in filenames:
+            if not filename.endswith('.py') or filename == '__init__.py':
+                continue
+            path = os.path.join(routes_dir, filename)
+            module = types.ModuleType(f'{package}.{filename[:-3]}')
+            module.__file__ = path
+            module.__package__ = package
+            sys.modules[module.__name__] = module
+            try:
+                with open(path, encoding='utf-8') as f:
+                    exec(compile(f.read(), path, 'exec'), module.__dict__)
+                for blueprint in [v for v in vars(module).values() if isinstance(v, Blueprint)]:
+                    app.register_blueprint(blueprint)
+            except Exception as e:
+                errors[f"routes/{filename}"] = f"{type(e).__name__}: {e}"
+    finally:
+        for module_name in [m for m in sys.modules if m == package or m.startswith(package + '.')]:
+            del sys.modules[module_name]
+
+    templates_dir = os.path.join(root, 'templates')
+    if os.path.exists(os.path.join(templates_dir, 'index.html')) and \
+            not any(rule.rule == '/' for rule in app.url_map.iter_rules()):
+        app.add_url_rule('/', 'index', lambda: send_from_directory(templates_dir, 'index.html'))
+    return app, errors
+
+
+def _sample_value(rule, argument):
+    converter = getattr(rule, '_converters', {}).get(argument)
+    for name, value in SAMPLE_VALUES.items():
+        if converter is not None and type(converter).__name__.lower().startswith(name):
+            return value
+    return SAMPLE_VALUES['default']
+
+
+def plan_requests(app):
+    # One request per URL rule: (rule, method, url)
+    adapter = app.url_map.bind('localhost')
+    planned = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+        if rule.endpoint == 'static':
+            continue
+        method = next((m for m in METHOD_PREFERENCE if m in (rule.methods or ())), None)
+        if method is None:
+            continue
+        values = {argument: _sample_value(rule, argument) for argument in rule.arguments}
+        try:
+            url = adapter.build(rule.endpoint, values, method=method)
+        except Exception:
+            url = rule.rule
+        planned.append((rule.rule, method, url))
+    return planned
+
+
+# Worker side: the apps built for recent runs, {run: (app, errors)}. Each
+# run gets a fresh app, so later runs see the files as they are by then.
+_worker_apps = {}
+WORKER_APPS_KEPT = 4
+
+
+def _worker_app(root, run):
+    if run not in _worker_apps:
+        while len(_worker_apps) >= WORKER_APPS_KEPT:
+            del _worker_apps[min(_worker_apps)]
+        _worker_apps[run] = build_app(root, name=f'_smoke_worker_{os.getpid()}_{run}')
+    return _worker_apps[run]
+
+
+def _plan(root, run):
+    app, errors = _worker_app(root, run)
+    return plan_requests(app), errors
+
+
+def _on_alarm(signum, frame):
+    raise TimeoutError("request timed out")
+
+
+def _request(root, run, rule, method, url, timeout):
+    # Runs in a worker process (main thread), so a hung view can be interrupted with an alarm
+    result = {"rule": rule, "method": method, "url": url}
+    started = time.perf_counter()
+    previous = signal.signal(signal.SIGALRM, _on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        response = _worker_app(root, run)[0].test_client().open(url, method=method, data={})
+        result["status"] = response.status_code
+        response.close()
+    except TimeoutError:
+        result["error"] = f"timed out after {timeout}s"
+    except Exception as e:
+        frames = traceback.extract_tb(e.__traceback__)
+        where = next((f"{os.path.basename(f.filename)}:{f.lineno}" for f in reversed(frames)
+                      if f"{os.sep}routes{os.sep}" in f.filename), None)
+        result["error"] = f"{type(e).__name__}: {e}" + (f" ({where})" if where else "")
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+    result["seconds"] = round(time.perf_counter() - started, 4)
+    return result
+
+
+def failed(result):
+    return "error" in result or result.get("status", 0) >= 500
+
+
+# Runner side: worker pools are kept between runs, one per worker count, and
+# only replaced after a worker hangs or dies
+_pools = {}
+_pools_lock = threading.Lock()
+_runs = itertools.count()
+
+
+def _pool(workers):
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=WORKER_CONTEXT)
+        return pool
+
+
+def _discard_pool(workers, pool):
+    # Kills the workers of a pool that has a hung or dead worker; the next run starts a new one
+    with _pools_lock:
+        if _pools.get(workers) is pool:
+            del _pools[workers]
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+
+def run_smoke_tests(root, workers=SMOKE_TEST_WORKERS, timeout=SMOKE_TEST_TIMEOUT):
+    # Hits every URL rule of the app built from root through the Flask test
+    # client, spread over worker processes. Returns a summary dict; a failure
+    # is an exception, a timeout or a 5xx status. Generated code only ever
+    # runs in the worker processes, planning included.
+    workers = max(1, workers)
+    pool = _pool(workers)
+    run = next(_runs)
+    summary = {"load_errors": {}, "results": [], "passed": 0, "failed": 0}
+    healthy = False
+    try:
+        try:
+            planned, summary["load_errors"] = pool.submit(_plan, root, run).result(timeout + 30)
+        except FutureTimeout:
+            summary["load_errors"]["routes/"] = "timed out while importing the route modules"
+            return summary
+        except RuntimeError:
+            # BrokenProcessPool, or a pool shut down by a concurrent run
+            summary["load_errors"]["routes/"] = "the worker process exited while importing the route modules"
+            return summary
+        futures = []
+        try:
+            for rule, method, url in planned:
+                futures.append(pool.submit(_request, root, run, rule, method, url, timeout))
+        except RuntimeError:
+            pass
+        # Alarms cover hung Python code; the overall deadline covers anything that ignores them
+        deadline = timeout * (len(planned) / workers + 1) + 5
+        healthy = len(futures) == len(planned) and not wait(futures, timeout=deadline).not_done
+        for index, (rule, method, url) in enumerate(planned):
+            future = futures[index] if index < len(futures) else None
+            if future is not None and future.done() and future.exception() is None:
+                result = future.result()
+            elif future is not None and future.done():
+                result = {"rule": rule, "method": method, "url": url,
+                          "error": f"{type(future.exception()).__name__}: {future.exception()}"}
+                healthy = healthy and not isinstance(future.exception(), BrokenProcessPool)
+            else:
+                result = {"rule": rule, "method": method, "url": url, "error": "worker did not respond"}
+            summary["results"].append(result)
+    finally:
+        if not healthy:
+            _discard_pool(workers, pool)
+    summary["failed"] = sum(1 for result in summary["results"] if failed(result))
+    summary["passed"] = len(summary["results"]) - summary["failed"]
+    return summary
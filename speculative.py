@@ -0,0 +1,96 @@
+import os
+import asyncio
+import contextvars
+
+from jobs import new_job_state, emit_event
+from workspace import Workspace, CommitConflict, current_workspace
+from smoke_tests import run_smoke_tests, failed
+
+# Candidate builds started per request; 1 disables speculative builds
+SPECULATIVE_CANDIDATES = int(os.environ.get('SPECULATIVE_CANDIDATES', '1'))
+# Seconds between candidate starts. With a stagger, later candidates only cost
+# anything if no earlier one has produced a valid build by then.
+SPECULATIVE_STAGGER = float(os.environ.get('SPECULATIVE_STAGGER', '0'))
+
+
+async def _in_thread(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, contextvars.copy_context().run, func, *args)
+
+
+def validate_workspace(root):
+    # Every route module must import and register into a fresh app, and no
+    # URL may fail its smoke test. Returns a list of error strings; empty
+    # means the candidate is usable.
+    summary = run_smoke_tests(root)
+    errors = [f"{module}: {error}" for module, error in sorted(summary["load_errors"].items())]
+    errors += [
+        f"{result['method']} {result['url']}: {result.get('error') or 'HTTP %s' % result['status']}"
+        for result in summary["results"] if failed(result)
+    ]
+    return errors
+
+
+async def run_candidates(user_input, job, run_candidate, base_dir, candidates=SPECULATIVE_CANDIDATES,
+                         stagger=SPECULATIVE_STAGGER, validate=validate_workspace, build_log=None):
+    # Runs `candidates` copies of run_candidate(user_input, child_job), each in
+    # its own workspace. Finished candidates are validated as they come in; the
+    # first valid one is committed to base_dir and the rest are cancelled.
+    # Returns the list of committed paths, or None when no candidate passed.
+    children = [
+        new_job_state(job_id=f"{job['id']}-{n}", user_input=user_input, max_iterations=job["max_iterations"])
+        for n in range(1, candidates + 1)
+    ]
+    job["candidates"] = [child["id"] for child in children]
+    workspaces = {}
+
+    def record(record_type, **data):
+        emit_event(job, record_type, **data)
+        if build_log is not None:
+            build_log.append(record_type, **data)
+
+    async def attempt(index, child):
+        if stagger and index:
+            await asyncio.sleep(stagger * index)
+        workspace = workspaces[child["id"]] = await _in_thread(Workspace.create, base_dir, child["id"])
+        current_workspace.set(workspace)
+        record("candidate_started", candidate=child["id"], workspace=workspace.root)
+        child["status"] = "running"
+        await run_candidate(user_input, child)
+        if child["status"] != "completed":
+            return child, [f"build ended with status {child['status']}"]
+        return child, await _in_thread(validate, workspace.root)
+
+    tasks = {asyncio.create_task(attempt(index, child)): child for index, child in enumerate(children)}
+    committed = None
+    try:
+        pending = set(tasks)
+        while pending and committed is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    record("candidate_finished", candidate=tasks[task]["id"], status="error", valid=False,
+                           errors=[f"{type(task.exception()).__name__}: {task.exception()}"])
+                    continue
+                child, errors = task.result()
+                record("candidate_finished", candidate=child["id"], status=child["status"], valid=not errors,
+                       iterations=child["iteration"], errors=errors)
+                if not errors and committed is None:
+                    try:
+                        committed = await _in_thread(workspaces[child["id"]].commit)
+                    except CommitConflict as e:
+                        # Another build committed the same files first; a later candidate may still fit
+                        record("candidate_conflict", candidate=child["id"], files=e.paths)
+                        continue
+                    job["iteration"] = child["iteration"]
+                    record("candidate_promoted", candidate=child["id"], files=committed)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for child in children:
+            for key in ("llm_calls", "prompt_tokens", "completion_tokens"):
+                job[key] = job.get(key, 0) + child.get(key, 0)
+        for workspace in workspaces.values():
+            await _in_thread(workspace.remove)
+    return committed
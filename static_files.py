@@ -0,0 +1,225 @@
+import os
+import re
+import gzip
+import time
+import hashlib
+import mimetypes
+import threading
+
+from werkzeug.wrappers import Request, Response
+from werkzeug.utils import send_file
+
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files larger than this are indexed (ETag) but served from disk, uncompressed
+STATIC_MAX_CACHED_BYTES = int(os.environ.get('STATIC_MAX_CACHED_BYTES', str(4 * 1024 * 1024)))
+# Smaller files are not worth compressing
+STATIC_COMPRESS_MIN_BYTES = int(os.environ.get('STATIC_COMPRESS_MIN_BYTES', '512'))
+# Seconds between checks for files committed by builds in other worker
+# processes; 0 disables the check
+STATIC_CHECK_INTERVAL = float(os.environ.get('STATIC_CHECK_INTERVAL', '2'))
+# Cache lifetime for URLs that carry the content hash (?v=...)
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+COMPRESSIBLE_TYPES = {'application/javascript', 'application/json', 'application/xml', 'image/svg+xml',
+                      'application/manifest+json', 'text/javascript'}
+# src="/static/..." and href="/static/..." in a template served as-is
+STATIC_REFERENCE = re.compile(r"""((?:src|href)\s*=\s*['"])/static/([^'"?#]+)(?=['"#])""")
+
+
+def _signature(stat):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _compressible(mimetype):
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _entry(path, relative, signature, body=None):
+    # Everything needed to answer a request for one file: strong ETag, content
+    # type and, for text formats, gzip/brotli variants that are actually smaller
+    mimetype = mimetypes.guess_type(relative)[0] or 'application/octet-stream'
+    if body is None and signature[2] <= STATIC_MAX_CACHED_BYTES:
+        with open(path, 'rb') as f:
+            body = f.read()
+    digest = hashlib.sha256(body).hexdigest() if body is not None else _file_hash(path)
+    variants = {}
+    if body is not None and _compressible(mimetype) and len(body) >= STATIC_COMPRESS_MIN_BYTES:
+        candidates = {'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            candidates['br'] = brotli.compress(body, quality=11)
+        variants = {encoding: data for encoding, data in candidates.items() if len(data) < len(body) * 0.9}
+    return {"path": path, "signature": signature, "hash": digest, "version": digest[:12],
+            "mimetype": mimetype, "body": body, "variants": variants}
+
+
+class StaticIndex:
+    # In-memory index of the files the builder serves directly: everything
+    # under static/ and templates/index.html (served as-is at /). Each entry
+    # holds the content, its hash and pre-compressed variants, so requests
+    # cost no filesystem access. refresh() rebuilds only entries whose
+    # (inode, mtime, size) changed; it runs at load time, whenever a build
+    # commits (which is when the variants get compressed) and in the
+    # background after check() finds the index older than check_interval.
+
+    def __init__(self, base_dir, check_interval=STATIC_CHECK_INTERVAL):
+        self.base_dir = base_dir
+        self.check_interval = check_interval
+        self.entries = {}
+        self._checked = time.monotonic()
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        self._refresher = None
+
+    def _scan(self):
+        static_dir = os.path.join(self.base_dir, 'static')
+        for current, subdirs, files in os.walk(static_dir):
+            subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+            for filename in files:
+                if not filename.startswith('.'):
+                    path = os.path.join(current, filename)
+                    yield os.path.relpath(path, self.base_dir).replace(os.sep, '/'), path
+        yield 'templates/index.html', os.path.join(self.base_dir, 'templates', 'index.html')
+
+    def refresh(self):
+        # Returns the relative paths that were (re)indexed or dropped
+        with self._lock:
+            self._checked = time.monotonic()
+            entries = {}
+            changed = []
+            for relative, path in self._scan():
+                try:
+                    signature = _signature(os.stat(path))
+                    previous = self.entries.get(relative)
+                    if previous is not None and previous["signature"] == signature:
+                        entries[relative] = previous
+                        continue
+                    if relative == 'templates/index.html':
+                        # Rendered below, once every static file is indexed
+                        entries[relative] = {"signature": signature, "path": path}
+                    else:
+                        entries[relative] = _entry(path, relative, signature)
+                except OSError:
+                    continue
+                changed.append(relative)
+            changed.extend(relative for relative in self.entries if relative not in entries)
+            page = entries.get('templates/index.html')
+            if page is not None and changed:
+                try:
+                    entries['templates/index.html'] = self._index_page(page["path"], page["signature"], entries)
+                except OSError:
+                    del entries['templates/index.html']
+            # A single assignment: requests see either the old index or the new one
+            self.entries = entries
+            return changed
+
+    def _index_page(self, path, signature, entries):
+        # index.html is sent without Jinja, so its /static/ references get the
+        # content hash appended here and the assets can be cached for good
+        with open(path, 'rb') as f:
+            body = f.read()
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return _entry(path, 'index.html', signature, body)
+
+        def versioned(match):
+            entry = entries.get(f"static/{match.group(2)}")
+            if entry is None or "version" not in entry:
+                return match.group(0)
+            return f"{match.group(1)}/static/{match.group(2)}?v={entry['version']}"
+
+        return _entry(path, 'index.html', signature, STATIC_REFERENCE.sub(versioned, text).encode('utf-8'))
+
+    def check(self):
+        # Picks up files committed by other worker processes, at most once per
+        # check_interval. The rescan runs in a background thread; requests are
+        # answered from the current index meanwhile and see the new one once
+        # it is swapped in. Commits in this process refresh the index directly.
+        if not self.check_interval or time.monotonic() - self._checked < self.check_interval:
+            return
+        with self._check_lock:
+            if self._refresher is not None and self._refresher.is_alive():
+                return
+            self._checked = time.monotonic()
+            self._refresher = threading.Thread(target=self.refresh, name='static-refresh', daemon=True)
+            self._refresher.start()
+
+    def version(self, filename):
+        entry = self.entries.get(f"static/{filename}")
+        return entry["version"] if entry is not None else None
+
+    def add_url_defaults(self, app):
+        # url_for('static', filename=...) in generated templates adds ?v=<content hash>
+        @app.url_defaults
+        def static_version(endpoint, values):
+            if endpoint == 'static' and 'v' not in values:
+                version = self.version(values.get('filename'))
+                if version is not None:
+                    values['v'] = version
+
+    def response(self, environ, relative):
+        # Response for an indexed file, or None to let the application handle the request
+        entry = self.entries.get(relative)
+        if entry is None:
+            return None
+        request = Request(environ)
+        versioned = request.args.get('v') == entry["version"]
+        if entry["body"] is None:
+            # send_file answers conditional and range requests itself
+            response = send_file(entry["path"], environ, mimetype=entry["mimetype"], etag=entry["hash"][:32],
+                                 max_age=IMMUTABLE_MAX_AGE if versioned else None)
+            response.cache_control.immutable = versioned or None
+            encoding = 'identity'
+        else:
+            encoding = next((encoding for encoding in ('br', 'gzip')
+                             if encoding in entry["variants"] and request.accept_encodings[encoding]), 'identity')
+            response = Response(entry["variants"].get(encoding, entry["body"]), mimetype=entry["mimetype"])
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+            if entry["variants"]:
+                response.vary.add('Accept-Encoding')
+            # Each encoding is a different representation and needs its own strong ETag
+            response.set_etag(entry["hash"][:32] + ('' if encoding == 'identity' else f'-{encoding}'))
+            if versioned:
+                response.cache_control.public = True
+                response.cache_control.max_age = IMMUTABLE_MAX_AGE
+                response.cache_control.immutable = True
+            else:
+                # Cached, but revalidated (If-None-Match -> 304) on every use
+                response.cache_control.no_cache = True
+            response.make_conditional(request)
+        metrics.static_responses.inc(status=str(response.status_code), encoding=encoding)
+        return response
+
+
+class StaticMiddleware:
+    # WSGI middleware in front of the builder and the generated app: GET and
+    # HEAD requests for indexed static files are answered from the index.
+
+    def __init__(self, index, wsgi_app, url_prefix='/static/'):
+        self.index = index
+        self.wsgi_app = wsgi_app
+        self.url_prefix = url_prefix
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if environ.get('REQUEST_METHOD') in ('GET', 'HEAD') and path.startswith(self.url_prefix):
+            self.index.check()
+            response = self.index.response(environ, 'static/' + path[len(self.url_prefix):])
+            if response is not None:
+                return response(environ, start_response)
+        return self.wsgi_app(environ, start_response)
@@ -0,0 +1,30 @@
+import os
+import sys
+import time
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Test modules import llm (and with it litellm) at collection time
+os.environ.setdefault('LITELLM_LOCAL_MODEL_COST_MAP', 'True')
+
+
+@pytest.fixture(scope="session")
+def builder():
+    # main.py sets up its directories, job store and engine at import time,
+    # so it is imported once per session inside a scratch base directory
+    import bench
+    cwd = os.getcwd()
+    bench.prepare_workdir(tempfile.mkdtemp(prefix='builder-test-'))
+    import main
+    yield main
+    os.chdir(cwd)
+
+
+def wait_for(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.05)
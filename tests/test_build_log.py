@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+from build_log import BuildLog, load_iterations
+from mock_llm import load_script
+
+
+def test_records_superseded_by_a_resume_are_dropped():
+    log = BuildLog(os.path.join(tempfile.mkdtemp(prefix='builder-log-'), 'job.jsonl'), buffer_records=1)
+    log.append("build", user_input="app")
+    for iteration, tool in ((1, "create_file"), (2, "fetch_code"), (3, "update_file")):
+        log.append("iteration", iteration=iteration)
+        log.append("llm_response", iteration=iteration, content=f"run 1, iteration {iteration}")
+        log.append("tool_call", iteration=iteration, id=f"call_{iteration}", tool=tool, arguments={"path": "a"})
+        if iteration < 3:
+            log.append("checkpoint", iteration=iteration, bytes=1, files=0)
+    # Interrupted during iteration 3; resumed from the checkpoint after iteration 2
+    log.append("build", user_input="app")
+    log.append("resume", iteration=2, files=[], messages=5)
+    log.append("iteration", iteration=3)
+    log.append("llm_response", iteration=3, content="run 2, iteration 3")
+    log.append("tool_call", iteration=3, id="call_3", tool="task_completed", arguments={})
+
+    history = load_iterations(log.path)
+    assert [iteration["iteration"] for iteration in history["iterations"]] == [1, 2, 3]
+    assert history["iterations"][2]["llm_responses"] == ["run 2, iteration 3"]
+    assert history["resumed_after"] == [2]
+
+    prompt, script = load_script(log.path)
+    assert prompt == "app"
+    assert [[call["name"] for call in step["tool_calls"]] for step in script] == \
+        [["create_file"], ["fetch_code"], ["task_completed"]]
@@ -0,0 +1,92 @@
+import os
+import json
+
+import llm
+from llm_cache import to_jsonable
+from mock_llm import ScriptedLLM, turn
+
+from conftest import wait_for
+
+
+class RecordingLLM(ScriptedLLM):
+    # Keeps the messages of every completion request
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = []
+
+    def _prepare(self, model, messages, tools):
+        self.requests.append(list(messages))
+        return super()._prepare(model, messages, tools)
+
+
+def run(builder, prompt):
+    engine = builder.build_engine
+    job_id = engine.submit(prompt)['id']
+    wait_for(lambda: engine.get(job_id)['finished_at'] is not None)
+    return engine.get(job_id), [event["type"] for event in engine.get_events(job_id)]
+
+
+def tool_messages(request):
+    return {message["tool_call_id"]: message["content"] for message in map(to_jsonable, request)
+            if message.get("role") == "tool"}
+
+
+def test_failed_tool_calls_still_get_a_tool_message(builder):
+    backend = RecordingLLM({'bad calls': [
+        turn("", ("create_directory", {"path": "../outside"}), ("no_such_tool", {})),
+        turn("", ("task_completed", {})),
+    ]}, latency=0)
+    llm.set_backend(backend)
+    job, types = run(builder, 'bad calls')
+
+    assert job["status"] == "completed"
+    assert "error" in types
+    assert not os.path.exists(os.path.join(os.path.dirname(builder.BASE_DIR), 'outside'))
+    assistant = next(message for message in map(to_jsonable, backend.requests[1]) if message.get("tool_calls"))
+    results = tool_messages(backend.requests[1])
+    assert [call["id"] for call in assistant["tool_calls"]] == list(results)
+    assert all(results.values())
+
+
+def test_conflicting_commit_is_not_reported_completed(builder):
+    index = os.path.join(builder.BASE_DIR, 'templates', 'index.html')
+    llm.set_backend(ScriptedLLM({'conflict': [
+        turn("", ("update_file", {"path": "templates/index.html", "content": "from the build"})),
+        turn("", ("fetch_code", {"file_path": "templates/index.html"})),
+        turn("", ("fetch_code", {"file_path": "templates/index.html"})),
+        turn("", ("task_completed", {})),
+    ]}, latency=0.2))
+    engine = builder.build_engine
+    job_id = engine.submit('conflict')['id']
+    wait_for(lambda: engine.get(job_id)['iteration'] >= 1)
+    with open(index, 'w') as f:
+        f.write("committed meanwhile")
+    wait_for(lambda: engine.get(job_id)['finished_at'] is not None)
+
+    types = [event["type"] for event in engine.get_events(job_id)]
+    assert engine.get(job_id)["status"] == "error"
+    assert "completed" not in types and "committed" not in types
+    with open(index) as f:
+        assert f.read() == "committed meanwhile"
+
+
+class EmptyFirstLLM(ScriptedLLM):
+    # The first completion comes back without a message
+    empty = True
+
+    def _prepare(self, model, messages, tools):
+        response, delay = super()._prepare(model, messages, tools)
+        if self.empty:
+            self.empty = False
+            response.choices[0].message = None
+        return response, delay
+
+
+def test_iteration_with_an_empty_response_is_checkpointed(builder):
+    llm.set_backend(EmptyFirstLLM({'empty first': [turn("", ("task_completed", {}))]}, latency=0))
+    job, types = run(builder, 'empty first')
+
+    assert job["status"] == "completed"
+    with open(job["log_file"]) as f:
+        records = [json.loads(line) for line in f]
+    assert [record["iteration"] for record in records if record["type"] == "checkpoint"][:1] == [1]
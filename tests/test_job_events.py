@@ -0,0 +1,31 @@
+import json
+
+import llm
+from mock_llm import ScriptedLLM, turn
+
+from conftest import wait_for
+
+
+def stream(client, job_id, cursor=0):
+    response = client.get(f'/jobs/{job_id}/events?cursor={cursor}')
+    return [json.loads(line[len('data: '):]) for line in response.get_data(as_text=True).splitlines()
+            if line.startswith('data: ')]
+
+
+def test_stream_of_a_resumed_build_runs_to_its_final_end(builder):
+    script = [turn("", ("fetch_code", {"file_path": "routes/missing.py"}))] * 6
+    llm.set_backend(ScriptedLLM({'resume me': script}, latency=0.1))
+    engine = builder.build_engine
+    job_id = engine.submit('resume me')['id']
+    wait_for(lambda: engine.get(job_id)['iteration'] >= 3)
+    assert engine.cancel(job_id)
+    wait_for(lambda: engine.get(job_id)['finished_at'] is not None)
+    assert engine.get(job_id)['status'] == 'cancelled'
+
+    assert builder.app.test_client().post(f'/jobs/{job_id}/resume').status_code == 202
+    events = stream(builder.app.test_client(), job_id)
+
+    types = [event["type"] for event in events]
+    assert types.index("end") < types.index("resume_requested") < types.index("resumed")
+    assert types[-1] == "end" and events[-1]["status"] == "completed"
+    assert [event["seq"] for event in events] == list(range(len(events)))
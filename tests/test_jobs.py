@@ -0,0 +1,42 @@
+import llm
+from jobs import JobEngine
+from job_store import JobStore
+from mock_llm import ScriptedLLM, turn
+
+from conftest import wait_for
+
+
+def slow_build(prompt):
+    llm.set_backend(ScriptedLLM({prompt: [turn("", ("fetch_code", {"file_path": "routes/missing.py"}))] * 20},
+                                latency=0.2))
+
+
+def test_cancel_route(builder):
+    slow_build('cancel me')
+    engine = builder.build_engine
+    client = builder.app.test_client()
+    job_id = engine.submit('cancel me')['id']
+    wait_for(lambda: engine.get(job_id)['iteration'] >= 1)
+
+    response = client.post(f'/jobs/{job_id}/cancel')
+    assert response.status_code == 202
+    wait_for(lambda: engine.get(job_id)['finished_at'] is not None)
+    assert engine.get(job_id)['status'] == 'cancelled'
+
+    assert client.post(f'/jobs/{job_id}/cancel').status_code == 409
+    assert client.post('/jobs/no-such-job/cancel').status_code == 404
+
+
+def test_cancel_reaches_the_worker_running_the_build(builder):
+    # A second engine without a dispatcher stands in for another worker
+    # process: it can only flag the job in the shared store
+    slow_build('cancel elsewhere')
+    engine = builder.build_engine
+    job_id = engine.submit('cancel elsewhere')['id']
+    wait_for(lambda: engine.get(job_id)['iteration'] >= 1)
+
+    other = JobEngine(builder.run_build, JobStore(builder.JOB_STORE_PATH))
+    assert other.cancel(job_id)
+    wait_for(lambda: engine.get(job_id)['finished_at'] is not None)
+    assert engine.get(job_id)['status'] == 'cancelled'
+    assert not other.cancel(job_id)
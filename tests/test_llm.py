@@ -0,0 +1,33 @@
+import os
+import tempfile
+
+import llm
+import metrics
+from llm_cache import CompletionCache
+from mock_llm import ScriptedLLM, turn
+
+from conftest import wait_for
+
+
+def prompt_tokens_total():
+    return sum(value for key, value in metrics.llm_tokens._series.items() if "prompt" in key)
+
+
+def test_cache_hits_are_not_counted_as_token_usage(builder, monkeypatch):
+    cache = CompletionCache(os.path.join(tempfile.mkdtemp(prefix='builder-cache-'), 'cache.sqlite3'))
+    monkeypatch.setattr(llm, 'completion_cache', cache)
+    llm.set_backend(ScriptedLLM({'cache me': [turn("", ("task_completed", {}))]}, latency=0))
+    engine = builder.build_engine
+
+    def build():
+        before = prompt_tokens_total()
+        job_id = engine.submit('cache me')['id']
+        wait_for(lambda: engine.get(job_id)['finished_at'] is not None)
+        return engine.get(job_id), prompt_tokens_total() - before
+
+    first, first_tokens = build()
+    second, second_tokens = build()
+    assert cache.hits == 1
+    assert first["prompt_tokens"] > 0 and first_tokens == first["prompt_tokens"]
+    assert second["llm_calls"] == 1
+    assert second["prompt_tokens"] == 0 and second_tokens == 0
@@ -0,0 +1,43 @@
+import pytest
+
+from patching import PatchConflict, apply_unified_diff, parse_unified_diff
+
+
+def test_insertion_hunk_goes_after_the_given_line():
+    text = "import os\nprint(1)\n"
+    assert apply_unified_diff(text, "@@ -1,0 +2 @@\n+import sys\n") == "import os\nimport sys\nprint(1)\n"
+
+
+def test_insertion_hunk_later_in_the_file():
+    text = "a\nb\nc\n"
+    assert apply_unified_diff(text, "@@ -2,0 +3,1 @@\n+x\n") == "a\nb\nx\nc\n"
+
+
+def test_insertion_at_the_top_of_the_file():
+    assert apply_unified_diff("a\n", "@@ -0,0 +1 @@\n+first\n") == "first\na\n"
+
+
+def test_replacement_hunk_still_replaces_in_place():
+    text = "a\nb\nc\n"
+    assert apply_unified_diff(text, "@@ -2 +2 @@\n-b\n+B\n") == "a\nB\nc\n"
+
+
+def test_lines_that_look_like_file_headers_inside_a_hunk():
+    text = "select 1;\n-- old comment\nselect 2;\n"
+    diff = "@@ -1,3 +1,3 @@\n select 1;\n--- old comment\n+++ new comment\n select 2;\n"
+    hunks = parse_unified_diff(diff)
+    assert hunks[0]["old"] == ["select 1;", "-- old comment", "select 2;"]
+    assert hunks[0]["new"] == ["select 1;", "++ new comment", "select 2;"]
+    assert apply_unified_diff(text, diff) == "select 1;\n++ new comment\nselect 2;\n"
+
+
+def test_file_headers_between_hunks_of_a_multi_file_diff():
+    diff = ("--- a/x.py\n+++ b/x.py\n@@ -1 +1 @@\n-a\n+b\n"
+            "--- a/y.py\n+++ b/y.py\n@@ -1 +1 @@\n-c\n+d\n")
+    hunks = parse_unified_diff(diff)
+    assert [(h["old"], h["new"]) for h in hunks] == [(["a"], ["b"]), (["c"], ["d"])]
+
+
+def test_missing_lines_are_a_conflict():
+    with pytest.raises(PatchConflict):
+        apply_unified_diff("a\n", "@@ -1 +1 @@\n-z\n+y\n")
@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+from route_validation import RouteValidator
+
+
+def test_validation_runs_in_fork_server_workers():
+    routes = tempfile.mkdtemp(prefix='builder-routes-')
+    with open(os.path.join(routes, 'a.py'), 'w') as f:
+        f.write("from flask import Blueprint\na = Blueprint('a', __name__)\n\n@a.route('/a')\ndef a_view():\n    return 'a'\n")
+    validator = RouteValidator(workers=1)
+
+    errors = validator.validate(os.path.join(routes, 'b.py'),
+                                "from flask import Blueprint\nb = Blueprint('a', __name__)\n\n@b.route('/a')\ndef b_view(:\n")
+    assert errors and errors[0]["type"] == "syntax_error"
+    errors = validator.validate(os.path.join(routes, 'b.py'),
+                                "from flask import Blueprint\nb = Blueprint('a', __name__)\n\n@b.route('/a')\ndef b_view():\n    return 'b'\n")
+    assert {error["type"] for error in errors} == {"duplicate_blueprint_name", "route_collision"}
+    assert validator._pool._mp_context.get_start_method() in ('forkserver', 'spawn')
@@ -0,0 +1,33 @@
+import os
+import tempfile
+
+import smoke_tests
+
+ROUTES = """from flask import Blueprint
+pages = Blueprint('pages', __name__)
+
+@pages.route('/ok')
+def ok():
+    return 'ok'
+
+@pages.route('/broken')
+def broken():
+    raise ValueError('broken')
+"""
+
+
+def test_worker_pool_is_reused_and_sees_new_files():
+    root = tempfile.mkdtemp(prefix='builder-smoke-')
+    os.makedirs(os.path.join(root, 'routes'))
+    with open(os.path.join(root, 'routes', 'pages.py'), 'w') as f:
+        f.write(ROUTES)
+
+    first = smoke_tests.run_smoke_tests(root, workers=2, timeout=2)
+    assert (first["passed"], first["failed"]) == (1, 1)
+    pool = smoke_tests._pools[2]
+
+    with open(os.path.join(root, 'routes', 'pages.py'), 'w') as f:
+        f.write(ROUTES.replace("raise ValueError('broken')", "return 'fixed'"))
+    second = smoke_tests.run_smoke_tests(root, workers=2, timeout=2)
+    assert (second["passed"], second["failed"]) == (2, 0)
+    assert smoke_tests._pools[2] is pool
@@ -0,0 +1,35 @@
+import os
+import time
+import tempfile
+import threading
+
+from static_files import StaticIndex
+
+from conftest import wait_for
+
+
+def test_check_refreshes_in_the_background():
+    base = tempfile.mkdtemp(prefix='builder-static-')
+    os.makedirs(os.path.join(base, 'static'))
+    with open(os.path.join(base, 'static', 'app.css'), 'w') as f:
+        f.write('body {}')
+    index = StaticIndex(base, check_interval=0.01)
+    index.refresh()
+    with open(os.path.join(base, 'static', 'new.js'), 'w') as f:
+        f.write('run()')
+
+    release = threading.Event()
+    refresh = index.refresh
+
+    def slow_refresh():
+        release.wait(10)
+        return refresh()
+
+    index.refresh = slow_refresh
+    time.sleep(0.02)
+    index.check()
+    # The request that triggered the check is served from the current index
+    assert 'static/app.css' in index.entries and 'static/new.js' not in index.entries
+    index.check()
+    release.set()
+    wait_for(lambda: 'static/new.js' in index.entries)
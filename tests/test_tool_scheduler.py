@@ -0,0 +1,24 @@
+import os
+import tempfile
+
+from tool_scheduler import plan_tool_calls
+from workspace import Workspace, current_workspace
+
+
+def test_paths_are_compared_inside_the_build_workspace():
+    base = tempfile.mkdtemp(prefix='builder-base-')
+    os.makedirs(os.path.join(base, 'routes'))
+    workspace = Workspace.create(base, 'scheduler')
+    calls = [
+        ("create_file", {"path": "routes/a.py", "content": ""}),
+        ("fetch_code", {"file_path": os.path.join(base, 'routes', 'a.py')}),
+        ("fetch_code", {"file_path": os.path.join(workspace.root, 'routes', 'a.py')}),
+        ("create_file", {"path": "routes/b.py", "content": ""}),
+    ]
+    token = current_workspace.set(workspace)
+    try:
+        assert plan_tool_calls(calls) == [[[0, 1, 2], [3]]]
+        # Outside the writable directories: the call runs on its own
+        assert plan_tool_calls([calls[0], ("fetch_code", {"file_path": "../x"})]) == [[[0]], [[1]]]
+    finally:
+        current_workspace.reset(token)
@@ -0,0 +1,96 @@
+import os
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from workspace import PathOutsideWorkspace, resolve_path
+
+TOOL_CONCURRENCY = int(os.environ.get('TOOL_CONCURRENCY', '8'))
+
+# Argument that names the file or directory each tool touches. Tools that are
+# not listed here (task_completed, unknown tools, ...) act as barriers: every
+# call before them finishes first, and nothing after them starts early.
+PATH_ARGUMENTS = {
+    "create_directory": "path",
+    "create_file": "path",
+    "update_file": "path",
+    "apply_patch": "path",
+    "fetch_code": "file_path"
+}
+
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_CONCURRENCY, thread_name_prefix='tool')
+
+
+def tool_call_path(name, args):
+    # The file the tool will actually touch, mapped through the current
+    # build's workspace the way the tools map it, so that a relative path and
+    # an absolute one into the workspace or the base directory compare equal
+    key = PATH_ARGUMENTS.get(name)
+    if key is None or not isinstance(args, dict) or not isinstance(args.get(key), str):
+        return None
+    try:
+        path = resolve_path(args[key])
+    except PathOutsideWorkspace:
+        # The call fails without touching anything; scheduled as a barrier
+        return None
+    return os.path.normpath(os.path.abspath(path))
+
+
+def _overlaps(a, b):
+    # Same path, or one is a directory containing the other
+    return a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+
+def plan_tool_calls(calls):
+    # calls: list of (name, args). Returns a list of stages to run one after
+    # another; each stage is a list of chains that may run concurrently, and
+    # each chain is a list of call indexes that must run in order.
+    stages = []
+    chains = []
+    chain_paths = []
+    for index, (name, args) in enumerate(calls):
+        path = tool_call_path(name, args)
+        if path is None:
+            if chains:
+                stages.append(chains)
+            stages.append([[index]])
+            chains, chain_paths = [], []
+            continue
+        hits = [i for i, paths in enumerate(chain_paths) if any(_overlaps(path, p) for p in paths)]
+        if not hits:
+            chains.append([index])
+            chain_paths.append({path})
+            continue
+        # Merge every chain this call conflicts with, keeping original order
+        target = hits[0]
+        for i in reversed(hits[1:]):
+            chains[target].extend(chains.pop(i))
+            chain_paths[target] |= chain_paths.pop(i)
+        chains[target].sort()
+        chains[target].append(index)
+        chain_paths[target].add(path)
+    if chains:
+        stages.append(chains)
+    return stages
+
+
+async def run_tool_calls(calls, execute):
+    # Runs execute(index) for every call on the tool thread pool, honouring the
+    # ordering constraints from plan_tool_calls. Results come back in the
+    # original call order regardless of completion order.
+    loop = asyncio.get_running_loop()
+    results = [None] * len(calls)
+
+    def run_chain(chain):
+        for index in chain:
+            results[index] = execute(index)
+
+    # Each chain runs in its own copy of the caller's context (a context can
+    # only be entered by one thread at a time), so tracing spans and other
+    # context variables carry over into the worker threads
+    for stage in plan_tool_calls(calls):
+        await asyncio.gather(*(
+            loop.run_in_executor(tool_executor, contextvars.copy_context().run, run_chain, chain)
+            for chain in stage
+        ))
+    return results
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Per-build span tracing. A build opens a root span with start_trace(); code
+# anywhere below it (coroutines, and threads started with a copied context)
+# opens child spans with span(). Outside a trace, span() costs one contextvar
+# lookup and records nothing.
+
+# Finished traces kept in memory for /jobs/<id>/trace
+TRACE_HISTORY = int(os.environ.get('TRACE_HISTORY', '200'))
+# Optional: append every finished trace to this file as one OTLP/JSON line
+# (the format of the OpenTelemetry collector's file exporter); no collector needed
+TRACE_OTLP_FILE = os.environ.get('TRACE_OTLP_FILE')
+SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'flask-app-builder')
+
+current_span = contextvars.ContextVar('trace_span', default=None)
+
+_traces = OrderedDict()
+_traces_lock = threading.Lock()
+_otlp_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'thread', 'attributes')
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.thread = threading.current_thread().name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Trace:
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def _finish(self, span):
+        span.end_ns = time.time_ns()
+        with self._lock:
+            self.spans.append(span)
+
+    def _finished_spans(self):
+        with self._lock:
+            return sorted(self.spans, key=lambda s: s.start_ns)
+
+    def to_chrome(self):
+        # Chrome trace-event format: open in chrome://tracing or https://ui.perfetto.dev
+        spans = self._finished_spans()
+        threads = {}
+        events = []
+        for span in spans:
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            events.append({
+                "name": span.name,
+                "cat": "build",
+                "ph": "X",
+                "ts": span.start_ns / 1000,
+                "dur": (span.end_ns - span.start_ns) / 1000,
+                "pid": 1,
+                "tid": tid,
+                "args": dict(span.attributes, span_id=span.span_id, parent_id=span.parent_id)
+            })
+        events.extend(
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+            for name, tid in threads.items()
+        )
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"trace_id": self.trace_id}}
+
+    def to_otlp(self):
+        spans = []
+        for span in self._finished_spans():
+            attributes = dict(span.attributes, **{"thread.name": span.thread})
+            error = attributes.pop("error", None)
+            record = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()],
+                "status": {"code": 2, "message": str(error)} if error else {}
+            }
+            if span.parent_id:
+                record["parentSpanId"] = span.parent_id
+            spans.append(record)
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "builder"}, "spans": spans}]
+        }]}
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+@contextmanager
+def span(name, **attributes):
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attributes["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span.reset(token)
+        parent.trace._finish(child)
+
+
+@contextmanager
+def start_trace(trace_id, name="build", **attributes):
+    trace = Trace(trace_id)
+    root = Span(trace, name, None, attributes)
+    token = current_span.set(root)
+    _remember(trace)
+    try:
+        yield root
+    except BaseException as e:
+        root.attributes["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span.reset(token)
+        trace._finish(root)
+        if TRACE_OTLP_FILE:
+            export_otlp(trace, TRACE_OTLP_FILE)
+
+
+def _remember(trace):
+    with _traces_lock:
+        _traces[trace.trace_id] = trace
+        while len(_traces) > TRACE_HISTORY:
+            _traces.popitem(last=False)
+
+
+def get_trace(trace_id):
+    with _traces_lock:
+        return _traces.get(trace_id)
+
+
+def export_otlp(trace, path):
+    line = json.dumps(trace.to_otlp(), ensure_ascii=False) + "\n"
+    try:
+        with _otlp_lock, open(path, 'a', encoding='utf-8') as otlp_file:
+            otlp_file.write(line)
+    except Exception:
+        pass
@@ -0,0 +1,19 @@
+import multiprocessing
+
+# Modules every fork server child starts with, collected from the pools that
+# use process_context(); only honoured until the fork server has started
+_preload = set()
+
+
+def process_context(*preload):
+    # Start method for the builder's process pools. Workers are forked from a
+    # single-threaded fork server rather than from the server process, whose
+    # event loop, executors and HTTP client threads may hold locks at fork
+    # time. `preload` names modules the fork server imports once, so workers
+    # start without importing them again. spawn where forkserver is missing.
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    _preload.update(preload)
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(sorted(_preload))
+    return context
@@ -0,0 +1,210 @@
+import os
+import glob
+import uuid
+import fcntl
+import shutil
+import filecmp
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Directories a build may write to, relative to the base directory
+WORKSPACE_DIRS = ('templates', 'static', 'routes')
+# Parent directory for per-build workspaces. The default, <base>/.workspaces,
+# keeps them on the same filesystem as the base files so both the hardlinks
+# and the commit renames work.
+WORKSPACE_ROOT = os.environ.get('WORKSPACE_ROOT') or None
+
+# The workspace of the build running in the current context, if any. Tool
+# threads inherit it through the copied context (see tool_scheduler).
+current_workspace = contextvars.ContextVar('workspace', default=None)
+
+
+# Commits from concurrent builds are applied one batch at a time, across
+# threads (this lock) and worker processes (a lock file next to the workspaces)
+_commit_lock = threading.Lock()
+
+
+class PathOutsideWorkspace(ValueError):
+    pass
+
+
+class CommitConflict(Exception):
+    # The base files at `paths` changed (another build committed them) after
+    # this workspace was created, and this build changed them too
+
+    def __init__(self, paths):
+        super().__init__(f"files changed by another build since this build started: {', '.join(paths)}")
+        self.paths = paths
+
+
+def _ignore_caches(directory, names):
+    return [name for name in names if name == '__pycache__']
+
+
+@contextmanager
+def _commit_guard(lock_path):
+    with _commit_lock, open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _signature(path):
+    # None for a missing file
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _files(root, dirs):
+    # Relative paths of the files under root/<dir> for each of dirs
+    for directory in dirs:
+        for current, subdirs, files in os.walk(os.path.join(root, directory)):
+            subdirs[:] = [d for d in subdirs if d != '__pycache__']
+            for filename in files:
+                yield os.path.relpath(os.path.join(current, filename), root)
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+class Workspace:
+    # A private view of templates/, static/ and routes/ for one build. Base
+    # files are hardlinked in, and writers replace files instead of writing
+    # through them (see write_file in main.py), so a write never reaches the
+    # shared inode: copy-on-write at file granularity. Tool paths are mapped
+    # into the workspace and confined to those directories; nothing is visible
+    # in the base directory until commit().
+    #
+    # `snapshot` maps each file brought in from the base to the signatures
+    # (inode, mtime, size) of its workspace copy and of the base file at
+    # creation time: a build changed a file when its copy no longer matches,
+    # and another build changed it when the base file no longer matches.
+
+    def __init__(self, root, base_dir, dirs=WORKSPACE_DIRS, snapshot=None):
+        self.root = root
+        self.base_dir = base_dir
+        self.dirs = dirs
+        self.snapshot = snapshot or {}
+
+    @classmethod
+    def create(cls, base_dir, name='build', dirs=WORKSPACE_DIRS):
+        parent = WORKSPACE_ROOT or os.path.join(base_dir, '.workspaces')
+        os.makedirs(parent, exist_ok=True)
+        root = tempfile.mkdtemp(prefix=f'{name}-', dir=parent)
+        for directory in dirs:
+            source = os.path.join(base_dir, directory)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(root, directory), ignore=_ignore_caches,
+                                copy_function=_link_or_copy)
+        snapshot = {relative: (_signature(os.path.join(root, relative)), _signature(os.path.join(base_dir, relative)))
+                    for relative in _files(root, dirs)}
+        return cls(root, base_dir, dirs, snapshot)
+
+    def relative(self, path):
+        # Relative paths are taken relative to the base directory; absolute
+        # paths may point into the base directory or into this workspace
+        absolute = os.path.normpath(os.path.join(self.base_dir, path))
+        for prefix in (self.root, self.base_dir):
+            if absolute == prefix or absolute.startswith(prefix + os.sep):
+                relative = os.path.relpath(absolute, prefix)
+                break
+        else:
+            raise PathOutsideWorkspace(f"path {path!r} is outside the build workspace")
+        if relative.split(os.sep)[0] not in self.dirs:
+            raise PathOutsideWorkspace(
+                f"path {path!r} is outside the writable directories ({', '.join(d + '/' for d in self.dirs)})"
+            )
+        return relative
+
+    def resolve(self, path):
+        return os.path.join(self.root, self.relative(path))
+
+    def changes(self):
+        # Relative paths of files this build wrote or created. Writers replace
+        # files, so a copy with its original signature was never written, even
+        # when another build has since committed a newer version to the base.
+        # Written files that ended up identical to the base are left out.
+        changed = []
+        for relative in _files(self.root, self.dirs):
+            source = os.path.join(self.root, relative)
+            original = self.snapshot.get(relative)
+            if original is not None and _signature(source) == original[0]:
+                continue
+            try:
+                if filecmp.cmp(source, os.path.join(self.base_dir, relative), shallow=False):
+                    continue
+            except FileNotFoundError:
+                pass
+            changed.append(relative)
+        return sorted(changed)
+
+    def conflicts(self, changed):
+        # Paths among `changed` whose base file is no longer the one this
+        # workspace started from (for new files: that now exist in the base)
+        return [relative for relative in changed
+                if _signature(os.path.join(self.base_dir, relative)) !=
+                (self.snapshot[relative][1] if relative in self.snapshot else None)]
+
+    def commit(self):
+        # Stages every changed file next to its target first, then renames them
+        # all into place in one batch, so readers never see a partially written
+        # file and the base directory changes in one short burst. Returns the
+        # committed relative paths; raises CommitConflict, without changing
+        # anything, when another build committed one of the same files first.
+        with _commit_guard(os.path.join(os.path.dirname(self.root), '.commit.lock')):
+            changed = self.changes()
+            conflicts = self.conflicts(changed)
+            if conflicts:
+                raise CommitConflict(conflicts)
+            staged = []
+            try:
+                for relative in changed:
+                    target = os.path.join(self.base_dir, relative)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    temporary = os.path.join(os.path.dirname(target),
+                                             f'.{os.path.basename(target)}.{uuid.uuid4().hex[:8]}.commit')
+                    _link_or_copy(os.path.join(self.root, relative), temporary)
+                    staged.append((temporary, target, relative))
+            except BaseException:
+                for temporary, _, _ in staged:
+                    try:
+                        os.remove(temporary)
+                    except OSError:
+                        pass
+                raise
+            for temporary, target, _ in staged:
+                os.replace(temporary, target)
+        return [relative for _, _, relative in staged]
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def resolve_path(path):
+    # Maps a tool path into the current build's workspace; unchanged outside one
+    workspace = current_workspace.get()
+    return workspace.resolve(path) if workspace is not None else path
+
+
+def expand_path(pattern):
+    # Expands a tool path that may contain glob patterns (routes/*.py,
+    # templates/**/*.html) into (tool path, file path) pairs for matching files
+    workspace = current_workspace.get()
+    if workspace is None:
+        matches = [(match, match) for match in sorted(glob.glob(pattern, recursive=True))]
+    else:
+        matches = [(os.path.relpath(match, workspace.root), match)
+                   for match in sorted(glob.glob(workspace.resolve(pattern), recursive=True))]
+    return [(path, target) for path, target in matches
+            if os.path.isfile(target) and '__pycache__' not in target.split(os.sep)]